@@ -2,9 +2,13 @@ import streamlit as st
 import db
 import pandas as pd
 import base64
+import logging
+import threading
 from datetime import date, datetime, timedelta
 from io import BytesIO
 
+_log = logging.getLogger(__name__)
+
 def _make_qr_bytes(data: str) -> bytes:
     """Return PNG bytes of a QR code encoding `data`."""
     import qrcode
@@ -40,10 +44,13 @@ STAGE_LABEL = {
     'SEND TO SITE':        'Delivered to Site',
 }
 
-@st.cache_data(ttl=3600, show_spinner=False)
+@st.cache_resource(ttl=3600, show_spinner=False)
+def _get_mark_index():
+    """Shared by every session; delta imports update it in place, other imports clear it."""
+    return db.get_mark_index()
+
 def _get_marks():
-    """Cleared on import; otherwise stable for the session."""
-    return db.get_marks()
+    return _get_mark_index().marks()
 
 @st.cache_data(ttl=3600, show_spinner=False)
 def _get_work_orders():
@@ -54,12 +61,9 @@ def _get_marks_by_work_order(work_order):
     return db.get_marks_by_work_order(work_order)
 
 @st.cache_data(ttl=300, show_spinner=False)
-def _get_stage_daily_stats():
-    return db.get_stage_daily_stats()
-
-@st.cache_data(ttl=300, show_spinner=False)
-def _get_project_summary(as_of_date=None):
-    return db.get_summary(as_of_date)
+def _get_dashboard_snapshot(as_of_date=None):
+    """Headline numbers for Report / Progress / Summary in one query."""
+    return db.get_dashboard_snapshot(as_of_date)
 
 @st.cache_data(ttl=300, show_spinner=False)
 def _get_manhour_summary():
@@ -77,9 +81,13 @@ def _get_raw_material_summary():
 def _get_today_progress(today):
     return db.search_progress(start=str(today), end=str(today))
 
-@st.cache_data(ttl=3600, show_spinner=False)
+@st.cache_data(ttl=60, show_spinner=False)
+def _get_progress_totals(stage=None, assembly_mark=None, work_order=None):
+    """Stage totals of a Show All report; every page of it shares one query."""
+    return db.search_progress_totals(stage=stage, assembly_mark=assembly_mark, work_order=work_order)
+
 def _get_sub_assemblies(mark):
-    return db.get_sub_assemblies(mark)
+    return _get_mark_index().subs(mark)
 
 @st.cache_data(ttl=3600, show_spinner=False)
 def _get_parts(mark):
@@ -89,23 +97,15 @@ def _get_parts(mark):
 def _get_completed_stages(mark, sub):
     return db.get_completed_stages(mark, sub)
 
-@st.cache_data(ttl=120, show_spinner=False)
-def _get_visual_inspection_summary():
-    return db.get_visual_inspection_summary()
-
 @st.cache_data(ttl=300, show_spinner=False)
 def _vi_passed(mark, sub):
     """Cached visual inspection check — avoids a DB hit per sub-assembly on every validate."""
     return db.visual_inspection_passed(mark, sub)
 
 @st.cache_data(ttl=300, show_spinner=False)
-def _get_on_hold_weight():
-    return db.get_on_hold_weight()
-
-@st.cache_data(ttl=300, show_spinner=False)
-def _get_all_daily_stage_totals():
-    """All (entry_date, stage, kg) rows — loaded once, filtered in Python by date."""
-    return db.get_all_daily_stage_totals()
+def _get_stage_prefix_sums():
+    """Per-stage prefix sums over daily totals — date changes are a bisect, not a DB hit."""
+    return db.get_stage_prefix_sums()
 
 @st.cache_data(ttl=120, show_spinner=False)
 def _get_missing_vi():
@@ -115,6 +115,62 @@ def _get_missing_vi():
 def _get_deliveries():
     return db.get_deliveries()
 
+def _fetch_parallel(**calls):
+    """Run a page's independent data calls concurrently on a quarter of the DB pool.
+    calls maps a name to a zero-argument callable; returns {name: result}.
+    Workers get the script-run context so st.cache_data getters behave as
+    they do on the main thread. Exceptions propagate to the page.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    try:
+        from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+    except ImportError:   # older Streamlit: run without the context
+        add_script_run_ctx = get_script_run_ctx = lambda *a, **k: None
+    ctx = get_script_run_ctx()
+
+    def _run(fn):
+        add_script_run_ctx(ctx=ctx)   # attaches to the current worker thread
+        return fn()
+
+    # concurrent sessions fanning out at once must leave connections for saves
+    workers = max(1, min(len(calls), db.get_pool_stats()['max'] // 4))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {name: pool.submit(_run, fn) for name, fn in calls.items()}
+        return {name: f.result() for name, f in futures.items()}
+
+def _paged(key, fetch):
+    """Render one keyset page with Prev/Next controls; returns its rows.
+    fetch takes after=/before= cursors and returns a db *_page() dict.
+    The cursor lives in session state under f'{key}_cursor'.
+    """
+    cursor = st.session_state.get(f'{key}_cursor') or {}
+    page = fetch(**cursor)
+    c1, c2, c3 = st.columns([1, 1, 4])
+    with c1:
+        if st.button('◀ Prev', key=f'{key}_prev', disabled=page['prev'] is None,
+                     use_container_width=True):
+            st.session_state[f'{key}_cursor'] = {'before': page['prev']}
+            st.rerun()
+    with c2:
+        if st.button('Next ▶', key=f'{key}_next', disabled=page['next'] is None,
+                     use_container_width=True):
+            st.session_state[f'{key}_cursor'] = {'after': page['next']}
+            st.rerun()
+    with c3:
+        st.caption(f"{len(page['rows'])} rows shown · about {page['estimate']:,} in total")
+    return page['rows']
+
+
+def _show_rejected(rejected, limit=20):
+    """Warn about import rows skipped over unreadable values ((sheet row, reason) pairs)."""
+    if not rejected:
+        return
+    lines = [f'Row {n}: {reason}' for n, reason in rejected[:limit]]
+    if len(rejected) > limit:
+        lines.append(f'… and {len(rejected) - limit} more')
+    st.warning(f'⚠️ {len(rejected)} entr{"y" if len(rejected) == 1 else "ies"} skipped:  \n'
+               + '  \n'.join(lines))
+
 # ── Global CSS ────────────────────────────────────────────────────────────────
 st.markdown("""
 <style>
@@ -216,6 +272,13 @@ def show_sidebar():
 # ══════════════════════════════════════════════════════════════════════════════
 # Page: Daily Entry
 # ══════════════════════════════════════════════════════════════════════════════
+def _pick_entry_mark(mark, sub):
+    """Quick-find callback: select the mark before the entry widgets are built."""
+    st.session_state['entry_wo']    = 'All'
+    st.session_state['entry_mark']  = mark
+    st.session_state['entry_sub']   = [sub] if sub else []
+    st.session_state['entry_quick'] = ''
+
 def page_daily_entry():
     st.header('✏️ Daily Entry')
 
@@ -260,10 +323,11 @@ def page_daily_entry():
                                 parts   = qr_data.split('|')
                                 qr_mark = parts[0].strip().upper()
                                 qr_sub  = parts[1].strip().upper() if len(parts) > 1 else ''
-                                if qr_mark in marks:
+                                mark_index = _get_mark_index()
+                                if qr_mark in mark_index:
                                     st.session_state['entry_mark']   = qr_mark
                                     st.session_state['entry_sub']    = (
-                                        [qr_sub] if qr_sub and qr_sub in _get_sub_assemblies(qr_mark)
+                                        [qr_sub] if qr_sub and mark_index.has(qr_mark, qr_sub)
                                         else []
                                     )
                                     st.session_state['_qr_processed'] = True
@@ -290,6 +354,18 @@ def page_daily_entry():
                         icon = '✅' if s in completed else '⏳'
                         status_cols[i].markdown(f'{icon} **{s}**')
 
+            # ── Quick find ────────────────────────────────────────────────────
+            quick = st.text_input('Quick find', key='entry_quick',
+                                  placeholder='Assembly, sub-assembly or part mark (typos OK)')
+            if quick:
+                hits = _get_mark_index().search(quick, limit=8)
+                for hit_mark, hit_sub in hits:
+                    st.button(f'{hit_mark} / {hit_sub}' if hit_sub else hit_mark,
+                              key=f'entry_quick_{hit_mark}|{hit_sub}', use_container_width=True,
+                              on_click=_pick_entry_mark, args=(hit_mark, hit_sub))
+                if not hits:
+                    st.caption('No matching marks.')
+
             entry_date = st.date_input('Date', value=date.today(), key='entry_date')
             work_orders = _get_work_orders()
             wo_sel = st.selectbox('Work Order', ['All'] + work_orders, key='entry_wo')
@@ -410,15 +486,21 @@ def page_daily_entry():
                             st.error(e)
                     else:
                         check_subs = subs_selected if subs_selected else ['']
-                        for s in check_subs:
-                            db.add_visual_inspection(entry_date, mark, s,
-                                                     weights_map.get(s, 0.0), qty, remarks)
-                        _get_visual_inspection_summary.clear()
+                        with db.transaction():
+                            taken = [s for s in check_subs
+                                     if db.add_visual_inspection(entry_date, mark, s,
+                                                                 weights_map.get(s, 0.0), qty, remarks) is None]
+                        _get_dashboard_snapshot.clear()
                         _vi_passed.clear()
                         _get_missing_vi.clear()
-                        n = len(check_subs)
-                        st.success(f'Saved {n} inspection record{"s" if n > 1 else ""}.')
-                        st.rerun()
+                        n = len(check_subs) - len(taken)
+                        if n:
+                            st.success(f'Saved {n} inspection record{"s" if n > 1 else ""}.')
+                        if taken:   # inspected from another session since the check above
+                            for s in taken:
+                                st.error(f'{s or mark}: already recorded on {entry_date}.')
+                        else:
+                            st.rerun()
             else:
                 if st.button('➕ Add to Queue', type='primary', use_container_width=True):
                     errors = []
@@ -506,9 +588,10 @@ def page_daily_entry():
                         st.session_state.queue = []
                         # Bust caches so updated data shows immediately
                         _get_today_progress.clear()
-                        _get_stage_daily_stats.clear()
+                        _get_progress_totals.clear()
+                        _get_dashboard_snapshot.clear()
                         _get_completed_stages.clear()
-                        _get_all_daily_stage_totals.clear()
+                        _get_stage_prefix_sums.clear()
                         st.success(f'Saved {count} entries.')
                         st.rerun()
                 with c2:
@@ -537,9 +620,10 @@ def page_daily_entry():
                         if del_id > 0:
                             db.delete_progress(int(del_id))
                             _get_today_progress.clear()
-                            _get_stage_daily_stats.clear()
+                            _get_progress_totals.clear()
+                            _get_dashboard_snapshot.clear()
                             _get_completed_stages.clear()
-                            _get_all_daily_stage_totals.clear()
+                            _get_stage_prefix_sums.clear()
                             st.success(f'Deleted entry #{int(del_id)}')
                             st.rerun()
             else:
@@ -600,27 +684,24 @@ def page_report():
     # ── Date selector ─────────────────────────────────────────────────────────
     selected_date = st.date_input('Select Date', value=date.today(), key='rpt_selected_date')
 
-    # ── All daily stage totals — loaded once, filtered in Python ──────────────
-    all_daily   = _get_all_daily_stage_totals()   # [{entry_date, stage, kg}, ...]
-    sel_str     = str(selected_date)
-
-    # Cumulative: sum all rows where entry_date <= selected_date
-    proj_by_stage = {s: 0.0 for s in db.STAGES}
-    for row in all_daily:
-        if row['entry_date'] <= sel_str:
-            if row['stage'] in proj_by_stage:
-                proj_by_stage[row['stage']] += row['kg']
+    # ── Everything the page reads, fetched concurrently ───────────────────────
+    sel_str = str(selected_date)
+    data = _fetch_parallel(
+        prefix_sums = _get_stage_prefix_sums,
+        snapshot    = lambda: _get_dashboard_snapshot(sel_str),
+        missing_vi  = _get_missing_vi,
+    )
+    snap = data['snapshot']
 
-    # Daily: sum rows where entry_date == selected_date
-    today_by_stage = {s: 0.0 for s in db.STAGES}
-    for row in all_daily:
-        if row['entry_date'] == sel_str and row['stage'] in today_by_stage:
-            today_by_stage[row['stage']] += row['kg']
+    # ── Stage prefix sums — loaded once, looked up by date ────────────────────
+    prefix_sums    = data['prefix_sums']
+    proj_by_stage  = prefix_sums.as_of(sel_str)   # cumulative up to selected date
+    today_by_stage = prefix_sums.on(sel_str)      # recorded on selected date
 
-    proj_total = (_get_project_summary().get('total', 0) or 0)
+    proj_total = snap.total_kg
 
     # ── Project Totals (cumulative up to selected date) ────────────────────────
-    painting_done_kg = db.get_painting_done_kg(up_to_date=sel_str)
+    painting_done_kg = snap.painting_done_kg
     st.markdown(f"**Cumulative Progress as of {selected_date.strftime('%d %b %Y')}**")
     pt_cols = st.columns(1 + len(db.STAGES) + 1)
     pt_cols[0].metric('Total Weight (kg)', f'{proj_total:,.1f}')
@@ -636,7 +717,7 @@ def page_report():
     st.divider()
 
     # stage_stats for avg/day (all-time aggregate, date-independent)
-    stage_stats  = _get_stage_daily_stats()
+    stage_stats  = snap.stage_stats
     fitup_stats  = stage_stats.get('FIT UP',  {'total_kg': 0, 'days': 0, 'avg_per_day': 0})
     weld_stats   = stage_stats.get('WELDING', {'total_kg': 0, 'days': 0, 'avg_per_day': 0})
 
@@ -658,7 +739,7 @@ def page_report():
     proj_total_kg = proj_total
     fitup_total   = proj_by_stage.get('FIT UP', 0)
     weld_total    = proj_by_stage.get('WELDING', 0)
-    on_hold_kg    = _get_on_hold_weight()
+    on_hold_kg    = snap.on_hold_kg
     workfront_kg  = proj_total_kg - fitup_total - on_hold_kg
     st.divider()
     st.markdown('**Workfront**')
@@ -672,9 +753,8 @@ def page_report():
                   f'{fitup_total:,.1f} FIT UP − {weld_total:,.1f} Welding')
     st.divider()
     st.markdown('**Ready for Delivery to Painting Shop**')
-    vi_summary     = _get_visual_inspection_summary()
-    vi_total_kg    = vi_summary.get('total_kg', 0) or 0
-    vi_entries     = vi_summary.get('entries', 0) or 0
+    vi_total_kg    = snap.vi_kg
+    vi_entries     = snap.vi_entries
     blast_total    = stage_stats.get('BLASTING & PAINTING', {'total_kg': 0})['total_kg']
     ready_kg       = vi_total_kg - blast_total
     vi_cols = st.columns(2)
@@ -688,7 +768,7 @@ def page_report():
                        'Check for missing Visual Inspection records.')
     # ── Missing Visual Inspection ──────────────────────────────────────────────
     with st.expander('🔍 Missing Visual Inspection (Welding done, VI pending)', expanded=False):
-        missing_vi = _get_missing_vi()
+        missing_vi = data['missing_vi']
         if missing_vi:
             df_missing = pd.DataFrame(missing_vi)
             df_missing.columns = ['Assembly Mark', 'Sub Assembly', 'Welding (kg)']
@@ -699,10 +779,13 @@ def page_report():
             if st.button('✅ Record VI for All', type='primary', key='bulk_vi_all'):
                 records = [{'mark': r['assembly_mark'], 'sub': r['sub_assembly_mark'],
                             'weight_kg': r['welding_kg'], 'qty': 1} for r in missing_vi]
-                n = db.bulk_add_visual_inspection(vi_date, records)
-                _get_visual_inspection_summary.clear()
+                n, skipped = db.bulk_add_visual_inspection(vi_date, records)
+                _get_dashboard_snapshot.clear()
                 _get_missing_vi.clear()
-                st.success(f'Recorded VI for {n} sub-assemblies.')
+                msg = f'Recorded VI for {n} sub-assemblies.'
+                if skipped:
+                    msg += f' {skipped} already had a record for this date.'
+                st.success(msg)
                 st.rerun()
         else:
             st.success('✅ All welded sub-assemblies have Visual Inspection records.')
@@ -733,23 +816,34 @@ def page_report():
 
     if 'report_rows' not in st.session_state:
         st.session_state.report_rows = []
+    if 'report_query' not in st.session_state:
+        st.session_state.report_query = None   # set while Show All pages through results
 
     asm = None if asm_filter == 'All' else asm_filter
     stg = None if stage_filter == 'All' else stage_filter
     wo  = None if wo_filter == 'All' else wo_filter
 
     if load:
+        st.session_state.report_query = None
         st.session_state.report_rows = db.search_progress(
             stage=stg, assembly_mark=asm, start=str(start), end=str(end), work_order=wo)
     if load_all:
-        st.session_state.report_rows = db.search_progress(stage=stg, assembly_mark=asm, work_order=wo)
+        st.session_state.report_query = dict(stage=stg, assembly_mark=asm, work_order=wo)
+        st.session_state.rpt_cursor = {}
 
-    rows = st.session_state.report_rows
+    query = st.session_state.report_query
+    if query is not None:
+        rows = _paged('rpt', lambda **cur: db.search_progress_page(**query, **cur))
+    else:
+        rows = st.session_state.report_rows
     if rows:
-        summary       = db.get_summary()
-        project_total = summary.get('total', 0) or 0
-        stage_totals  = {s: sum(r['weight_kg'] for r in rows if r['stage'] == s)
-                         for s in db.STAGES}
+        project_total = snap.total_kg
+        if query is not None:   # totals cover every match, not just the page shown
+            totals = _get_progress_totals(**query)
+            stage_totals = {s: totals.get(s, 0) for s in db.STAGES}
+        else:
+            stage_totals = {s: sum(r['weight_kg'] for r in rows if r['stage'] == s)
+                            for s in db.STAGES}
 
         # Fill the placeholder above the filters
         with summary_container:
@@ -790,9 +884,10 @@ def page_report():
                 if c[10].button('🗑', key=f"rpt_del_{row['id']}", use_container_width=True):
                     db.delete_progress(row['id'])
                     _get_today_progress.clear()
-                    _get_stage_daily_stats.clear()
+                    _get_progress_totals.clear()
+                    _get_dashboard_snapshot.clear()
                     _get_completed_stages.clear()
-                    _get_all_daily_stage_totals.clear()
+                    _get_stage_prefix_sums.clear()
                     st.session_state.report_rows = [r for r in st.session_state.report_rows
                                                     if r['id'] != row['id']]
                     st.rerun()
@@ -823,15 +918,12 @@ def page_report():
 def page_progress():
     st.header('📊 Progress Overview')
 
-    summary       = db.get_summary()
-    project_total = summary.get('total', 0) or 0
+    snap = _get_dashboard_snapshot()
 
     met_cols = st.columns(len(db.STAGES))
     for i, s in enumerate(db.STAGES):
-        done = summary.get(s, 0) or 0
-        pct  = min(done / project_total * 100, 100) if project_total else 0
         with met_cols[i]:
-            st.metric(f'{STAGE_BADGE[s]} {STAGE_LABEL[s]}', f'{done:,.1f} kg', f'{pct:.1f}%')
+            st.metric(f'{STAGE_BADGE[s]} {STAGE_LABEL[s]}', f'{snap.done_kg[s]:,.1f} kg', f'{snap.pct(s):.1f}%')
 
     st.divider()
 
@@ -1245,14 +1337,18 @@ def page_delivery():
             if selected_dos:
                 mc1, mc2 = st.columns(2)
                 if mc1.button('✅ Mark Selected Done', type='primary', use_container_width=True, key='mark_sel_done'):
-                    for do_no, _ in selected_dos:
-                        db.set_painting_done_by_do(str(do_no), True)
+                    with db.transaction():
+                        for do_no, _ in selected_dos:
+                            db.set_painting_done_by_do(str(do_no), True)
                     _get_deliveries.clear()
+                    _get_dashboard_snapshot.clear()
                     st.rerun()
                 if mc2.button('↩ Unmark Selected', use_container_width=True, key='unmark_sel_done'):
-                    for do_no, _ in selected_dos:
-                        db.set_painting_done_by_do(str(do_no), False)
+                    with db.transaction():
+                        for do_no, _ in selected_dos:
+                            db.set_painting_done_by_do(str(do_no), False)
                     _get_deliveries.clear()
+                    _get_dashboard_snapshot.clear()
                     st.rerun()
 
         sts_sub = df[df['Type'] == 'SEND TO SITE']
@@ -1327,11 +1423,20 @@ def page_visual_inspection():
         col_b1, col_b2 = st.columns(2)
         with col_b1:
             if st.button('🔍 Load by Date', use_container_width=True):
+                st.session_state.vi_paged = False
                 st.session_state.vi_rows = db.get_visual_inspections(str(start), str(end))
         with col_b2:
             if st.button('📋 Show All', use_container_width=True):
-                st.session_state.vi_rows = db.get_visual_inspections()
-
+                st.session_state.vi_paged = True
+                st.session_state.vi_cursor = {}
+
+        vi_asm = None if asm_filter == 'All' else asm_filter
+        if st.session_state.get('vi_paged'):
+            if st.session_state.get('vi_page_asm') != vi_asm:   # filter changed: back to page 1
+                st.session_state.vi_page_asm = vi_asm
+                st.session_state.vi_cursor = {}
+            st.session_state.vi_rows = _paged(
+                'vi', lambda **cur: db.get_visual_inspections_page(assembly_mark=vi_asm, **cur))
         rows = st.session_state.get('vi_rows', [])
         if asm_filter != 'All':
             rows = [r for r in rows if r['assembly_mark'] == asm_filter]
@@ -1353,8 +1458,9 @@ def page_visual_inspection():
                 c[6].write(row['remarks'])
                 if c[7].button('🗑', key=f"vi_del_{row['id']}", use_container_width=True):
                     db.delete_visual_inspection(row['id'])
-                    _get_visual_inspection_summary.clear()
-                    st.session_state.vi_rows = db.get_visual_inspections()
+                    _get_dashboard_snapshot.clear()
+                    st.session_state.vi_rows = [r for r in st.session_state.vi_rows
+                                                if r['id'] != row['id']]
                     st.rerun()
         else:
             st.info('Click Load or Show All to view records.')
@@ -1443,24 +1549,71 @@ def page_manage():
             'This will overwrite all existing assemblies & parts with the new data.  \n'
             '✅ All daily progress records are kept safe.'
         )
+        last = st.session_state.get('import_timings')
+        if last and 'diff' in last:
+            st.caption(
+                f"Last import: parse {last.get('parse', 0):.2f}s · "
+                f"diff {last.get('diff', 0):.2f}s · "
+                f"apply {last.get('apply', 0):.2f}s · total {last.get('total', 0):.2f}s"
+            )
+        elif last:
+            st.caption(
+                f"Last import: parse {last.get('parse', 0):.2f}s · "
+                f"load {last.get('stage', 0):.2f}s ({last.get('method', '—')}) · "
+                f"merge {last.get('merge', 0):.2f}s · total {last.get('total', 0):.2f}s"
+            )
+        last_delta = st.session_state.pop('import_delta_summary', None)
+        if last_delta:
+            st.success(
+                f"✅ Parts: {last_delta['inserted']} added · {last_delta['updated']} updated · "
+                f"{last_delta['deleted']} removed · {last_delta['unchanged']} unchanged.  \n"
+                f"Assemblies: {last_delta['assemblies_inserted']} added · "
+                f"{last_delta['assemblies_updated']} updated · {last_delta['assemblies_deleted']} removed.  \n"
+                f"Progress: {last_delta['progress_added']} added · "
+                f"{last_delta['progress_updated']} updated · {last_delta['progress_deleted']} removed."
+            )
+        _show_rejected(st.session_state.pop('import_rejected', None))
+        import_mode = st.radio(
+            'Import mode',
+            ['Apply changes only', 'Replace everything'],
+            horizontal=True,
+            help='"Apply changes only" updates just the parts that differ from the file and '
+                 'leaves unchanged rows (and their IDs) alone. "Replace everything" reloads '
+                 'all assemblies & parts.',
+        )
         uploaded = st.file_uploader('Choose Excel file (.xlsx)', type=['xlsx', 'xls'])
         if st.button('📥 Import & Overwrite', type='primary', use_container_width=True,
                      disabled=uploaded is None):
             file_bytes = uploaded.read()
-            part_count, prog_count, err = db.replace_import_excel(file_bytes)
+            timings, rejected = {}, []
+            if import_mode == 'Apply changes only':
+                delta, err = db.delta_import_excel(file_bytes, timings=timings)
+                rejected = delta.pop('rejected')
+                part_count, prog_count = delta['inserted'] + delta['updated'], delta['progress_added']
+                if not err:
+                    mark_changes = delta.pop('marks')
+                    mark_index = _get_mark_index()
+                    mark_index.remove(**mark_changes['removed'])
+                    mark_index.add(**mark_changes['added'])
+                    st.session_state['import_delta_summary'] = delta
+            else:
+                part_count, prog_count, err = db.replace_import_excel(file_bytes, timings=timings,
+                                                                      rejected=rejected)
+                if not err:
+                    _get_mark_index.clear()
+            st.session_state['import_timings'] = timings
+            st.session_state['import_rejected'] = rejected
             if err:
                 st.error(f'Import failed: {err}')
             else:
-                _get_marks.clear()
                 _get_work_orders.clear()
                 _get_marks_by_work_order.clear()
-                _get_sub_assemblies.clear()
                 _get_parts.clear()
                 _get_today_progress.clear()
-                _get_stage_daily_stats.clear()
+                _get_progress_totals.clear()
+                _get_dashboard_snapshot.clear()
                 _get_completed_stages.clear()
-                _get_all_daily_stage_totals.clear()
-                _get_visual_inspection_summary.clear()
+                _get_stage_prefix_sums.clear()
                 _get_raw_material_summary.clear()
                 _vi_passed.clear()
                 st.success(f'✅ Imported {part_count} parts and {prog_count} progress records.')
@@ -1658,6 +1811,25 @@ def page_manage():
         else:
             st.info('No login history yet.')
 
+        st.divider()
+        st.subheader('🗄️ Database Connections')
+        st.caption('Connection pool for this server process.')
+        ps = db.get_pool_stats()
+        pc1, pc2, pc3, pc4 = st.columns(4)
+        pc1.metric('In Use', f"{ps['in_use']} / {ps['max']}")
+        pc2.metric('Idle', ps['idle'])
+        pc3.metric('Avg Wait', f"{ps['avg_wait'] * 1000:,.1f} ms",
+                   f"max {ps['max_wait'] * 1000:,.0f} ms", delta_color='off')
+        pc4.metric('Acquire Failures', ps['failures'],
+                   f"{ps['timeouts']} timeouts · {ps['connect_errors']} connect errors",
+                   delta_color='off')
+        held = db.get_held_connections()
+        if held:
+            st.warning(f'⚠️ {len(held)} connection(s) held longer than expected — possible leak.')
+            for h in held:
+                with st.expander(f"Held {h['held_for']:,.1f}s · thread {h['thread']}"):
+                    st.code(h['stack'] or 'Set FAB_DB_DEBUG=1 to record checkout stacks.')
+
     # ── Settings ──────────────────────────────────────────────────────────────
     with tab_settings:
         st.subheader('Project Settings')
@@ -1683,7 +1855,9 @@ def page_manage():
         if confirm:
             if st.button('🗑 Clear All Database', type='primary'):
                 db.clear_all_data()
+                _get_mark_index.clear()
                 st.session_state.report_rows = []
+                st.session_state.report_query = None
                 st.success('All database records have been cleared.')
                 st.rerun()
 
@@ -1754,15 +1928,32 @@ def page_raw_material():
                 st.caption('Columns: **Received Date · D.O. Number · Description · Grade · Qty · Total kg · Remark**')
                 uploaded = st.file_uploader('Choose Excel file (.xlsx)', type=['xlsx', 'xls'],
                                             key='rm_upload')
+                rm_upsert = st.checkbox(
+                    'Update rows already imported', value=True, key='rm_upsert',
+                    help='Rows with the same Received Date, D.O. Number, Description and Grade '
+                         'are updated instead of added again.',
+                )
+                last_rm = st.session_state.pop('rm_import_stats', None)
+                if last_rm:
+                    st.success(f"✅ {last_rm['inserted']} added · {last_rm['updated']} updated · "
+                               f"{last_rm['unchanged']} unchanged.")
+                    _show_rejected(last_rm.get('rejected'))
+                    if last_rm.get('ambiguous'):
+                        st.warning(
+                            f"⚠️ {len(last_rm['ambiguous'])} row(s) left unchanged: their Received Date, "
+                            "D.O. Number, Description and Grade match more than one existing entry.  \n"
+                            + '  \n'.join(f'Row {n}: {hits} entries' for n, hits in last_rm['ambiguous'][:20]))
                 if st.button('📥 Import', type='primary', use_container_width=True,
                              disabled=uploaded is None):
                     file_bytes = uploaded.read()
-                    count, err = db.import_raw_materials_excel(file_bytes)
+                    rm_stats = {}
+                    count, err = db.import_raw_materials_excel(file_bytes, upsert=rm_upsert, stats=rm_stats)
                     if err:
                         st.error(f'Import failed: {err}')
                     else:
-                        st.success(f'Imported {count} records.')
+                        st.session_state['rm_import_stats'] = rm_stats
                         st.session_state.rm_rows = []
+                        st.session_state.rm_paged = False
                         st.rerun()
 
     st.markdown('---')
@@ -1792,12 +1983,15 @@ def page_raw_material():
         st.session_state.rm_rows = []
 
     if load:
+        st.session_state.rm_paged = False
         st.session_state.rm_rows = db.get_raw_materials(str(start), str(end))
     if load_all:
-        st.session_state.rm_rows = db.get_raw_materials()
+        st.session_state.rm_paged = True
+        st.session_state.rm_cursor = {}
 
-    rows = st.session_state.rm_rows
-    if rows:
+    paged = st.session_state.get('rm_paged', False)
+    rows = _paged('rm', db.get_raw_materials_page) if paged else st.session_state.rm_rows
+    if rows and not paged:   # Show All: the overall summary above already covers it
         # ── Filtered summary ──────────────────────────────────────────────────
         filt_qty = sum(r.get('qty', 0) for r in rows)
         filt_kg  = sum(r.get('total_kg', 0) for r in rows)
@@ -1806,9 +2000,15 @@ def page_raw_material():
         fc2.metric('Qty (filtered)', f'{filt_qty:,.2f}')
         fc3.metric('Total kg (filtered)', f'{filt_kg:,.2f} kg')
 
+    if rows:
         st.markdown('')
-        df = pd.DataFrame(rows)[['id', 'received_date', 'do_no', 'description', 'grade', 'qty', 'total_kg', 'remark']]
-        df.columns = ['ID', 'Received Date', 'D.O. No.', 'Description', 'Grade', 'Qty', 'Total kg', 'Remark']
+        # Show All pages carry no display_no (see db.get_raw_materials_page)
+        cols = ['received_date', 'do_no', 'description', 'grade', 'qty', 'total_kg', 'remark']
+        names = ['Received Date', 'D.O. No.', 'Description', 'Grade', 'Qty', 'Total kg', 'Remark']
+        if not paged:
+            cols, names = ['display_no'] + cols, ['No.'] + names
+        df = pd.DataFrame(rows)[cols]
+        df.columns = names
         st.dataframe(df, use_container_width=True, hide_index=True)
 
         ec1, ec2 = st.columns(2)
@@ -1827,11 +2027,15 @@ def page_raw_material():
 
         if role != 'viewer':
             with st.form('del_rm'):
-                del_id = st.number_input('Delete entry by ID', min_value=0, step=1, value=0)
+                rm_labels = {r['id']: (f"No. {r['display_no']} · " if 'display_no' in r else '')
+                                      + f"{r['received_date'] or '—'} · {r['do_no']} · {r['description']}"
+                             for r in rows}
+                del_ids = st.multiselect('Delete entries', list(rm_labels), format_func=rm_labels.get)
                 if st.form_submit_button('🗑 Delete', type='secondary'):
-                    if del_id > 0:
-                        db.delete_raw_material(int(del_id))
-                        st.success(f'Deleted entry #{int(del_id)}')
+                    if del_ids:
+                        n = db.delete_raw_materials(del_ids)
+                        st.session_state.rm_rows = [r for r in rows if r['id'] not in set(del_ids)]
+                        st.success(f'Deleted {n} entr{"y" if n == 1 else "ies"}.')
                         st.rerun()
     else:
         st.info('Click **Load by Date** or **Show All** to display records.')
@@ -1847,13 +2051,12 @@ def page_summary():
     st.header('📈 Progress Summary')
 
     # ── Load data ──────────────────────────────────────────────────────────────
-    summary    = db.get_summary()
+    snap       = _get_dashboard_snapshot()
     daily_prod = db.get_daily_production()
 
-    project_total = summary.get('total', 0) or 0
-    stage_done    = {s: summary.get(s, 0) or 0 for s in db.STAGES}
-    stage_pcts    = [min(stage_done[s] / project_total * 100, 100) if project_total else 0
-                     for s in db.STAGES]
+    project_total = snap.total_kg
+    stage_done    = snap.done_kg
+    stage_pcts    = [snap.pct(s) for s in db.STAGES]
     overall_pct   = sum(stage_pcts) / len(db.STAGES) if db.STAGES else 0
 
     # ── KPI row ────────────────────────────────────────────────────────────────
@@ -2006,15 +2209,16 @@ def page_drawing():
                 if not drw_files:
                     st.error('Please select at least one file.')
                 else:
-                    for f in drw_files:
-                        title = f.name.rsplit('.', 1)[0]   # filename without extension
-                        db.save_drawing(
-                            title, '',
-                            f.name, f.read(),
-                            st.session_state.user['username'],
-                            drw_rev.strip(),
-                            str(drw_date),
-                        )
+                    with db.transaction():
+                        for f in drw_files:
+                            title = f.name.rsplit('.', 1)[0]   # filename without extension
+                            db.save_drawing(
+                                title, '',
+                                f.name, f.read(),
+                                st.session_state.user['username'],
+                                drw_rev.strip(),
+                                str(drw_date),
+                            )
                     n = len(drw_files)
                     st.success(f'Uploaded {n} drawing{"s" if n > 1 else ""}.')
                     st.rerun()
@@ -2082,6 +2286,20 @@ def _init_db(_schema_v=8):
     db.init()
 
 
+@st.cache_resource(ttl=86400, show_spinner=False)
+def _verify_assembly_weights():
+    """Re-check assembly totals against their parts at most once a day per server.
+    Runs on a background thread: a slow or failing check is logged, never shown."""
+    def run():
+        try:
+            db.verify_assembly_weights(repair=True)
+        except Exception:
+            _log.exception('assembly weight check failed')
+    t = threading.Thread(target=run, name='verify-assembly-weights', daemon=True)
+    t.start()
+    return t
+
+
 def main():
     try:
         _init_db()
@@ -2101,6 +2319,8 @@ def main():
                 f"Technical detail: `{type(e).__name__}: {e}`")
         st.stop()
 
+    _verify_assembly_weights()
+
     # Cache project name in session state — avoids a DB hit on every rerun
     if 'project_name' not in st.session_state:
         st.session_state.project_name = db.get_project_name()
@@ -1,7 +1,16 @@
-import os, sys
+import os, sys, re, threading, time, logging, traceback
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.pool
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
 from datetime import date
+from functools import lru_cache
+from operator import itemgetter
 
 STAGES = ['FIT UP', 'WELDING', 'BLASTING & PAINTING', 'SEND TO SITE']
 
@@ -33,38 +42,385 @@ class _CurWrap:
         row = self._cur.fetchone()
         return row['id'] if row else None
 
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+
+# ── Prepared statements ────────────────────────────────────────────────────────
+# Hot statements are PREPAREd once per server connection and then run with
+# EXECUTE, so Postgres skips parse/plan on every call.  Needs a session-mode
+# connection (Supabase pooler port 5432); set FAB_DB_PREPARE=0 to disable.
+
+_PREPARE_ENABLED = os.environ.get('FAB_DB_PREPARE', '1') != '0'
+_STMT_CACHE_SIZE = 128   # prepared statements kept per connection (LRU)
+_PREPARABLE      = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH'}
+_PREPARE_RETRIES = 3     # PREPAREs of one statement that may fail on state before it runs unprepared
+
+# A PREPARE that fails on the statement itself (syntax, parameter types, an
+# unsupported feature) is final.  These errors name objects that may exist by
+# the next call (a temp table, a migration still to run, a grant); they and
+# non-SQL failures such as a statement timeout are retried.
+_PREPARE_TRANSIENT = (psycopg2.errors.UndefinedTable, psycopg2.errors.UndefinedColumn,
+                      psycopg2.errors.UndefinedFunction, psycopg2.errors.UndefinedObject,
+                      psycopg2.errors.InvalidSchemaName, psycopg2.errors.InsufficientPrivilege)
+
+_stmt_stats      = {'hits': 0, 'misses': 0, 'evictions': 0, 'unpreparable': 0, 'prepare_retries': 0}
+_stmt_stats_lock = threading.Lock()
+
+
+def _stmt_count(name, n=1):
+    with _stmt_stats_lock:
+        _stmt_stats[name] += n
+
+
+@lru_cache(maxsize=1024)
+def _translate(sql):
+    """Translate a ?-placeholder statement once per distinct SQL text.
+    Returns (pyformat_sql, prepare_body, execute_args)."""
+    pyformat = sql.replace('?', '%s')
+    n = 0
+
+    def _number(m):
+        nonlocal n
+        if m.group(0) == '%%':
+            return '%'
+        n += 1
+        return f'${n}'
+
+    body = re.sub(r'%s|%%', _number, pyformat)
+    args = ' (' + ', '.join(['%s'] * n) + ')' if n else ''
+    return pyformat, body, args
+
+
+class _StatementCache:
+    """Per-connection LRU of server-side prepared statements keyed by SQL text.
+    A cached value of None marks a statement that cannot be prepared: its
+    PREPARE failed on the statement itself, or _PREPARE_RETRIES times in a row
+    on _PREPARE_TRANSIENT errors."""
+
+    def __init__(self, capacity=_STMT_CACHE_SIZE):
+        self.capacity = capacity
+        self.hits     = 0
+        self.misses   = 0
+        self._entries = OrderedDict()   # key -> 'EXECUTE name' or None
+        self._failures = {}             # key -> transient PREPARE failures so far
+        self._seq     = 0
+        self._stale   = False           # clear() called; DEALLOCATE ALL still owed
+
+    def lookup(self, cur, key, body, args):
+        """Return the EXECUTE statement for `key`, preparing it on first use.
+        None means run the statement unprepared."""
+        stmt = self._entries.get(key, False)
+        if stmt is not False:
+            self._entries.move_to_end(key)
+            if stmt is not None:
+                self.hits += 1
+                _stmt_count('hits')
+            return stmt
+
+        self.misses += 1
+        _stmt_count('misses')
+        stmt = None
+        verb = key.split(None, 1)[0].upper() if key else ''
+        if verb in _PREPARABLE:
+            if self._stale:
+                cur.execute('DEALLOCATE ALL')
+                self._stale = False
+            self._seq += 1
+            name = f'fab_ps_{self._seq}'
+            try:
+                # Savepoint keeps a failed PREPARE from aborting the caller's transaction
+                cur.execute(f'SAVEPOINT fab_ps; PREPARE {name} AS {body}; RELEASE SAVEPOINT fab_ps')
+                stmt = f'EXECUTE {name}{args}'
+            except psycopg2.errors.InFailedSqlTransaction:
+                raise   # the caller's transaction had already failed; no savepoint was set
+            except psycopg2.Error as e:
+                cur.execute('ROLLBACK TO SAVEPOINT fab_ps; RELEASE SAVEPOINT fab_ps')
+                if (isinstance(e, _PREPARE_TRANSIENT)
+                        or not isinstance(e, (psycopg2.ProgrammingError, psycopg2.NotSupportedError))):
+                    failures = self._failures.pop(key, 0) + 1
+                    if failures < _PREPARE_RETRIES:   # not cached: the next call prepares again
+                        self._failures[key] = failures
+                        if len(self._failures) > self.capacity:
+                            del self._failures[next(iter(self._failures))]
+                        _stmt_count('prepare_retries')
+                        return None
+            self._failures.pop(key, None)
+        if stmt is None:
+            _stmt_count('unpreparable')
+
+        self._entries[key] = stmt
+        if len(self._entries) > self.capacity:
+            _, old = self._entries.popitem(last=False)
+            if old is not None:
+                cur.execute('DEALLOCATE ' + old.split()[1])
+                _stmt_count('evictions')
+        return stmt
+
+    def clear(self):
+        """Forget every prepared statement (e.g. after a schema change).  The server
+        side is deallocated before the next PREPARE, inside whatever transaction
+        is open then, so clearing never commits or rolls back the caller's work."""
+        self._entries.clear()
+        self._failures.clear()
+        self._stale = True
+
+
+# DATE columns come back as 'YYYY-MM-DD' strings, as they did when they were TEXT
+_DATE_AS_STR = psycopg2.extensions.new_type((1082,), 'FAB_DATE_STR', lambda value, cur: value)
+
+
+class _PgConnection(psycopg2.extensions.connection):
+    """psycopg2 connection that carries its own prepared-statement cache
+    plus the bookkeeping the pool needs to decide when to validate or recycle it."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        psycopg2.extensions.register_type(_DATE_AS_STR, self)
+        self.stmt_cache = _StatementCache()
+        self.created_at = self.last_used = time.monotonic()
+        self.broken     = False   # set when a statement hit a connection-level error
+
+
+def get_statement_cache_stats():
+    """Process-wide prepared-statement counters: hits, misses, evictions, hit_rate."""
+    with _stmt_stats_lock:
+        stats = dict(_stmt_stats)
+    total = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / total if total else 0.0
+    return stats
+
 
 class _DBConn:
     """psycopg2 connection wrapper that mimics sqlite3 usage patterns.
     Converts ? placeholders to %s and uses RealDictCursor for dict-like row access.
-    When created from the pool, close() returns the connection to the pool."""
+    Statements run through the connection's prepared-statement cache when possible.
+    When created from the pool, close() returns the connection to the pool.
+    A joined wrapper belongs to an enclosing transaction(): its commit() and
+    close() are no-ops and the outer block decides the outcome."""
 
-    def __init__(self, conn, pool=None):
-        self._conn = conn
-        self._pool = pool
+    def __init__(self, conn, pool=None, joined=False):
+        self._conn   = conn
+        self._pool   = pool
+        self._joined = joined
 
     def execute(self, sql, params=None):
-        sql = sql.replace('?', '%s')
-        cur = self._conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute(sql, params or [])
+        pyformat, body, args = _translate(sql)
+        cur   = self._conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cache = getattr(self._conn, 'stmt_cache', None)
+        if cache is None or not _PREPARE_ENABLED:
+            cur.execute(pyformat, params or [])
+            return _CurWrap(cur)
+
+        fresh = self._conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        try:
+            stmt = cache.lookup(cur, sql, body, args)
+            cur.execute(stmt or pyformat, params or [])
+        except psycopg2.errors.FeatureNotSupported:
+            # "cached plan must not change result type": the schema changed under us.
+            # Drop the stale plans; retry only if nothing else ran in this transaction,
+            # otherwise the failed transaction is left for its owner to roll back.
+            cache.clear()
+            if not fresh:
+                raise
+            self._conn.rollback()
+            cur = self._conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            cur.execute(pyformat, params or [])
+        except psycopg2.errors.UndefinedFunction:
+            # A parameter type that no longer matches its column re-prepares on the
+            # next call, but isn't retried: it is as likely a wrong statement.
+            cache.clear()
+            raise
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self._conn.broken = True
+            raise
         return _CurWrap(cur)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Uncommitted work is rolled back by the pool when the connection goes back
+        self.close()
+        return False
+
     def commit(self):
-        self._conn.commit()
+        if not self._joined:
+            self._conn.commit()
 
     def close(self):
+        if self._joined:
+            return
         if self._pool is not None:
-            self._pool.putconn(self._conn)
+            # Broken connections are discarded instead of going back to the pool
+            discard = self._conn.closed or getattr(self._conn, 'broken', False)
+            self._conn.last_used = time.monotonic()
+            self._pool.putconn(self._conn, close=discard)
         else:
             self._conn.close()
 
 
+# ── Connection pool ────────────────────────────────────────────────────────────
+# FAB_DB_DEBUG=1 records the stack of every checkout and logs connections held
+# longer than FAB_DB_LEAK_SECS, so pool exhaustion can be traced to its caller.
+
+_DB_DEBUG  = os.environ.get('FAB_DB_DEBUG', '0') == '1'
+_LEAK_SECS = float(os.environ.get('FAB_DB_LEAK_SECS', 30))
+
+_log = logging.getLogger(__name__)
+
+
+class _ConnectionPool:
+    """Bounded, thread-safe connection pool with backpressure.
+    At most `maxconn` connections ever exist; when all are checked out, callers
+    wait up to `timeout` seconds for one to be returned and then get a
+    psycopg2.pool.PoolError.  Connections are never opened outside the pool."""
+
+    def __init__(self, minconn, maxconn, timeout, **connect_kwargs):
+        self.minconn  = minconn
+        self.maxconn  = maxconn
+        self.timeout  = timeout
+        self._kwargs  = connect_kwargs
+        self._idle    = []        # LIFO: the most recently used connection is reused first
+        self._in_use  = {}        # conn -> (checkout time, thread name, stack or None)
+        self._opening = 0         # connects in flight; they count toward maxconn
+        self._cond    = threading.Condition()
+        self._reported = set()    # checkouts already logged as possible leaks
+        self._stats   = {
+            'acquired': 0, 'waited': 0, 'wait_time': 0.0, 'max_wait': 0.0,
+            'timeouts': 0, 'connect_errors': 0, 'opened': 0, 'closed': 0,
+        }
+        for _ in range(minconn):
+            self._idle.append(self._connect())
+        self._stats['opened'] = minconn
+
+    def _connect(self):
+        return psycopg2.connect(**self._kwargs)
+
+    def getconn(self):
+        start    = time.monotonic()
+        deadline = start + self.timeout
+        conn     = None
+        owner    = self._owner()
+        if _DB_DEBUG:
+            self._report_leaks()
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn = self._idle.pop()
+                    self._in_use[conn] = owner
+                    break
+                if len(self._in_use) + self._opening < self.maxconn:
+                    self._opening += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    if _DB_DEBUG:
+                        self._report_leaks(0)
+                    raise psycopg2.pool.PoolError(
+                        f'connection pool exhausted: no connection free within {self.timeout:g}s')
+                self._cond.wait(remaining)
+            wait = time.monotonic() - start
+            self._stats['acquired']  += 1
+            self._stats['wait_time'] += wait
+            self._stats['max_wait']   = max(self._stats['max_wait'], wait)
+            if wait > 0.001:
+                self._stats['waited'] += 1
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._opening -= 1
+                    self._stats['connect_errors'] += 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._opening -= 1
+                self._in_use[conn] = owner
+                self._stats['opened'] += 1
+        return conn
+
+    @staticmethod
+    def _owner():
+        stack = ''.join(traceback.format_stack(limit=16)[:-3]) if _DB_DEBUG else None
+        return time.monotonic(), threading.current_thread().name, stack
+
+    def held(self, older_than=0.0):
+        """Checked-out connections held for at least `older_than` seconds, longest first."""
+        now = time.monotonic()
+        with self._cond:
+            owners = list(self._in_use.values())
+        held = [{'held_for': now - t, 'since': t, 'thread': name, 'stack': stack}
+                for t, name, stack in owners if now - t >= older_than]
+        return sorted(held, key=lambda h: -h['held_for'])
+
+    def _report_leaks(self, older_than=None):
+        """Log each over-held checkout once (every one of them when older_than is given)."""
+        held = self.held(_LEAK_SECS if older_than is None else older_than)
+        for h in held:
+            key = (h['since'], h['thread'])
+            if older_than is None and key in self._reported:
+                continue
+            self._reported.add(key)
+            _log.warning('DB connection held %.1fs by thread %s, checked out at:\n%s',
+                         h['held_for'], h['thread'], h['stack'] or '(stack not recorded)')
+        self._reported &= {(h['since'], h['thread']) for h in held}
+
+    def putconn(self, conn, close=False):
+        if not close and not conn.closed:
+            status = conn.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+        if close or conn.closed:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        with self._cond:
+            self._in_use.pop(conn, None)
+            if conn.closed:
+                self._stats['closed'] += 1
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            for conn in self._idle:
+                conn.close()
+            self._stats['closed'] += len(self._idle)
+            self._idle.clear()
+
+    def stats(self):
+        with self._cond:
+            s = dict(self._stats)
+            s.update(in_use=len(self._in_use), idle=len(self._idle), opening=self._opening,
+                     min=self.minconn, max=self.maxconn, timeout=self.timeout)
+        s['failures'] = s['timeouts'] + s['connect_errors']
+        s['avg_wait'] = s['wait_time'] / s['acquired'] if s['acquired'] else 0.0
+        return s
+
+
+# Pool sizing — override with FAB_DB_POOL_MIN / FAB_DB_POOL_MAX / FAB_DB_POOL_TIMEOUT
+_POOL_MIN     = int(os.environ.get('FAB_DB_POOL_MIN', 1))
+_POOL_MAX     = int(os.environ.get('FAB_DB_POOL_MAX', 4))
+_POOL_TIMEOUT = float(os.environ.get('FAB_DB_POOL_TIMEOUT', 15))
+
+
 def _get_pool():
-    """Return a module-level connection pool (created once per process)."""
+    """Build the process-wide connection pool from the database_url secret."""
     import streamlit as st
     import socket
     from urllib.parse import urlparse, unquote
-    import psycopg2.pool
 
     url = st.secrets['database_url']
     p = urlparse(url)
@@ -74,8 +430,8 @@ def _get_pool():
     except Exception:
         pass
 
-    return psycopg2.pool.ThreadedConnectionPool(
-        1, 4,
+    return _ConnectionPool(
+        _POOL_MIN, max(_POOL_MAX, _POOL_MIN), _POOL_TIMEOUT,
         host=host,
         port=p.port or 5432,
         dbname=p.path.lstrip('/'),
@@ -83,6 +439,7 @@ def _get_pool():
         password=unquote(p.password or ''),
         sslmode='require',
         connect_timeout=10,
+        connection_factory=_PgConnection,
         keepalives=1,
         keepalives_idle=60,
         keepalives_interval=10,
@@ -90,226 +447,1275 @@ def _get_pool():
     )
 
 
-_pool = None  # module-level singleton
+_pool      = None  # module-level singleton
+_pool_lock = threading.Lock()
 
+_IDLE_CHECK_SECS = 60     # validate a pooled connection only after this much idle time
+_MAX_CONN_AGE    = 1800   # recycle pooled connections older than this (seconds)
 
-def _conn():
+
+def _checkout(pool):
+    """Take a usable connection from the pool.
+    Connections that are closed, flagged broken or past _MAX_CONN_AGE are replaced;
+    only those idle longer than _IDLE_CHECK_SECS pay for a liveness round trip."""
+    while True:
+        conn = pool.getconn()
+        now  = time.monotonic()
+        if (conn.closed or getattr(conn, 'broken', False)
+                or now - getattr(conn, 'created_at', now) > _MAX_CONN_AGE):
+            pool.putconn(conn, close=True)
+            continue
+        if now - getattr(conn, 'last_used', now) > _IDLE_CHECK_SECS:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute('SELECT 1')
+                conn.rollback()
+            except psycopg2.Error:
+                pool.putconn(conn, close=True)
+                continue
+        return conn
+
+
+def _pool_instance():
     global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = _get_pool()
+    return _pool
+
+
+_local = threading.local()   # per-thread state: the open transaction(), if any
+
+
+def _conn():
+    """Check out a pooled connection; waits for a free slot rather than connecting directly.
+    Inside transaction() this returns a view onto the transaction's connection."""
+    tx = getattr(_local, 'tx', None)
+    if tx is not None:
+        return _DBConn(tx._conn, joined=True)
+    pool = _pool_instance()
+    return _DBConn(_checkout(pool), pool)
+
+
+@contextmanager
+def transaction():
+    """Unit of work: every db.* call inside the block shares one connection and
+    one transaction, committed once on exit and rolled back if anything raises.
+    Nested transaction() blocks join the outermost one.
+
+        with db.transaction():
+            db.add_part(...)
+            db.add_progress(...)
+    """
+    if getattr(_local, 'tx', None) is not None:
+        yield _conn()
+        return
+    pool  = _pool_instance()
+    owner = _DBConn(_checkout(pool), pool)
+    _local.tx = owner
     try:
-        if _pool is None:
-            _pool = _get_pool()
-        conn = _pool.getconn()
-        # Verify connection is alive; reset if stale
-        try:
-            conn.cursor().execute('SELECT 1')
-        except Exception:
-            try:
-                _pool.putconn(conn, close=True)
-            except Exception:
-                pass
-            conn = _pool.getconn()
-        return _DBConn(conn, _pool)
-    except Exception:
-        # Pool failed — fall back to direct connection
-        import streamlit as st
-        import socket
-        from urllib.parse import urlparse, unquote
-        url = st.secrets['database_url']
-        p = urlparse(url)
-        host = p.hostname
+        yield _DBConn(owner._conn, joined=True)
+        owner.commit()
+    except BaseException:
         try:
-            host = socket.getaddrinfo(host, None, socket.AF_INET)[0][4][0]
-        except Exception:
-            pass
-        conn = psycopg2.connect(
-            host=host, port=p.port or 5432, dbname=p.path.lstrip('/'),
-            user=p.username, password=unquote(p.password or ''), sslmode='require',
-        )
-        return _DBConn(conn, pool=None)
+            owner._conn.rollback()
+        except psycopg2.Error:
+            owner._conn.broken = True
+        raise
+    finally:
+        _local.tx = None
+        owner.close()
+
+
+def get_held_connections(older_than=None):
+    """Connections checked out longer than `older_than` seconds (default FAB_DB_LEAK_SECS).
+    Each entry has held_for, thread and — with FAB_DB_DEBUG=1 — the checkout stack."""
+    if _pool is None:
+        return []
+    return _pool.held(_LEAK_SECS if older_than is None else older_than)
+
+
+def get_pool_stats():
+    """Live pool metrics: in_use, idle, wait times and acquisition failures."""
+    if _pool is None:
+        return {'in_use': 0, 'idle': 0, 'opening': 0, 'min': _POOL_MIN, 'max': _POOL_MAX,
+                'timeout': _POOL_TIMEOUT, 'acquired': 0, 'waited': 0, 'wait_time': 0.0,
+                'max_wait': 0.0, 'avg_wait': 0.0, 'timeouts': 0, 'connect_errors': 0,
+                'failures': 0, 'opened': 0, 'closed': 0}
+    return _pool.stats()
+
+
+# ── Progress rollup ────────────────────────────────────────────────────────────
+# progress_rollup holds one row per (assembly, sub-assembly, stage) with the
+# summed kg and latest DO / date.  Statement-level triggers on progress keep it
+# in step from the transition tables, so a bulk import is one set-based pass:
+# inserts add a delta, updates and deletes recompute the affected keys.
+# Writers serialise per key on the rollup row itself — the upsert that adds a
+# delta, or the no-op upsert that precedes a recompute, takes the row lock (in
+# key order) and a recompute's fresh snapshot then sees every earlier writer.
+
+_PROGRESS_ROLLUP_SELECT = """
+    SELECT assembly_mark, COALESCE(sub_assembly_mark, ''), stage,
+           COALESCE(SUM(weight_kg), 0), MAX(delivery_order_no), MAX(entry_date)
+    FROM progress
+"""
+
+_PROGRESS_ROLLUP_TABLE = """
+    CREATE TABLE IF NOT EXISTS progress_rollup (
+        assembly_mark     TEXT NOT NULL,
+        sub_assembly_mark TEXT NOT NULL DEFAULT '',
+        stage             TEXT NOT NULL,
+        kg                DOUBLE PRECISION NOT NULL DEFAULT 0,
+        last_do           TEXT,
+        last_date         DATE,
+        PRIMARY KEY (assembly_mark, sub_assembly_mark, stage)
+    )
+"""
 
+_PROGRESS_ROLLUP_TRIGGERS = [
+    "DROP TRIGGER IF EXISTS trg_progress_rollup ON progress",
+    "DROP FUNCTION IF EXISTS progress_rollup_trg()",
+    "DROP FUNCTION IF EXISTS progress_rollup_refresh(TEXT, TEXT, TEXT)",
+    """
+    CREATE OR REPLACE FUNCTION progress_rollup_recompute(p_asm TEXT[], p_sub TEXT[], p_stage TEXT[])
+    RETURNS void LANGUAGE plpgsql AS $$
+    BEGIN
+        -- lock (or create) each key's row in key order, then recompute from progress
+        INSERT INTO progress_rollup AS r (assembly_mark, sub_assembly_mark, stage)
+        SELECT DISTINCT * FROM unnest(p_asm, p_sub, p_stage) ORDER BY 1, 2, 3
+        ON CONFLICT (assembly_mark, sub_assembly_mark, stage) DO UPDATE SET kg = r.kg;
+        UPDATE progress_rollup r
+           SET kg = s.kg, last_do = s.last_do, last_date = s.last_date
+          FROM (SELECT assembly_mark, COALESCE(sub_assembly_mark, '') AS sub, stage,
+                       COALESCE(SUM(weight_kg), 0) AS kg,
+                       MAX(delivery_order_no) AS last_do, MAX(entry_date) AS last_date
+                FROM progress WHERE assembly_mark = ANY(p_asm)
+                GROUP BY 1, 2, 3) s
+         WHERE (r.assembly_mark, r.sub_assembly_mark, r.stage) = (s.assembly_mark, s.sub, s.stage)
+           AND (r.assembly_mark, r.sub_assembly_mark, r.stage)
+               IN (SELECT * FROM unnest(p_asm, p_sub, p_stage));
+        DELETE FROM progress_rollup r
+         WHERE (r.assembly_mark, r.sub_assembly_mark, r.stage)
+               IN (SELECT * FROM unnest(p_asm, p_sub, p_stage))
+           AND NOT EXISTS (SELECT 1 FROM progress p
+                           WHERE p.assembly_mark = r.assembly_mark
+                             AND COALESCE(p.sub_assembly_mark, '') = r.sub_assembly_mark
+                             AND p.stage = r.stage);
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION progress_rollup_stmt_trg() RETURNS trigger LANGUAGE plpgsql AS $$
+    DECLARE
+        k_asm TEXT[]; k_sub TEXT[]; k_stage TEXT[];
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO progress_rollup AS r
+                   (assembly_mark, sub_assembly_mark, stage, kg, last_do, last_date)
+            SELECT assembly_mark, COALESCE(sub_assembly_mark, ''), stage,
+                   COALESCE(SUM(weight_kg), 0), MAX(delivery_order_no), MAX(entry_date)
+            FROM new_rows GROUP BY 1, 2, 3 ORDER BY 1, 2, 3
+            ON CONFLICT (assembly_mark, sub_assembly_mark, stage) DO UPDATE
+               SET kg        = r.kg + EXCLUDED.kg,
+                   last_do   = GREATEST(r.last_do, EXCLUDED.last_do),
+                   last_date = GREATEST(r.last_date, EXCLUDED.last_date);
+            RETURN NULL;
+        ELSIF TG_OP = 'DELETE' THEN
+            SELECT array_agg(assembly_mark), array_agg(COALESCE(sub_assembly_mark, '')), array_agg(stage)
+              INTO k_asm, k_sub, k_stage
+              FROM (SELECT DISTINCT assembly_mark, sub_assembly_mark, stage FROM old_rows) o;
+        ELSE   -- UPDATE: only rows whose rollup inputs changed, under both old and new keys
+            SELECT array_agg(asm), array_agg(sub), array_agg(stage)
+              INTO k_asm, k_sub, k_stage
+              FROM (SELECT o.assembly_mark AS asm, COALESCE(o.sub_assembly_mark, '') AS sub, o.stage
+                    FROM old_rows o JOIN new_rows n ON n.id = o.id
+                    WHERE (o.assembly_mark, o.sub_assembly_mark, o.stage, o.weight_kg,
+                           o.delivery_order_no, o.entry_date)
+                          IS DISTINCT FROM
+                          (n.assembly_mark, n.sub_assembly_mark, n.stage, n.weight_kg,
+                           n.delivery_order_no, n.entry_date)
+                    UNION
+                    SELECT n.assembly_mark, COALESCE(n.sub_assembly_mark, ''), n.stage
+                    FROM old_rows o JOIN new_rows n ON n.id = o.id
+                    WHERE (o.assembly_mark, o.sub_assembly_mark, o.stage, o.weight_kg,
+                           o.delivery_order_no, o.entry_date)
+                          IS DISTINCT FROM
+                          (n.assembly_mark, n.sub_assembly_mark, n.stage, n.weight_kg,
+                           n.delivery_order_no, n.entry_date)) k;
+        END IF;
+        IF k_asm IS NOT NULL THEN
+            PERFORM progress_rollup_recompute(k_asm, k_sub, k_stage);
+        END IF;
+        RETURN NULL;
+    END $$
+    """,
+    "DROP TRIGGER IF EXISTS trg_progress_rollup_ins ON progress",
+    "DROP TRIGGER IF EXISTS trg_progress_rollup_del ON progress",
+    "DROP TRIGGER IF EXISTS trg_progress_rollup_upd ON progress",
+    """
+    CREATE TRIGGER trg_progress_rollup_ins AFTER INSERT ON progress
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION progress_rollup_stmt_trg()
+    """,
+    """
+    CREATE TRIGGER trg_progress_rollup_del AFTER DELETE ON progress
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION progress_rollup_stmt_trg()
+    """,
+    """
+    CREATE TRIGGER trg_progress_rollup_upd AFTER UPDATE ON progress
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION progress_rollup_stmt_trg()
+    """,
+]
 
-# ── Schema initialisation ──────────────────────────────────────────────────────
+# Raw aggregation over parts + progress; the rollup-backed query below must
+# return exactly the same rows (see check_progress_rollup).
+_CUMULATIVE_BY_SUB_RAW = """
+    SELECT
+        sp.assembly_mark,
+        sp.sub_assembly_mark,
+        sp.work_order,
+        sp.priority,
+        sp.sub_weight AS total_weight_kg,
+        COALESCE(SUM(CASE WHEN p.stage='FIT UP'              THEN p.weight_kg END), 0) AS fitup,
+        COALESCE(SUM(CASE WHEN p.stage='WELDING'             THEN p.weight_kg END), 0) AS welding,
+        COALESCE(SUM(CASE WHEN p.stage='BLASTING & PAINTING' THEN p.weight_kg END), 0) AS blasting,
+        COALESCE(SUM(CASE WHEN p.stage='SEND TO SITE'        THEN p.weight_kg END), 0) AS sendsite,
+        MAX(CASE WHEN p.stage='BLASTING & PAINTING' THEN p.delivery_order_no END) AS blasting_do,
+        MAX(CASE WHEN p.stage='SEND TO SITE'        THEN p.delivery_order_no END) AS sendsite_do
+    FROM (
+        SELECT pt.assembly_mark, pt.sub_assembly_mark,
+               a2.work_order, MAX(pt.priority) AS priority, SUM(pt.total_weight_kg) AS sub_weight
+        FROM parts pt
+        JOIN assemblies a2 ON pt.assembly_mark = a2.assembly_mark
+        WHERE pt.sub_assembly_mark != ''
+        {wo_filter1}
+        GROUP BY pt.assembly_mark, pt.sub_assembly_mark, a2.work_order
+    ) sp
+    LEFT JOIN progress p
+        ON sp.assembly_mark = p.assembly_mark
+       AND sp.sub_assembly_mark = p.sub_assembly_mark
+    GROUP BY sp.assembly_mark, sp.sub_assembly_mark, sp.work_order, sp.priority, sp.sub_weight
+
+    UNION ALL
+
+    SELECT
+        a.assembly_mark,
+        '' AS sub_assembly_mark,
+        a.work_order,
+        pp.priority,
+        a.total_weight_kg,
+        COALESCE(ps.fitup, 0)    AS fitup,
+        COALESCE(ps.welding, 0)  AS welding,
+        COALESCE(ps.blasting, 0) AS blasting,
+        COALESCE(ps.sendsite, 0) AS sendsite,
+        ps.blasting_do,
+        ps.sendsite_do
+    FROM assemblies a
+    LEFT JOIN (
+        SELECT assembly_mark, MAX(priority) AS priority
+        FROM parts GROUP BY assembly_mark
+    ) pp ON pp.assembly_mark = a.assembly_mark
+    LEFT JOIN (
+        SELECT assembly_mark,
+               SUM(CASE WHEN stage='FIT UP'              THEN weight_kg END) AS fitup,
+               SUM(CASE WHEN stage='WELDING'             THEN weight_kg END) AS welding,
+               SUM(CASE WHEN stage='BLASTING & PAINTING' THEN weight_kg END) AS blasting,
+               SUM(CASE WHEN stage='SEND TO SITE'        THEN weight_kg END) AS sendsite,
+               MAX(CASE WHEN stage='BLASTING & PAINTING' THEN delivery_order_no END) AS blasting_do,
+               MAX(CASE WHEN stage='SEND TO SITE'        THEN delivery_order_no END) AS sendsite_do
+        FROM progress GROUP BY assembly_mark
+    ) ps ON ps.assembly_mark = a.assembly_mark
+    WHERE NOT EXISTS (
+        SELECT 1 FROM parts x
+        WHERE x.assembly_mark = a.assembly_mark AND x.sub_assembly_mark != ''
+    )
+    {wo_filter2}
+    ORDER BY 1, 2
+"""
+
+_CUMULATIVE_BY_SUB = """
+    SELECT
+        sp.assembly_mark,
+        sp.sub_assembly_mark,
+        sp.work_order,
+        sp.priority,
+        sp.sub_weight AS total_weight_kg,
+        COALESCE(SUM(CASE WHEN r.stage='FIT UP'              THEN r.kg END), 0) AS fitup,
+        COALESCE(SUM(CASE WHEN r.stage='WELDING'             THEN r.kg END), 0) AS welding,
+        COALESCE(SUM(CASE WHEN r.stage='BLASTING & PAINTING' THEN r.kg END), 0) AS blasting,
+        COALESCE(SUM(CASE WHEN r.stage='SEND TO SITE'        THEN r.kg END), 0) AS sendsite,
+        MAX(CASE WHEN r.stage='BLASTING & PAINTING' THEN r.last_do END) AS blasting_do,
+        MAX(CASE WHEN r.stage='SEND TO SITE'        THEN r.last_do END) AS sendsite_do
+    FROM (
+        SELECT pt.assembly_mark, pt.sub_assembly_mark,
+               a2.work_order, MAX(pt.priority) AS priority, SUM(pt.total_weight_kg) AS sub_weight
+        FROM parts pt
+        JOIN assemblies a2 ON pt.assembly_mark = a2.assembly_mark
+        WHERE pt.sub_assembly_mark != ''
+        {wo_filter1}
+        GROUP BY pt.assembly_mark, pt.sub_assembly_mark, a2.work_order
+    ) sp
+    LEFT JOIN progress_rollup r
+        ON sp.assembly_mark = r.assembly_mark
+       AND sp.sub_assembly_mark = r.sub_assembly_mark
+    GROUP BY sp.assembly_mark, sp.sub_assembly_mark, sp.work_order, sp.priority, sp.sub_weight
+
+    UNION ALL
+
+    SELECT
+        a.assembly_mark,
+        '' AS sub_assembly_mark,
+        a.work_order,
+        pp.priority,
+        a.total_weight_kg,
+        COALESCE(ps.fitup, 0)    AS fitup,
+        COALESCE(ps.welding, 0)  AS welding,
+        COALESCE(ps.blasting, 0) AS blasting,
+        COALESCE(ps.sendsite, 0) AS sendsite,
+        ps.blasting_do,
+        ps.sendsite_do
+    FROM assemblies a
+    LEFT JOIN (
+        SELECT assembly_mark, MAX(priority) AS priority
+        FROM parts GROUP BY assembly_mark
+    ) pp ON pp.assembly_mark = a.assembly_mark
+    LEFT JOIN (
+        SELECT assembly_mark,
+               SUM(CASE WHEN stage='FIT UP'              THEN kg END) AS fitup,
+               SUM(CASE WHEN stage='WELDING'             THEN kg END) AS welding,
+               SUM(CASE WHEN stage='BLASTING & PAINTING' THEN kg END) AS blasting,
+               SUM(CASE WHEN stage='SEND TO SITE'        THEN kg END) AS sendsite,
+               MAX(CASE WHEN stage='BLASTING & PAINTING' THEN last_do END) AS blasting_do,
+               MAX(CASE WHEN stage='SEND TO SITE'        THEN last_do END) AS sendsite_do
+        FROM progress_rollup GROUP BY assembly_mark
+    ) ps ON ps.assembly_mark = a.assembly_mark
+    WHERE NOT EXISTS (
+        SELECT 1 FROM parts x
+        WHERE x.assembly_mark = a.assembly_mark AND x.sub_assembly_mark != ''
+    )
+    {wo_filter2}
+    ORDER BY 1, 2
+"""
+
+
+def rebuild_progress_rollup():
+    """Recompute progress_rollup from scratch. Returns the number of rollup rows."""
+    with _conn() as db:
+        # SHARE blocks progress writers (and so the triggers) for the duration
+        db.execute("LOCK TABLE progress IN SHARE MODE")
+        db.execute("DELETE FROM progress_rollup")
+        db.execute(f"""
+            INSERT INTO progress_rollup (assembly_mark, sub_assembly_mark, stage, kg, last_do, last_date)
+            {_PROGRESS_ROLLUP_SELECT}
+            GROUP BY 1, 2, 3
+        """)
+        n = db.execute("SELECT COUNT(*) AS n FROM progress_rollup").fetchone()['n']
+        db.commit()
+    return n
 
-def init():
-    db = _conn()
 
-    # Core tables
-    db.execute("""
-        CREATE TABLE IF NOT EXISTS assemblies (
-            assembly_mark   TEXT PRIMARY KEY,
-            total_weight_kg DOUBLE PRECISION DEFAULT 0,
-            description     TEXT DEFAULT '',
-            work_order      TEXT DEFAULT '001'
-        )
-    """)
-    db.execute("""
-        CREATE TABLE IF NOT EXISTS parts (
-            id                SERIAL PRIMARY KEY,
-            assembly_mark     TEXT NOT NULL,
-            sub_assembly_mark TEXT DEFAULT '',
-            part_mark         TEXT DEFAULT '',
-            no                INTEGER DEFAULT 1,
-            name              TEXT DEFAULT '',
-            profile           TEXT DEFAULT '',
-            kg_per_m          DOUBLE PRECISION DEFAULT 0,
-            length_mm         DOUBLE PRECISION DEFAULT 0,
-            total_weight_kg   DOUBLE PRECISION DEFAULT 0,
-            profile2          TEXT DEFAULT '',
-            grade             TEXT DEFAULT '',
-            remark            TEXT DEFAULT '',
-            FOREIGN KEY (assembly_mark) REFERENCES assemblies(assembly_mark)
-        )
-    """)
-    db.execute("""
-        CREATE TABLE IF NOT EXISTS progress (
-            id                SERIAL PRIMARY KEY,
-            entry_date        TEXT NOT NULL,
-            assembly_mark     TEXT NOT NULL,
-            stage             TEXT NOT NULL,
-            weight_kg         DOUBLE PRECISION DEFAULT 0,
-            qty               INTEGER DEFAULT 0,
-            inspector         TEXT DEFAULT '',
-            remarks           TEXT DEFAULT '',
-            created_at        TIMESTAMPTZ DEFAULT NOW(),
-            sub_assembly_mark TEXT DEFAULT '',
-            delivery_order_no TEXT DEFAULT ''
-        )
-    """)
-    db.commit()
+def check_progress_rollup(tolerance=0.01):
+    """Compare get_cumulative_by_sub() against the raw parts/progress aggregation.
+    Returns a list of mismatches: {'key': (asm, sub), 'field', 'rollup', 'raw'}.
+    An empty list means the rollup is consistent.
+    """
+    fmt = {'wo_filter1': '', 'wo_filter2': ''}
+    with _conn() as db:
+        raw = db.execute(_CUMULATIVE_BY_SUB_RAW.format(**fmt)).fetchall()
+        rolled = db.execute(_CUMULATIVE_BY_SUB.format(**fmt)).fetchall()
+    raw = {(r['assembly_mark'], r['sub_assembly_mark']): dict(r) for r in raw}
+    rolled = {(r['assembly_mark'], r['sub_assembly_mark']): dict(r) for r in rolled}
+    mismatches = []
+    for key in sorted(set(raw) | set(rolled)):
+        a, b = rolled.get(key), raw.get(key)
+        if a is None or b is None:
+            mismatches.append({'key': key, 'field': 'row', 'rollup': a is not None, 'raw': b is not None})
+            continue
+        for field in ('fitup', 'welding', 'blasting', 'sendsite'):
+            if abs((a[field] or 0) - (b[field] or 0)) > tolerance:
+                mismatches.append({'key': key, 'field': field, 'rollup': a[field], 'raw': b[field]})
+        for field in ('blasting_do', 'sendsite_do'):
+            if (a[field] or '') != (b[field] or ''):
+                mismatches.append({'key': key, 'field': field, 'rollup': a[field], 'raw': b[field]})
+    return mismatches
+
+
+# ── Daily stage totals ─────────────────────────────────────────────────────────
+# daily_stage_totals holds kg and entry count per (entry_date, stage) for
+# progress rows whose assembly exists — the same rows the report queries
+# join to assemblies.  Statement-level triggers sum each statement's rows
+# into per-key deltas and apply them in (entry_date, stage) order, so
+# concurrent writers take the totals row locks in the same order.  Inserting
+# or deleting assemblies adds or removes the matching progress the same way,
+# and TRUNCATE of assemblies empties the table.
+#
+# The progress triggers check assemblies and the assemblies triggers read
+# progress, so neither may miss the other's uncommitted rows: inserting or
+# deleting assemblies first locks progress against writes (readers go on),
+# waiting for in-flight progress writes and holding new ones until commit.
+
+_DAILY_STAGE_TOTALS_SELECT = """
+    SELECT p.entry_date, p.stage, COALESCE(SUM(p.weight_kg), 0), COUNT(*)
+    FROM progress p
+    WHERE EXISTS (SELECT 1 FROM assemblies a WHERE a.assembly_mark = p.assembly_mark)
+"""
+
+_DAILY_STAGE_TOTALS_TABLE = """
+    CREATE TABLE IF NOT EXISTS daily_stage_totals (
+        entry_date DATE NOT NULL,
+        stage      TEXT NOT NULL,
+        kg         DOUBLE PRECISION NOT NULL DEFAULT 0,
+        entries    INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (entry_date, stage)
+    )
+"""
 
-    # Idempotent column migrations
-    for col_sql in [
-        "ALTER TABLE progress   ADD COLUMN IF NOT EXISTS sub_assembly_mark TEXT DEFAULT ''",
-        "ALTER TABLE progress   ADD COLUMN IF NOT EXISTS delivery_order_no TEXT DEFAULT ''",
-        "ALTER TABLE parts      ADD COLUMN IF NOT EXISTS remark TEXT DEFAULT ''",
-        "ALTER TABLE assemblies ADD COLUMN IF NOT EXISTS work_order TEXT DEFAULT '001'",
-        "ALTER TABLE assemblies ADD COLUMN IF NOT EXISTS priority INTEGER DEFAULT 0",
-        "ALTER TABLE parts      ADD COLUMN IF NOT EXISTS priority INTEGER",
-        "ALTER TABLE progress   ADD COLUMN IF NOT EXISTS painting_done BOOLEAN DEFAULT FALSE",
-    ]:
-        db.execute(col_sql)
-    db.commit()
+# Deltas are passed as parallel arrays: (entry_date, stage, kg, entries) per row
+_DAILY_STAGE_TOTALS_TRIGGERS = [
+    "DROP TRIGGER IF EXISTS trg_daily_stage_totals ON progress",
+    "DROP FUNCTION IF EXISTS daily_stage_totals_trg()",
+    """
+    CREATE OR REPLACE FUNCTION daily_stage_totals_apply(p_date DATE[], p_stage TEXT[],
+                                                        p_kg DOUBLE PRECISION[], p_n INTEGER[])
+    RETURNS void LANGUAGE sql AS $$
+        -- one net delta per key, locked in key order; keys that net to nothing are left alone
+        INSERT INTO daily_stage_totals AS t (entry_date, stage, kg, entries)
+        SELECT d, s, SUM(kg), SUM(n)
+        FROM unnest(p_date, p_stage, p_kg, p_n) AS u(d, s, kg, n)
+        GROUP BY d, s
+        HAVING SUM(n) <> 0 OR SUM(kg) <> 0
+        ORDER BY d, s
+        ON CONFLICT (entry_date, stage) DO UPDATE
+           SET kg = t.kg + EXCLUDED.kg, entries = t.entries + EXCLUDED.entries;
+        DELETE FROM daily_stage_totals
+         WHERE (entry_date, stage) IN (SELECT * FROM unnest(p_date, p_stage)) AND entries <= 0;
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION daily_stage_totals_guard() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        LOCK TABLE progress IN SHARE ROW EXCLUSIVE MODE;
+        RETURN NULL;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION daily_stage_totals_stmt_trg() RETURNS trigger LANGUAGE plpgsql AS $$
+    DECLARE
+        k_date DATE[]; k_stage TEXT[]; k_kg DOUBLE PRECISION[]; k_n INTEGER[];
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            SELECT array_agg(entry_date), array_agg(stage), array_agg(kg), array_agg(n)
+              INTO k_date, k_stage, k_kg, k_n
+              FROM (SELECT entry_date, stage, SUM(COALESCE(weight_kg, 0)) AS kg, COUNT(*)::int AS n
+                    FROM new_rows r
+                    WHERE EXISTS (SELECT 1 FROM assemblies a WHERE a.assembly_mark = r.assembly_mark)
+                    GROUP BY 1, 2) d;
+        ELSIF TG_OP = 'DELETE' THEN
+            SELECT array_agg(entry_date), array_agg(stage), array_agg(kg), array_agg(n)
+              INTO k_date, k_stage, k_kg, k_n
+              FROM (SELECT entry_date, stage, -SUM(COALESCE(weight_kg, 0)) AS kg, -COUNT(*)::int AS n
+                    FROM old_rows r
+                    WHERE EXISTS (SELECT 1 FROM assemblies a WHERE a.assembly_mark = r.assembly_mark)
+                    GROUP BY 1, 2) d;
+        ELSE   -- UPDATE: take out the old rows, add the new ones; unchanged keys net to zero
+            SELECT array_agg(entry_date), array_agg(stage), array_agg(kg), array_agg(n)
+              INTO k_date, k_stage, k_kg, k_n
+              FROM (SELECT entry_date, stage, SUM(kg) AS kg, SUM(n)::int AS n
+                    FROM (SELECT assembly_mark, entry_date, stage,
+                                 -COALESCE(weight_kg, 0) AS kg, -1 AS n FROM old_rows
+                          UNION ALL
+                          SELECT assembly_mark, entry_date, stage,
+                                 COALESCE(weight_kg, 0), 1 FROM new_rows) r
+                    WHERE EXISTS (SELECT 1 FROM assemblies a WHERE a.assembly_mark = r.assembly_mark)
+                    GROUP BY 1, 2) d;
+        END IF;
+        IF k_date IS NOT NULL THEN
+            PERFORM daily_stage_totals_apply(k_date, k_stage, k_kg, k_n);
+        END IF;
+        RETURN NULL;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION daily_stage_totals_asm_trg() RETURNS trigger LANGUAGE plpgsql AS $$
+    DECLARE
+        k_date DATE[]; k_stage TEXT[]; k_kg DOUBLE PRECISION[]; k_n INTEGER[];
+    BEGIN
+        IF TG_OP = 'TRUNCATE' THEN
+            DELETE FROM daily_stage_totals;
+            RETURN NULL;
+        ELSIF TG_OP = 'INSERT' THEN
+            SELECT array_agg(entry_date), array_agg(stage), array_agg(kg), array_agg(n)
+              INTO k_date, k_stage, k_kg, k_n
+              FROM (SELECT p.entry_date, p.stage, SUM(COALESCE(p.weight_kg, 0)) AS kg, COUNT(*)::int AS n
+                    FROM progress p JOIN new_asm a ON a.assembly_mark = p.assembly_mark
+                    GROUP BY 1, 2) d;
+        ELSE
+            SELECT array_agg(entry_date), array_agg(stage), array_agg(kg), array_agg(n)
+              INTO k_date, k_stage, k_kg, k_n
+              FROM (SELECT p.entry_date, p.stage, -SUM(COALESCE(p.weight_kg, 0)) AS kg, -COUNT(*)::int AS n
+                    FROM progress p JOIN old_asm a ON a.assembly_mark = p.assembly_mark
+                    GROUP BY 1, 2) d;
+        END IF;
+        IF k_date IS NOT NULL THEN
+            PERFORM daily_stage_totals_apply(k_date, k_stage, k_kg, k_n);
+        END IF;
+        RETURN NULL;
+    END $$
+    """,
+    "DROP FUNCTION IF EXISTS daily_stage_totals_add(DATE, TEXT, DOUBLE PRECISION, INTEGER)",
+    "DROP TRIGGER IF EXISTS trg_daily_stage_totals_ins ON progress",
+    "DROP TRIGGER IF EXISTS trg_daily_stage_totals_del ON progress",
+    "DROP TRIGGER IF EXISTS trg_daily_stage_totals_upd ON progress",
+    "DROP TRIGGER IF EXISTS trg_daily_stage_totals_asm_guard ON assemblies",
+    "DROP TRIGGER IF EXISTS trg_daily_stage_totals_asm_ins ON assemblies",
+    "DROP TRIGGER IF EXISTS trg_daily_stage_totals_asm_del ON assemblies",
+    "DROP TRIGGER IF EXISTS trg_daily_stage_totals_asm_trunc ON assemblies",
+    """
+    CREATE TRIGGER trg_daily_stage_totals_ins AFTER INSERT ON progress
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION daily_stage_totals_stmt_trg()
+    """,
+    """
+    CREATE TRIGGER trg_daily_stage_totals_del AFTER DELETE ON progress
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION daily_stage_totals_stmt_trg()
+    """,
+    """
+    CREATE TRIGGER trg_daily_stage_totals_upd AFTER UPDATE ON progress
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION daily_stage_totals_stmt_trg()
+    """,
+    """
+    CREATE TRIGGER trg_daily_stage_totals_asm_guard BEFORE INSERT OR DELETE OR TRUNCATE ON assemblies
+    FOR EACH STATEMENT EXECUTE FUNCTION daily_stage_totals_guard()
+    """,
+    """
+    CREATE TRIGGER trg_daily_stage_totals_asm_ins AFTER INSERT ON assemblies
+    REFERENCING NEW TABLE AS new_asm
+    FOR EACH STATEMENT EXECUTE FUNCTION daily_stage_totals_asm_trg()
+    """,
+    """
+    CREATE TRIGGER trg_daily_stage_totals_asm_del AFTER DELETE ON assemblies
+    REFERENCING OLD TABLE AS old_asm
+    FOR EACH STATEMENT EXECUTE FUNCTION daily_stage_totals_asm_trg()
+    """,
+    """
+    CREATE TRIGGER trg_daily_stage_totals_asm_trunc AFTER TRUNCATE ON assemblies
+    FOR EACH STATEMENT EXECUTE FUNCTION daily_stage_totals_asm_trg()
+    """,
+]
 
-    # Data migration: rename old DELIVERY stage
-    db.execute("UPDATE progress SET stage='SEND TO SITE' WHERE stage='DELIVERY'")
-    db.commit()
 
-    # Indexes for frequently filtered columns
-    for idx_sql in [
-        "CREATE INDEX IF NOT EXISTS idx_progress_entry_date    ON progress(entry_date)",
-        "CREATE INDEX IF NOT EXISTS idx_progress_assembly_mark ON progress(assembly_mark)",
-        "CREATE INDEX IF NOT EXISTS idx_progress_stage         ON progress(stage)",
-        "CREATE INDEX IF NOT EXISTS idx_parts_assembly_mark    ON parts(assembly_mark)",
-        "CREATE INDEX IF NOT EXISTS idx_vi_assembly_mark       ON visual_inspection(assembly_mark)",
-        "CREATE INDEX IF NOT EXISTS idx_vi_entry_date          ON visual_inspection(entry_date)",
-    ]:
-        db.execute(idx_sql)
-    db.commit()
+class StagePrefixSums:
+    """Cumulative kg per stage over sorted entry dates.
 
-    # Sync assembly totals from parts (fixes stale values on startup)
-    db.execute("""
-        UPDATE assemblies
-        SET total_weight_kg = (
-            SELECT COALESCE(SUM(total_weight_kg), 0)
-            FROM parts WHERE assembly_mark = assemblies.assembly_mark
-        )
-    """)
-    db.commit()
+    Built from daily_stage_totals rows; as_of(d) and on(d) answer with a
+    binary search per stage instead of a pass over every row.
+    """
 
-    # Users table
-    db.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id            SERIAL PRIMARY KEY,
-            username      TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            role          TEXT DEFAULT 'user',
-            active        INTEGER DEFAULT 1
-        )
+    def __init__(self, rows):
+        self._dates = {}   # stage -> sorted entry dates
+        self._cum   = {}   # stage -> running kg total, aligned with _dates
+        self._daily = {}   # (entry_date, stage) -> kg
+        for r in sorted(rows, key=lambda r: (r['stage'], r['entry_date'])):
+            stage, d, kg = r['stage'], str(r['entry_date']), float(r['kg'] or 0)
+            dates = self._dates.setdefault(stage, [])
+            cum   = self._cum.setdefault(stage, [])
+            dates.append(d)
+            cum.append((cum[-1] if cum else 0.0) + kg)
+            self._daily[(d, stage)] = kg
+
+    def as_of(self, d, stages=STAGES):
+        """Cumulative kg per stage for entry_date <= d."""
+        d = str(d)
+        result = {}
+        for s in stages:
+            i = bisect_right(self._dates.get(s, []), d)
+            result[s] = self._cum[s][i - 1] if i else 0.0
+        return result
+
+    def on(self, d, stages=STAGES):
+        """kg per stage recorded on entry_date == d."""
+        d = str(d)
+        return {s: self._daily.get((d, s), 0.0) for s in stages}
+
+
+def get_stage_prefix_sums():
+    """StagePrefixSums over all of daily_stage_totals (one small scan)."""
+    return StagePrefixSums(get_all_daily_stage_totals())
+
+
+def rebuild_daily_stage_totals():
+    """Recompute daily_stage_totals from progress. Returns the number of rows."""
+    with _conn() as db:
+        db.execute("LOCK TABLE progress IN SHARE MODE")
+        db.execute("DELETE FROM daily_stage_totals")
+        db.execute(f"""
+            INSERT INTO daily_stage_totals (entry_date, stage, kg, entries)
+            {_DAILY_STAGE_TOTALS_SELECT}
+            GROUP BY p.entry_date, p.stage
+        """)
+        n = db.execute("SELECT COUNT(*) AS n FROM daily_stage_totals").fetchone()['n']
+        db.commit()
+    return n
+
+
+# ── Date column migration ──────────────────────────────────────────────────────
+# Older databases store dates as TEXT.  Migration 3 converts the columns below
+# online, table by table, committing as it goes:
+#
+#   1. add {column}_new of the target type, kept current by a BEFORE trigger;
+#   2. backfill existing rows in committed batches of _DATE_BACKFILL_BATCH ids;
+#   3. prove NOT NULL with a NOT VALID check validated afterwards, and build
+#      each index on the column again on the shadow, CONCURRENTLY;
+#   4. swap in one short ACCESS EXCLUSIVE transaction: drop the TEXT column,
+#      rename the shadow over it and move the index names across.
+#
+# Readers and writers carry on through 1-3, and a run that stops part way
+# starts again from 1 on the next init().  Tables without an id column (the
+# derived progress_rollup and daily_stage_totals) are altered in place.
+# Columns already converted (or tables not created yet) are skipped.
+#
+# A value that doesn't read as a date never fails the migration: ISO text and
+# day-first D/M/YYYY (as typed on site) convert, anything else is copied with
+# its whole row into date_migration_rejects and logged.  on_bad then says what
+# happens to the row: 'null' keeps it with a NULL date, 'remove' deletes it
+# (NOT NULL columns; unique lists the columns the date is unique with, so a
+# converted value that collides with an existing one goes too), and 'clear'
+# empties a derived table for a later migration to rebuild.  While the
+# migration runs, the trigger refuses a write that sets a 'remove' column to
+# an unreadable value and records one on a 'null' column.
+
+_DATE_BACKFILL_BATCH = int(os.environ.get('FAB_DATE_BACKFILL_BATCH', '5000'))
+
+# (table, column, target type, on_bad[, unique])
+_DATE_MIGRATIONS = [
+    (   # progress and the tables derived from it
+        [('progress',           'entry_date',    'DATE', 'remove'),
+         ('progress_rollup',    'last_date',     'DATE', 'null'),
+         ('daily_stage_totals', 'entry_date',    'DATE', 'clear')],   # refilled by migration 6
+        ["DROP FUNCTION IF EXISTS daily_stage_totals_add(TEXT, TEXT, DOUBLE PRECISION, INTEGER)"],
+    ),
+    ([('visual_inspection',  'entry_date',    'DATE', 'remove')], []),
+    ([('raw_materials',      'received_date', 'DATE', 'null')], []),
+    ([('manpower_detail',    'entry_date',    'DATE', 'remove', ('worker_type', 'shift'))], []),
+    # stored as GMT+8 wall-clock text by the old _now_gmt8() writes
+    ([('sessions',           'last_seen',     'TIMESTAMPTZ', 'remove')], []),
+]
+
+_DATE_MIGRATION_SETUP = [
+    """
+    CREATE TABLE IF NOT EXISTS date_migration_rejects (
+        id          SERIAL PRIMARY KEY,
+        table_name  TEXT NOT NULL,
+        column_name TEXT NOT NULL,
+        raw_value   TEXT,
+        action      TEXT NOT NULL,
+        row_data    JSONB NOT NULL,
+        rejected_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    )
+    """,
+    r"""
+    CREATE OR REPLACE FUNCTION fab_legacy_date(v TEXT) RETURNS DATE
+    LANGUAGE plpgsql AS $$
+    DECLARE
+        p TEXT[];
+    BEGIN
+        v := btrim(v);
+        IF v IS NULL OR v = '' THEN
+            RETURN NULL;
+        END IF;
+        -- ISO (time ignored) and day-first are read by hand: a failed cast
+        -- costs a subtransaction, and this runs once per row
+        p := regexp_match(v, '^(\d{4})-(\d{1,2})-(\d{1,2})($|[ T])');
+        IF p IS NULL THEN
+            p := regexp_match(v, '^(\d{1,2})[/.-](\d{1,2})[/.-](\d{4})$');
+            p := ARRAY[p[3], p[2], p[1]];
+        END IF;
+        IF p[1] IS NOT NULL THEN
+            IF p[1]::int >= 1 AND p[2]::int BETWEEN 1 AND 12 AND p[3]::int BETWEEN 1 AND
+               extract(day FROM make_date(p[1]::int, p[2]::int, 1) + INTERVAL '1 month - 1 day') THEN
+                RETURN make_date(p[1]::int, p[2]::int, p[3]::int);
+            END IF;
+            RETURN NULL;
+        END IF;
+        BEGIN
+            RETURN v::date;
+        EXCEPTION WHEN others THEN
+            RETURN NULL;
+        END;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION fab_legacy_timestamptz(v TEXT) RETURNS TIMESTAMPTZ
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        RETURN NULLIF(btrim(v), '')::timestamp AT TIME ZONE INTERVAL '+08:00';
+    EXCEPTION WHEN others THEN
+        RETURN NULL;
+    END $$
+    """,
+]
+
+
+def _date_cast(column, target):
+    return f"fab_legacy_{target.lower()}({column})"
+
+
+def _unreadable_date(column, target, on_bad):
+    """SQL condition for a value that has to go to date_migration_rejects."""
+    cast = _date_cast(column, target)
+    if on_bad == 'null':
+        return f"{cast} IS NULL AND NULLIF(btrim({column}), '') IS NOT NULL"
+    return f"{cast} IS NULL"
+
+
+def _convert_date_column(db, table, column, target, on_bad, unique=()):
+    """ALTER one TEXT column to target in place; returns the number of rejected rows."""
+    cast = _date_cast(column, target)
+    if on_bad == 'clear':
+        db.execute(f"DELETE FROM {table}")
+        db.execute(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE {target} USING {cast}")
+        return 0
+    bad = _unreadable_date(column, target, on_bad)
+    if on_bad == 'remove' and unique:
+        keys = ', '.join(unique)
+        bad += (f" OR id NOT IN (SELECT DISTINCT ON ({cast}, {keys}) id FROM {table} "
+                f"ORDER BY {cast}, {keys}, id)")
+    n = db.execute(f"""
+        INSERT INTO date_migration_rejects (table_name, column_name, raw_value, action, row_data)
+        SELECT ?, ?, t.{column}, ?, to_jsonb(t) FROM {table} t WHERE {bad}
+    """, (table, column, on_bad)).rowcount
+    if on_bad == 'remove' and n:
+        db.execute(f"DELETE FROM {table} WHERE {bad}")
+    if on_bad == 'null':
+        db.execute(f"ALTER TABLE {table} ALTER COLUMN {column} DROP NOT NULL")
+    db.execute(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE {target} USING {cast}")
+    return n
+
+
+def _run_concurrently(db, statements):
+    """Run CREATE/DROP INDEX CONCURRENTLY statements, which can't run in a
+    transaction. Commits whatever db has open first."""
+    db.commit()
+    raw = db._conn
+    raw.autocommit = True
+    cur = raw.cursor()
+    try:
+        cur.execute("SET lock_timeout = 0")   # waits for older transactions, however long
+        for sql in statements:
+            cur.execute(sql)
+    finally:
+        cur.execute("SET lock_timeout = '10s'")
+        raw.autocommit = False
+
+
+def _convert_date_column_online(db, table, column, target, on_bad, unique=()):
+    """Convert one TEXT column through a shadow column (steps 1-4 above); commits
+    as it goes.  Returns the number of rejected rows."""
+    new, cast = f'{column}_new', _date_cast(column, target)
+    sync, check = f'fab_sync_{table}_{column}', f'{table}_{column}_new_not_null'
+
+    # 1. shadow column and the trigger that keeps it current
+    db.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {new} {target}")
+    refuse = (f"RAISE EXCEPTION 'unreadable date %% for {table}.{column}', NEW.{column};"
+              if on_bad == 'remove' else
+              "INSERT INTO date_migration_rejects (table_name, column_name, raw_value, action, row_data) "
+              f"VALUES ('{table}', '{column}', NEW.{column}, 'null', to_jsonb(NEW));")
+    db.execute(f"""
+        CREATE OR REPLACE FUNCTION {sync}() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            NEW.{new} := {_date_cast('NEW.' + column, target)};
+            IF {_unreadable_date('NEW.' + column, target, on_bad)} THEN
+                {refuse}
+            END IF;
+            RETURN NEW;
+        END $$
     """)
+    # only writes that set the column; the backfill below fills the shadow itself
+    db.execute(f"DROP TRIGGER IF EXISTS {sync} ON {table}")
+    db.execute(f"CREATE TRIGGER {sync} BEFORE INSERT OR UPDATE OF {column} ON {table} "
+               f"FOR EACH ROW EXECUTE FUNCTION {sync}()")
     db.commit()
 
-    if db.execute("SELECT COUNT(*) AS cnt FROM users").fetchone()['cnt'] == 0:
-        db.execute(
-            "INSERT INTO users (username, password_hash, role) VALUES (?,?,?)",
-            ('admin', _hash('admin123'), 'admin')
-        )
+    # 2. backfill; rows written from here on went through the trigger
+    top = db.execute(f"SELECT COALESCE(MAX(id), 0) AS n FROM {table}").fetchone()['n']
+    missing = f"{new} IS NULL" + (f" AND NULLIF(btrim({column}), '') IS NOT NULL"
+                                  if on_bad == 'null' else '')
+    n = 0
+    for lo in range(0, top, _DATE_BACKFILL_BATCH):
+        span = (lo, lo + _DATE_BACKFILL_BATCH)
+        db.execute(f"UPDATE {table} SET {new} = {cast} "
+                   f"WHERE id > ? AND id <= ? AND {new} IS NULL", span)
+        n += db.execute(f"""
+            INSERT INTO date_migration_rejects (table_name, column_name, raw_value, action, row_data)
+            SELECT ?, ?, t.{column}, ?, to_jsonb(t) - ? FROM {table} t
+            WHERE id > ? AND id <= ? AND {missing}
+              AND NOT EXISTS (SELECT 1 FROM date_migration_rejects r   -- from an earlier run
+                              WHERE r.table_name = ? AND r.column_name = ?
+                                AND r.row_data->>'id' = t.id::text)
+        """, (table, column, on_bad, new) + span + (table, column)).rowcount
+        if on_bad == 'remove':
+            db.execute(f"DELETE FROM {table} WHERE id > ? AND id <= ? AND {new} IS NULL", span)
+        db.commit()
+    if unique:
+        keys = ', '.join(unique)
+        dup = (f"{new} IS NOT NULL AND id NOT IN (SELECT DISTINCT ON ({new}, {keys}) id "
+               f"FROM {table} WHERE {new} IS NOT NULL ORDER BY {new}, {keys}, id)")
+        n += db.execute(f"""
+            INSERT INTO date_migration_rejects (table_name, column_name, raw_value, action, row_data)
+            SELECT ?, ?, t.{column}, ?, to_jsonb(t) - ? FROM {table} t WHERE {dup}
+        """, (table, column, on_bad, new)).rowcount
+        db.execute(f"DELETE FROM {table} WHERE {dup}")
         db.commit()
 
-    # Manpower tables
-    db.execute("""
-        CREATE TABLE IF NOT EXISTS manpower (
-            id          SERIAL PRIMARY KEY,
-            entry_date  TEXT NOT NULL UNIQUE,
-            regular     INTEGER DEFAULT 0,
-            ot1         INTEGER DEFAULT 0,
-            ot2         INTEGER DEFAULT 0,
-            ot3         INTEGER DEFAULT 0,
-            sun_ph      INTEGER DEFAULT 0,
-            created_at  TIMESTAMPTZ DEFAULT NOW()
-        )
-    """)
+    # 3. NOT NULL proven ahead of the swap, indexes rebuilt on the shadow
+    not_null = db.execute(
+        "SELECT attnotnull AS nn FROM pg_attribute WHERE attrelid = ?::regclass AND attname = ?",
+        (table, column)).fetchone()['nn'] and on_bad != 'null'
+    if not_null:
+        db.execute(f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {check}")
+        db.execute(f"ALTER TABLE {table} ADD CONSTRAINT {check} CHECK ({new} IS NOT NULL) NOT VALID")
+        db.commit()
+        db.execute(f"ALTER TABLE {table} VALIDATE CONSTRAINT {check}")
+        db.commit()
+    indexes = db.execute("""
+        SELECT c.relname AS name, pg_get_indexdef(x.indexrelid) AS definition,
+               con.conname, con.contype
+        FROM pg_index x
+        JOIN pg_class c ON c.oid = x.indexrelid
+        LEFT JOIN pg_constraint con ON con.conindid = x.indexrelid AND con.conrelid = x.indrelid
+        JOIN pg_attribute a ON a.attrelid = x.indrelid AND a.attname = ?
+        WHERE x.indrelid = ?::regclass
+          AND (a.attnum = ANY(x.indkey)   -- key column, or used in an expression / predicate
+               OR EXISTS (SELECT 1 FROM pg_depend d
+                          WHERE d.classid = 'pg_class'::regclass AND d.objid = x.indexrelid
+                            AND d.refobjid = x.indrelid AND d.refobjsubid = a.attnum))
+    """, (column, table)).fetchall()
+    statements = []
+    for ix in indexes:
+        head, _, tail = ix['definition'].partition(' ON ')
+        head = re.sub(r' INDEX \S+$', f" INDEX CONCURRENTLY {ix['name']}_new", head)
+        statements.append(f"DROP INDEX CONCURRENTLY IF EXISTS {ix['name']}_new")
+        statements.append(head + ' ON ' + re.sub(rf'\b{column}\b', new, tail))
+    _run_concurrently(db, statements)
+
+    # 4. the swap
+    db.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE")
+    db.execute(f"DROP TRIGGER {sync} ON {table}")
+    db.execute(f"DROP FUNCTION {sync}()")
+    db.execute(f"ALTER TABLE {table} DROP COLUMN {column}")   # takes its indexes with it
+    db.execute(f"ALTER TABLE {table} RENAME COLUMN {new} TO {column}")
+    if not_null:
+        db.execute(f"ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL")   # uses the check
+        db.execute(f"ALTER TABLE {table} DROP CONSTRAINT {check}")
+    for ix in indexes:
+        if ix['contype'] in ('u', 'p'):
+            kind = 'UNIQUE' if ix['contype'] == 'u' else 'PRIMARY KEY'
+            db.execute(f"ALTER TABLE {table} ADD CONSTRAINT {ix['conname']} "
+                       f"{kind} USING INDEX {ix['name']}_new")
+        else:
+            db.execute(f"ALTER INDEX {ix['name']}_new RENAME TO {ix['name']}")
     db.commit()
+    return n
+
+
+def _migrate_date_columns(db, groups):
+    """Convert the TEXT columns listed in groups; returns the names converted.
+    Commits as it goes (see above)."""
+    text_cols = {(r['table_name'], r['column_name']) for r in db.execute(
+        "SELECT table_name, column_name FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND data_type = 'text'"
+    ).fetchall()}
+    with_id = {r['table_name'] for r in db.execute(
+        "SELECT table_name FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND column_name = 'id'"
+    ).fetchall()}
+    done = []
+    for columns, after in groups:
+        todo = [c for c in columns if (c[0], c[1]) in text_cols]
+        if not todo:
+            continue
+        if not done:
+            for sql in _DATE_MIGRATION_SETUP:
+                db.execute(sql)
+            db.commit()
+        for spec in todo:
+            table, column, target, on_bad = spec[:4]
+            convert = _convert_date_column_online if table in with_id else _convert_date_column
+            n = convert(db, *spec)
+            db.commit()
+            if n:
+                _log.warning('%s.%s: %d unreadable value(s) %s; originals kept in date_migration_rejects',
+                             table, column, n,
+                             'set to NULL' if on_bad == 'null' else 'removed with their rows')
+        for sql in after:
+            db.execute(sql)
+        db.commit()
+        done += [f'{spec[0]}.{spec[1]}' for spec in todo]
+    if done:
+        db.execute("DROP FUNCTION fab_legacy_date(TEXT), fab_legacy_timestamptz(TEXT)")
+        db.commit()
+        _log.info('migrated to DATE/TIMESTAMPTZ: %s', ', '.join(done))
+    return done
 
-    db.execute("""
-        CREATE TABLE IF NOT EXISTS manpower_detail (
-            id          SERIAL PRIMARY KEY,
-            entry_date  TEXT NOT NULL,
-            worker_type TEXT NOT NULL,
-            shift       TEXT NOT NULL,
-            count       INTEGER DEFAULT 0,
-            UNIQUE(entry_date, worker_type, shift)
-        )
-    """)
-    db.commit()
 
+# ── Schema initialisation ──────────────────────────────────────────────────────
+# init() applies _MIGRATIONS in version order.  schema_version records every
+# applied version; when the database is current, startup is a single read.
+# Pending migrations run in one transaction under _MIGRATION_LOCK, so
+# processes starting together don't race.  An _Online step commits on its
+# own (batched backfills, CREATE INDEX CONCURRENTLY): the migrations before
+# it are committed first, and the lock is held for the session throughout.
+# Migration 1 is written with IF NOT EXISTS throughout, so databases created
+# before schema_version existed start at version 0 and pass through it
+# unchanged.
+
+_MIGRATION_LOCK = (4242, 2)   # pg_advisory_lock key, held for the session
+
+
+class _Online:
+    """Migration step fn(db) that manages its own transactions."""
+
+    def __init__(self, fn):
+        self.fn = fn
+
+_CORE_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS assemblies (
+        assembly_mark   TEXT PRIMARY KEY,
+        total_weight_kg DOUBLE PRECISION DEFAULT 0,
+        description     TEXT DEFAULT '',
+        work_order      TEXT DEFAULT '001'
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS parts (
+        id                SERIAL PRIMARY KEY,
+        assembly_mark     TEXT NOT NULL,
+        sub_assembly_mark TEXT DEFAULT '',
+        part_mark         TEXT DEFAULT '',
+        no                INTEGER DEFAULT 1,
+        name              TEXT DEFAULT '',
+        profile           TEXT DEFAULT '',
+        kg_per_m          DOUBLE PRECISION DEFAULT 0,
+        length_mm         DOUBLE PRECISION DEFAULT 0,
+        total_weight_kg   DOUBLE PRECISION DEFAULT 0,
+        profile2          TEXT DEFAULT '',
+        grade             TEXT DEFAULT '',
+        remark            TEXT DEFAULT '',
+        FOREIGN KEY (assembly_mark) REFERENCES assemblies(assembly_mark)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS progress (
+        id                SERIAL PRIMARY KEY,
+        entry_date        DATE NOT NULL,
+        assembly_mark     TEXT NOT NULL,
+        stage             TEXT NOT NULL,
+        weight_kg         DOUBLE PRECISION DEFAULT 0,
+        qty               INTEGER DEFAULT 0,
+        inspector         TEXT DEFAULT '',
+        remarks           TEXT DEFAULT '',
+        created_at        TIMESTAMPTZ DEFAULT NOW(),
+        sub_assembly_mark TEXT DEFAULT '',
+        delivery_order_no TEXT DEFAULT ''
+    )
+    """,
+    # columns added after the first release
+    "ALTER TABLE progress   ADD COLUMN IF NOT EXISTS sub_assembly_mark TEXT DEFAULT ''",
+    "ALTER TABLE progress   ADD COLUMN IF NOT EXISTS delivery_order_no TEXT DEFAULT ''",
+    "ALTER TABLE parts      ADD COLUMN IF NOT EXISTS remark TEXT DEFAULT ''",
+    "ALTER TABLE assemblies ADD COLUMN IF NOT EXISTS work_order TEXT DEFAULT '001'",
+    "ALTER TABLE assemblies ADD COLUMN IF NOT EXISTS priority INTEGER DEFAULT 0",
+    "ALTER TABLE parts      ADD COLUMN IF NOT EXISTS priority INTEGER",
+    "ALTER TABLE progress   ADD COLUMN IF NOT EXISTS painting_done BOOLEAN DEFAULT FALSE",
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id            SERIAL PRIMARY KEY,
+        username      TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        role          TEXT DEFAULT 'user',
+        active        INTEGER DEFAULT 1
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS manpower (
+        id          SERIAL PRIMARY KEY,
+        entry_date  TEXT NOT NULL UNIQUE,
+        regular     INTEGER DEFAULT 0,
+        ot1         INTEGER DEFAULT 0,
+        ot2         INTEGER DEFAULT 0,
+        ot3         INTEGER DEFAULT 0,
+        sun_ph      INTEGER DEFAULT 0,
+        created_at  TIMESTAMPTZ DEFAULT NOW()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS manpower_detail (
+        id          SERIAL PRIMARY KEY,
+        entry_date  DATE NOT NULL,
+        worker_type TEXT NOT NULL,
+        shift       TEXT NOT NULL,
+        count       INTEGER DEFAULT 0,
+        UNIQUE(entry_date, worker_type, shift)
+    )
+    """,
     # Drawings table — files stored as BYTEA in the database
-    db.execute("""
-        CREATE TABLE IF NOT EXISTS drawings (
-            id            SERIAL PRIMARY KEY,
-            title         TEXT NOT NULL,
-            original_name TEXT NOT NULL,
-            filename      TEXT NOT NULL UNIQUE,
-            assembly_mark TEXT DEFAULT '',
-            uploaded_by   TEXT DEFAULT '',
-            created_at    TIMESTAMPTZ DEFAULT NOW(),
-            file_data     BYTEA
-        )
-    """)
-    db.execute("ALTER TABLE drawings ADD COLUMN IF NOT EXISTS file_data BYTEA")
-    db.execute("ALTER TABLE drawings ADD COLUMN IF NOT EXISTS rev_no TEXT DEFAULT ''")
-    db.execute("ALTER TABLE drawings ADD COLUMN IF NOT EXISTS date_received TEXT DEFAULT ''")
-    db.commit()
+    """
+    CREATE TABLE IF NOT EXISTS drawings (
+        id            SERIAL PRIMARY KEY,
+        title         TEXT NOT NULL,
+        original_name TEXT NOT NULL,
+        filename      TEXT NOT NULL UNIQUE,
+        assembly_mark TEXT DEFAULT '',
+        uploaded_by   TEXT DEFAULT '',
+        created_at    TIMESTAMPTZ DEFAULT NOW(),
+        file_data     BYTEA
+    )
+    """,
+    "ALTER TABLE drawings ADD COLUMN IF NOT EXISTS file_data BYTEA",
+    "ALTER TABLE drawings ADD COLUMN IF NOT EXISTS rev_no TEXT DEFAULT ''",
+    "ALTER TABLE drawings ADD COLUMN IF NOT EXISTS date_received TEXT DEFAULT ''",
+    """
+    CREATE TABLE IF NOT EXISTS settings (
+        key   TEXT PRIMARY KEY,
+        value TEXT DEFAULT ''
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS raw_materials (
+        id            SERIAL PRIMARY KEY,
+        received_date DATE,
+        do_no         TEXT DEFAULT '',
+        description   TEXT DEFAULT '',
+        grade         TEXT DEFAULT '',
+        qty           DOUBLE PRECISION DEFAULT 0,
+        total_kg      DOUBLE PRECISION DEFAULT 0,
+        remark        TEXT DEFAULT '',
+        created_at    TIMESTAMPTZ DEFAULT NOW()
+    )
+    """,
+    "ALTER TABLE raw_materials ADD COLUMN IF NOT EXISTS do_no TEXT DEFAULT ''",
+    "ALTER TABLE raw_materials ADD COLUMN IF NOT EXISTS total_kg DOUBLE PRECISION DEFAULT 0",
+    """
+    CREATE TABLE IF NOT EXISTS visual_inspection (
+        id                SERIAL PRIMARY KEY,
+        entry_date        DATE NOT NULL,
+        assembly_mark     TEXT DEFAULT '',
+        sub_assembly_mark TEXT DEFAULT '',
+        weight_kg         DOUBLE PRECISION DEFAULT 0,
+        qty               INTEGER DEFAULT 1,
+        remarks           TEXT DEFAULT '',
+        created_at        TIMESTAMPTZ DEFAULT NOW()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sessions (
+        id         SERIAL PRIMARY KEY,
+        username   TEXT NOT NULL,
+        role       TEXT DEFAULT '',
+        login_time TEXT NOT NULL,
+        last_seen  TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        active     INTEGER DEFAULT 1
+    )
+    """,
+]
+
+_INDEXES = [
+    "DROP INDEX IF EXISTS idx_progress_entry_date",
+    "CREATE INDEX IF NOT EXISTS idx_progress_date_stage    ON progress(entry_date, stage)",
+    "CREATE INDEX IF NOT EXISTS idx_progress_date_brin     ON progress USING brin (entry_date)",
+    "CREATE INDEX IF NOT EXISTS idx_progress_assembly_mark ON progress(assembly_mark)",
+    "CREATE INDEX IF NOT EXISTS idx_progress_stage         ON progress(stage)",
+    "CREATE INDEX IF NOT EXISTS idx_parts_assembly_mark    ON parts(assembly_mark)",
+    "CREATE INDEX IF NOT EXISTS idx_vi_assembly_mark       ON visual_inspection(assembly_mark)",
+    "CREATE INDEX IF NOT EXISTS idx_vi_entry_date          ON visual_inspection(entry_date)",
+    # One visual inspection per (date, assembly, sub-assembly); drop older duplicates first
+    """
+    DELETE FROM visual_inspection v
+    USING visual_inspection keep
+    WHERE v.entry_date = keep.entry_date
+      AND v.assembly_mark = keep.assembly_mark
+      AND v.sub_assembly_mark = keep.sub_assembly_mark
+      AND v.id > keep.id
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_vi_date_mark_sub "
+    "ON visual_inspection(entry_date, assembly_mark, sub_assembly_mark)",
+]
+
+# Text search_parts() matches; the trigram index below is built on this exact expression
+_PARTS_SEARCH_COLUMNS = ('assembly_mark', 'sub_assembly_mark', 'part_mark', 'name',
+                         'profile', 'profile2', 'grade')
+_PARTS_SEARCH_EXPR = "(" + " || ' ' || ".join(
+    f"COALESCE({c}, '')" for c in _PARTS_SEARCH_COLUMNS) + ")"
+
+# Keyset sort key for raw materials; idx_rm_received_id is built on it (undated rows last)
+_RAW_MATERIALS_SORT = "COALESCE(received_date, '-infinity'::date)"
+
+_TRIGRAM_INDEXES = [
+    f"CREATE INDEX IF NOT EXISTS idx_parts_search_trgm "
+    f"ON parts USING gin ({_PARTS_SEARCH_EXPR} gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS idx_progress_mark_trgm    ON progress USING gin (assembly_mark gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS idx_progress_remarks_trgm ON progress USING gin (remarks gin_trgm_ops)",
+]
+
+
+def _create_trigram_indexes(db):
+    """Install pg_trgm and the search indexes. Without the extension (no contrib
+    package, or no CREATE privilege) searches still work, just unindexed."""
+    cur = db._conn.cursor()
+    cur.execute("SAVEPOINT fab_trgm")
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except psycopg2.Error as e:
+        cur.execute("ROLLBACK TO SAVEPOINT fab_trgm")
+        _log.warning('pg_trgm unavailable (%s); keyword searches will not be indexed',
+                     str(e).strip().splitlines()[0])
+        return
+    cur.execute("RELEASE SAVEPOINT fab_trgm")
+    for sql in _TRIGRAM_INDEXES:
+        db.execute(sql)
+
+
+# (version, description, steps); a step is SQL or a callable taking the _DBConn.
+# Append new migrations at the end — never edit or renumber applied ones.
+_MIGRATIONS = [
+    (1, 'core tables and columns', _CORE_TABLES),
+    (2, 'rename DELIVERY stage to SEND TO SITE',
+     ["UPDATE progress SET stage = 'SEND TO SITE' WHERE stage = 'DELIVERY'"]),
+    # before the derived tables below, which copy progress.entry_date's type
+    (3, 'TEXT dates to DATE / TIMESTAMPTZ', [_Online(lambda db: _migrate_date_columns(db, _DATE_MIGRATIONS))]),
+    (4, 'indexes', _INDEXES),
+    (5, 'progress rollup', [_PROGRESS_ROLLUP_TABLE] + _PROGRESS_ROLLUP_TRIGGERS + [f"""
+        INSERT INTO progress_rollup (assembly_mark, sub_assembly_mark, stage, kg, last_do, last_date)
+        {_PROGRESS_ROLLUP_SELECT}
+        WHERE NOT EXISTS (SELECT 1 FROM progress_rollup)
+        GROUP BY 1, 2, 3
+    """]),
+    (6, 'daily stage totals', [_DAILY_STAGE_TOTALS_TABLE] + _DAILY_STAGE_TOTALS_TRIGGERS + [f"""
+        INSERT INTO daily_stage_totals (entry_date, stage, kg, entries)
+        {_DAILY_STAGE_TOTALS_SELECT}
+        AND NOT EXISTS (SELECT 1 FROM daily_stage_totals)
+        GROUP BY p.entry_date, p.stage
+    """]),
+    (7, 'default admin user', [lambda db: db.execute(
+        "INSERT INTO users (username, password_hash, role) SELECT ?, ?, ? "
+        "WHERE NOT EXISTS (SELECT 1 FROM users)", ('admin', _hash('admin123'), 'admin'))]),
+    (8, 'keyset pagination indexes', [
+        "CREATE INDEX IF NOT EXISTS idx_progress_date_id ON progress(entry_date, id)",
+        "CREATE INDEX IF NOT EXISTS idx_vi_date_id       ON visual_inspection(entry_date, id)",
+    ]),
+    (9, 'trigram search indexes', [lambda db: _create_trigram_indexes(db)]),
+    (10, 'statement-level progress rollup triggers', _PROGRESS_ROLLUP_TRIGGERS),
+    # (entry_date, id) serves date ranges as well; daily totals come from daily_stage_totals
+    (11, 'drop redundant date indexes, raw materials keyset index', [
+        "DROP INDEX IF EXISTS idx_progress_date_stage",
+        "DROP INDEX IF EXISTS idx_progress_date_brin",
+        "DROP INDEX IF EXISTS idx_vi_entry_date",
+        f"CREATE INDEX IF NOT EXISTS idx_rm_received_id ON raw_materials (({_RAW_MATERIALS_SORT}), id)",
+    ]),
+    (12, 'raw materials natural key index', [
+        "CREATE INDEX IF NOT EXISTS idx_rm_natural_key "
+        "ON raw_materials (do_no, description, grade, received_date)",
+    ]),
+    (13, 'statement-level daily stage totals triggers', _DAILY_STAGE_TOTALS_TRIGGERS),
+    # 11 dropped these unmeasured: (entry_date, id) can't answer stage-filtered
+    # date ranges from the index, and VI lookups by date alone lost their index
+    (14, 'restore date range indexes', [_Online(lambda db: _run_concurrently(db, [
+        "DROP INDEX CONCURRENTLY IF EXISTS idx_progress_date_stage",
+        "CREATE INDEX CONCURRENTLY idx_progress_date_stage ON progress(entry_date, stage)",
+        "DROP INDEX CONCURRENTLY IF EXISTS idx_progress_date_brin",
+        "CREATE INDEX CONCURRENTLY idx_progress_date_brin ON progress USING brin (entry_date)",
+        "DROP INDEX CONCURRENTLY IF EXISTS idx_vi_entry_date",
+        "CREATE INDEX CONCURRENTLY idx_vi_entry_date ON visual_inspection(entry_date)",
+    ]))]),
+]
+
+
+def get_schema_version():
+    """Highest applied migration version (0 before the first init())."""
+    with _conn() as db:
+        return _schema_version(db)
+
+
+def _schema_version(db):
+    if db.execute("SELECT to_regclass('schema_version') AS t").fetchone()['t'] is None:
+        return 0
+    return db.execute("SELECT COALESCE(MAX(version), 0) AS v FROM schema_version").fetchone()['v']
+
 
-    # Project settings table
+def init():
+    """Apply pending schema migrations. Returns the versions applied (empty when current)."""
+    latest = _MIGRATIONS[-1][0]
+    with _conn() as db:
+        if _schema_version(db) >= latest:
+            db.commit()
+            return []
+        # poll between transactions: a process waiting here holds no snapshot
+        # that the running migration's CREATE INDEX CONCURRENTLY would wait for
+        while not db.execute("SELECT pg_try_advisory_lock(?, ?) AS ok", _MIGRATION_LOCK).fetchone()['ok']:
+            db.commit()
+            time.sleep(0.5)
+        try:
+            applied = _apply_migrations(db)
+        finally:
+            db._conn.rollback()   # no-op unless a migration failed
+            db.execute("SELECT pg_advisory_unlock(?, ?)", _MIGRATION_LOCK)
+            db.execute("RESET lock_timeout")
+            db.commit()
+        if applied:
+            _log.info('schema migrated to version %d (%s)', latest, ', '.join(map(str, applied)))
+            cache = getattr(db._conn, 'stmt_cache', None)
+            if cache is not None:
+                cache.clear()
+    return applied
+
+
+def _apply_migrations(db):
     db.execute("""
-        CREATE TABLE IF NOT EXISTS settings (
-            key   TEXT PRIMARY KEY,
-            value TEXT DEFAULT ''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version     INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at  TIMESTAMPTZ NOT NULL DEFAULT NOW()
         )
     """)
+    db.execute("SET lock_timeout = '10s'")
+    current = _schema_version(db)   # another process may have finished first
+    applied = []
+    for version, description, steps in _MIGRATIONS:
+        if version <= current:
+            continue
+        for step in steps:
+            if isinstance(step, _Online):
+                db.commit()
+                step.fn(db)
+            elif callable(step):
+                step(db)
+            else:
+                db.execute(step)
+        db.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                   (version, description))
+        applied.append(version)
     db.commit()
-
-    db.close()
-    init_raw_materials()
-    init_visual_inspection()
-    init_sessions()
+    return applied
 
 
 def get_project_name():
-    c = _conn()
-    row = c.execute("SELECT value FROM settings WHERE key='project_name'").fetchone()
-    c.close()
+    with _conn() as c:
+        row = c.execute("SELECT value FROM settings WHERE key='project_name'").fetchone()
     return row['value'] if row else 'Fabrication Tracker'
 
 
 def set_project_name(name):
-    c = _conn()
-    c.execute("""
-        INSERT INTO settings (key, value) VALUES ('project_name', ?)
-        ON CONFLICT(key) DO UPDATE SET value=EXCLUDED.value
-    """, (name.strip(),))
-    c.commit()
-    c.close()
+    with _conn() as c:
+        c.execute("""
+            INSERT INTO settings (key, value) VALUES ('project_name', ?)
+            ON CONFLICT(key) DO UPDATE SET value=EXCLUDED.value
+        """, (name.strip(),))
+        c.commit()
 
 
 def _hash(password):
@@ -317,580 +1723,1155 @@ def _hash(password):
     return hashlib.sha256(password.encode('utf-8')).hexdigest()
 
 
+# ── Keyset pagination ──────────────────────────────────────────────────────────
+# "Show All" lists are read a page at a time, newest first, ordered on
+# (date, id).  A page is the `limit` rows just past a cursor taken from the
+# previous page's edge, so page 500 costs the same index range scan as
+# page 1.  The total is the planner's row estimate (EXPLAIN), not COUNT(*).
+
+_PAGE_SIZE = int(os.environ.get('FAB_PAGE_SIZE', '100'))
+_ESTIMATE_TTL = float(os.environ.get('FAB_ESTIMATE_TTL', '30'))   # seconds an estimate is reused
+_ESTIMATE_CACHE_SIZE = 256
+
+_estimates      = {}   # (source, where, params) -> (expires, rows)
+_estimates_lock = threading.Lock()
+
+
+def _estimate_rows(db, source, where, params):
+    """Planner estimate of the rows matching where (no scan).  Cached per filter
+    for _ESTIMATE_TTL seconds, so paging through one result plans it once."""
+    key = (source, where, tuple(params))
+    now = time.monotonic()
+    with _estimates_lock:
+        hit = _estimates.get(key)
+    if hit is not None and hit[0] > now:
+        return hit[1]
+    plan = db.execute(f"EXPLAIN (FORMAT JSON) SELECT 1 FROM {source} WHERE {where}", params).fetchone()
+    rows = int(plan['QUERY PLAN'][0]['Plan']['Plan Rows'])
+    with _estimates_lock:
+        if len(_estimates) >= _ESTIMATE_CACHE_SIZE:
+            expired = [k for k, (expires, _) in _estimates.items() if expires <= now]
+            for k in expired or [next(iter(_estimates))]:
+                del _estimates[k]
+        _estimates[key] = (now + _ESTIMATE_TTL, rows)
+    return rows
+
+
+def _keyset_page(db, columns, source, conditions, params, sort_expr, id_expr,
+                 after=None, before=None, limit=None):
+    """One page of SELECT columns FROM source WHERE conditions, newest first.
+    Returns {'rows', 'next', 'prev', 'estimate'}.  next / prev are cursors
+    (None at either end): pass next as after= for the following page and prev
+    as before= for the preceding one.
+    """
+    limit = limit or _PAGE_SIZE
+    where = ' AND '.join(conditions) or 'TRUE'
+    order = 'ASC' if before is not None else 'DESC'
+    page_conditions, page_params = list(conditions), list(params)
+    if after is not None:
+        page_conditions.append(f"({sort_expr}, {id_expr}) < (?, ?)")
+        page_params += list(after)
+    elif before is not None:
+        page_conditions.append(f"({sort_expr}, {id_expr}) > (?, ?)")
+        page_params += list(before)
+    rows = db.execute(f"""
+        SELECT {columns}, {sort_expr} AS page_key_date, {id_expr} AS page_key_id
+        FROM {source}
+        WHERE {' AND '.join(page_conditions) or 'TRUE'}
+        ORDER BY {sort_expr} {order}, {id_expr} {order}
+        LIMIT ?
+    """, page_params + [limit + 1]).fetchall()
+    more = len(rows) > limit
+    rows = [dict(r) for r in rows[:limit]]
+    if after is not None and not rows:   # nothing left past the cursor (rows deleted): start over
+        return _keyset_page(db, columns, source, conditions, params, sort_expr, id_expr, limit=limit)
+    if before is not None:
+        if not more:   # ran into the start: show a full first page instead
+            return _keyset_page(db, columns, source, conditions, params, sort_expr, id_expr, limit=limit)
+        rows.reverse()
+    keys = [(r.pop('page_key_date'), r.pop('page_key_id')) for r in rows]
+    has_next = more if before is None else True
+    has_prev = after is not None or before is not None
+    return {
+        'rows':     rows,
+        'next':     keys[-1] if rows and has_next else None,
+        'prev':     keys[0] if rows and has_prev else None,
+        'estimate': _estimate_rows(db, source, where, params),
+    }
+
+
 # ── Users ──────────────────────────────────────────────────────────────────────
 
 def authenticate(username, password):
-    c = _conn()
-    row = c.execute(
-        "SELECT id, username, role FROM users "
-        "WHERE LOWER(username)=LOWER(?) AND password_hash=? AND active=1",
-        (username.strip(), _hash(password))
-    ).fetchone()
-    c.close()
+    with _conn() as c:
+        row = c.execute(
+            "SELECT id, username, role FROM users "
+            "WHERE LOWER(username)=LOWER(?) AND password_hash=? AND active=1",
+            (username.strip(), _hash(password))
+        ).fetchone()
     return dict(row) if row else None
 
 
 def get_users():
-    c = _conn()
-    rows = c.execute(
-        "SELECT id, username, role, active FROM users ORDER BY username"
-    ).fetchall()
-    c.close()
+    with _conn() as c:
+        rows = c.execute(
+            "SELECT id, username, role, active FROM users ORDER BY username"
+        ).fetchall()
     return [dict(r) for r in rows]
 
 
 def add_user(username, password, role='user'):
-    c = _conn()
-    try:
-        c.execute("INSERT INTO users (username, password_hash, role) VALUES (?,?,?)",
-                  (username.strip(), _hash(password), role))
-        c.commit()
-        return True
-    except Exception:
-        return False
-    finally:
-        c.close()
+    with _conn() as c:
+        try:
+            c.execute("INSERT INTO users (username, password_hash, role) VALUES (?,?,?)",
+                      (username.strip(), _hash(password), role))
+            c.commit()
+            return True
+        except Exception:
+            return False
 
 
 def update_user_password(uid, new_password):
-    c = _conn()
-    c.execute("UPDATE users SET password_hash=? WHERE id=?", (_hash(new_password), uid))
-    c.commit()
-    c.close()
+    with _conn() as c:
+        c.execute("UPDATE users SET password_hash=? WHERE id=?", (_hash(new_password), uid))
+        c.commit()
 
 
 def update_user_role(uid, role):
-    c = _conn()
-    c.execute("UPDATE users SET role=? WHERE id=?", (role, uid))
-    c.commit()
-    c.close()
+    with _conn() as c:
+        c.execute("UPDATE users SET role=? WHERE id=?", (role, uid))
+        c.commit()
 
 
 def toggle_user_active(uid):
-    c = _conn()
-    c.execute("UPDATE users SET active = 1 - active WHERE id=?", (uid,))
-    c.commit()
-    c.close()
+    with _conn() as c:
+        c.execute("UPDATE users SET active = 1 - active WHERE id=?", (uid,))
+        c.commit()
 
 
 def delete_user_entry(uid):
-    c = _conn()
-    c.execute("DELETE FROM users WHERE id=?", (uid,))
-    c.commit()
-    c.close()
+    with _conn() as c:
+        c.execute("DELETE FROM users WHERE id=?", (uid,))
+        c.commit()
 
 
-# ── Raw Material Delivery ──────────────────────────────────────────────────────
+# ── Excel reading ──────────────────────────────────────────────────────────────
+# Importers stream the active sheet with openpyxl's read-only mode instead of
+# loading the whole workbook and materialising every row up front.  The header
+# must appear within the first FAB_EXCEL_HEADER_ROWS rows.
+
+_HEADER_SCAN_ROWS = int(os.environ.get('FAB_EXCEL_HEADER_ROWS', '50'))
+
+
+def _excel_rows(file_source, is_header, scan_rows=None, numbered=False):
+    """Open file_source (path, bytes or file object) read-only.
+    Returns (headers, rows): headers is the first row within scan_rows that
+    is_header(row) accepts, or None; rows is a generator over the rows after it
+    (numbered=True: over (sheet row number, row) pairs, for error reports).
+    The workbook is closed when rows is exhausted or garbage-collected.
+    """
+    import openpyxl
+    from io import BytesIO as _BytesIO
+    if isinstance(file_source, (bytes, bytearray)):
+        file_source = _BytesIO(file_source)
+    wb = openpyxl.load_workbook(file_source, read_only=True, data_only=True)
+    ws = wb.active
+    ws.reset_dimensions()   # some writers store a bogus sheet size; read every row
+    it = ws.iter_rows(values_only=True)
+    headers = None
+    for i, row in enumerate(it):
+        if i >= (scan_rows or _HEADER_SCAN_ROWS):
+            break
+        if row and is_header(row):
+            headers = row
+            break
+    if headers is None:
+        wb.close()
+        return None, iter(())
+
+    def rows():
+        try:
+            yield from (enumerate(it, start=i + 2) if numbered else it)
+        finally:
+            wb.close()
+    return headers, rows()
 
-def init_raw_materials():
-    c = _conn()
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS raw_materials (
-            id            SERIAL PRIMARY KEY,
-            received_date TEXT NOT NULL,
-            do_no         TEXT DEFAULT '',
-            description   TEXT DEFAULT '',
-            grade         TEXT DEFAULT '',
-            qty           DOUBLE PRECISION DEFAULT 0,
-            total_kg      DOUBLE PRECISION DEFAULT 0,
-            remark        TEXT DEFAULT '',
-            created_at    TIMESTAMPTZ DEFAULT NOW()
-        )
-    """)
-    c.execute("ALTER TABLE raw_materials ADD COLUMN IF NOT EXISTS do_no TEXT DEFAULT ''")
-    c.execute("ALTER TABLE raw_materials ADD COLUMN IF NOT EXISTS total_kg DOUBLE PRECISION DEFAULT 0")
-    c.commit()
-    c.close()
 
+# Cell converters shared by the importers' column specs
+def _cell_text(v):
+    return '' if v is None else str(v).strip()
+
+
+def _cell_float(v):
+    try: return float(v or 0)
+    except (TypeError, ValueError): return 0.0
+
+
+def _cell_int(v):
+    try: return int(float(v or 1))
+    except (TypeError, ValueError): return 1
+
+
+def _cell_opt_int(v):
+    """Integer, or None for a blank cell."""
+    return int(float(v)) if v is not None and str(v).strip() != '' else None
+
+
+_DAY_FIRST_DATE = re.compile(r'(\d{1,2})[/.-](\d{1,2})[/.-](\d{4})$')
+
+
+def _cell_date(v):
+    """'YYYY-MM-DD' for a date cell or date text (ISO, or day-first D/M/YYYY as
+    typed on site), None when blank.  Raises ValueError for anything else, so
+    importers can report the row instead of failing the whole file."""
+    if not v:
+        return None
+    if hasattr(v, 'strftime'):
+        return v.strftime('%Y-%m-%d')
+    text = str(v).strip()
+    if not text:
+        return None
+    m = _DAY_FIRST_DATE.match(text)
+    try:
+        d = date(int(m[3]), int(m[2]), int(m[1])) if m else date.fromisoformat(text[:10])
+    except ValueError:
+        raise ValueError(f'unreadable date {text!r}') from None
+    return d.isoformat()
+
+
+def _constant(value):
+    """Converter for a field none of whose aliases is in the header."""
+    return lambda v: value
+
+
+def _compile_extractor(header, fields, normalize=str.strip):
+    """Resolve column aliases against header once and return a row reader.
+    fields: sequence of (aliases, convert, default); aliases are matched after
+    normalize() is applied to both sides.  Returns extract(row) -> tuple with
+    one value per field, in order: default for a blank or missing cell,
+    convert(cell) otherwise.
+
+    One itemgetter pulls every field's first column out of the row, and the
+    cells are zipped with the converters and defaults.  A field missing from
+    the header reads column 0 through _constant(default); a field with more
+    than one alias present falls back to the later columns only when the
+    first is blank.
+    """
+    col = {}
+    for i, h in enumerate(header):
+        col[normalize(str(h)) if h else ''] = i
+    width = len(header)              # short rows are padded with None up to this
+    pad   = (None,) * width
+    firsts, converts, defaults, fallbacks = [], [], [], []
+    for k, (aliases, convert, default) in enumerate(fields):
+        idxs = [col[a] for a in map(normalize, aliases) if a in col]
+        if not idxs:
+            idxs, convert = [0], _constant(default)
+        firsts.append(idxs[0])
+        converts.append(convert)
+        defaults.append(default)
+        if len(idxs) > 1:
+            fallbacks.append((k, idxs[1:]))
+    get = itemgetter(*firsts)
+    if len(firsts) == 1:
+        get = lambda row, one=get: (one(row),)
+    converts, defaults, fallbacks = tuple(converts), tuple(defaults), tuple(fallbacks)
+
+    def extract(row):
+        if len(row) < width:
+            row = row + pad[:width - len(row)]
+        cells = get(row)
+        if fallbacks:
+            cells = list(cells)
+            for k, idxs in fallbacks:
+                if cells[k] is None:
+                    cells[k] = next((row[i] for i in idxs if row[i] is not None), None)
+        return tuple([d if v is None else c(v) for v, c, d in zip(cells, converts, defaults)])
+    return extract
+
+
+# ── Raw Material Delivery ──────────────────────────────────────────────────────
 
 def add_raw_material(received_date, do_no, description, grade, qty, total_kg=0, remark=''):
-    c = _conn()
-    cur = c.execute(
-        "INSERT INTO raw_materials (received_date, do_no, description, grade, qty, total_kg, remark) "
-        "VALUES (?,?,?,?,?,?,?) RETURNING id",
-        (str(received_date), do_no.strip(), description.strip(), grade.strip(), qty, float(total_kg), remark.strip())
-    )
-    rid = cur.lastrowid
-    c.commit()
-    c.close()
+    with _conn() as c:
+        cur = c.execute(
+            "INSERT INTO raw_materials (received_date, do_no, description, grade, qty, total_kg, remark) "
+            "VALUES (?,?,?,?,?,?,?) RETURNING id",
+            (str(received_date), do_no.strip(), description.strip(), grade.strip(), qty, float(total_kg), remark.strip())
+        )
+        rid = cur.lastrowid
+        c.commit()
     return rid
 
 
 def get_raw_material_summary():
     """Return overall totals: total entries, total qty, total kg received."""
-    c = _conn()
-    row = c.execute(
-        "SELECT COUNT(*) as entries, "
-        "COALESCE(SUM(qty),0) as total_qty, "
-        "COALESCE(SUM(total_kg),0) as total_kg "
-        "FROM raw_materials"
-    ).fetchone()
-    c.close()
+    with _conn() as c:
+        row = c.execute(
+            "SELECT COUNT(*) as entries, "
+            "COALESCE(SUM(qty),0) as total_qty, "
+            "COALESCE(SUM(total_kg),0) as total_kg "
+            "FROM raw_materials"
+        ).fetchone()
     return dict(row) if row else {'entries': 0, 'total_qty': 0, 'total_kg': 0}
 
 
+# display_no numbers entries 1..N in id order over the whole table, so it stays
+# gap-free after deletes while id remains the stable key
+_RAW_MATERIALS_NUMBERED = (
+    "SELECT * FROM (SELECT r.*, ROW_NUMBER() OVER (ORDER BY id) AS display_no "
+    "FROM raw_materials r) n"
+)
+
+
 def get_raw_materials(start=None, end=None):
-    c = _conn()
-    if start and end:
-        rows = c.execute(
-            "SELECT * FROM raw_materials WHERE received_date BETWEEN ? AND ? "
-            "ORDER BY received_date DESC", (str(start), str(end))
-        ).fetchall()
-    else:
-        rows = c.execute(
-            "SELECT * FROM raw_materials ORDER BY received_date DESC"
-        ).fetchall()
-    c.close()
+    with _conn() as c:
+        if start and end:
+            rows = c.execute(
+                f"{_RAW_MATERIALS_NUMBERED} WHERE received_date BETWEEN ? AND ? "
+                "ORDER BY received_date DESC NULLS LAST", (str(start), str(end))
+            ).fetchall()
+        else:
+            rows = c.execute(
+                f"{_RAW_MATERIALS_NUMBERED} ORDER BY received_date DESC NULLS LAST"
+            ).fetchall()
     return [dict(r) for r in rows]
 
 
+def get_raw_materials_page(start=None, end=None, after=None, before=None, limit=None):
+    """Keyset-paginated get_raw_materials(); see _keyset_page.  Rows carry no
+    display_no: numbering them would read the whole table for every page."""
+    conditions, params = [], []
+    if start and end:
+        conditions.append("received_date BETWEEN ? AND ?")
+        params += [str(start), str(end)]
+    with _conn() as c:
+        return _keyset_page(c, '*', 'raw_materials', conditions, params, _RAW_MATERIALS_SORT, 'id',
+                            after=after, before=before, limit=limit)
+
+
 def delete_raw_material(rid):
-    c = _conn()
-    c.execute("DELETE FROM raw_materials WHERE id=?", (rid,))
-    c.commit()
-    c.close()
-    _reorder_raw_materials()
-
-
-def _reorder_raw_materials():
-    """Renumber raw_materials IDs sequentially after a deletion."""
-    c = _conn()
-    rows = c.execute(
-        "SELECT received_date, do_no, description, grade, qty, total_kg, remark, created_at "
-        "FROM raw_materials ORDER BY id"
-    ).fetchall()
-    c.execute("DELETE FROM raw_materials")
-    c.execute("ALTER SEQUENCE raw_materials_id_seq RESTART WITH 1")
-    for r in rows:
-        c.execute(
-            "INSERT INTO raw_materials "
-            "(received_date, do_no, description, grade, qty, total_kg, remark, created_at) "
-            "VALUES (?,?,?,?,?,?,?,?)",
-            (r['received_date'], r['do_no'], r['description'], r['grade'],
-             r['qty'], r['total_kg'], r['remark'], r['created_at'])
-        )
-    c.commit()
-    c.close()
+    delete_raw_materials([rid])
 
 
-def import_raw_materials_excel(file_source):
+def delete_raw_materials(ids):
+    """Delete raw_materials rows by id in one statement. Returns the number deleted."""
+    ids = [int(i) for i in ids]
+    if not ids:
+        return 0
+    with _conn() as c:
+        n = c.execute("DELETE FROM raw_materials WHERE id = ANY(?)", (ids,)).rowcount
+        c.commit()
+    return n
+
+
+# one statement per chunk: rows whose natural key matches one existing row get
+# its qty / total kg / remark refreshed if they differ, the rest are inserted.
+# The key is not a unique constraint because older data may already hold
+# repeated rows; a key matching several of them is left alone and reported
+# back (row n, matches) instead.  idx_rm_natural_key serves both lookups.
+_RAW_MATERIAL_UPSERT = """
+    WITH v (n, received_date, do_no, description, grade, qty, total_kg, remark) AS (VALUES %s),
+    m AS (   -- OFFSET 0 keeps the LATERAL a per-row probe of idx_rm_natural_key
+        SELECT v.n, r.id, r.qty, r.total_kg, r.remark, COUNT(*) OVER (PARTITION BY v.n) AS hits
+        FROM v CROSS JOIN LATERAL (
+            SELECT id, qty, total_kg, remark FROM raw_materials r
+            WHERE r.received_date IS NOT DISTINCT FROM v.received_date AND r.do_no = v.do_no
+              AND r.description = v.description AND r.grade = v.grade
+            OFFSET 0) r
+    ),
+    changed AS (
+        SELECT m.id, v.n, v.qty, v.total_kg, v.remark
+        FROM m JOIN v ON v.n = m.n
+        WHERE m.hits = 1 AND (m.qty, m.total_kg, m.remark) IS DISTINCT FROM (v.qty, v.total_kg, v.remark)
+    ),
+    upd AS (
+        UPDATE raw_materials r SET qty = c.qty, total_kg = c.total_kg, remark = c.remark
+        FROM changed c WHERE r.id = c.id
+        RETURNING c.n
+    ),
+    ins AS (
+        INSERT INTO raw_materials (received_date, do_no, description, grade, qty, total_kg, remark)
+        SELECT received_date, do_no, description, grade, qty, total_kg, remark FROM v
+        WHERE NOT EXISTS (SELECT 1 FROM m WHERE m.n = v.n)
+        RETURNING 1
+    )
+    SELECT (SELECT COUNT(*) FROM ins), (SELECT COUNT(*) FROM upd),
+           (SELECT COALESCE(array_agg(ARRAY[n, hits] ORDER BY n), '{}') FROM
+               (SELECT DISTINCT n, hits FROM m WHERE hits > 1) a)
+"""
+
+
+def import_raw_materials_excel(file_source, upsert=True, stats=None, chunk=500):
     """Import raw materials from Excel.
     file_source can be a file path (str) or bytes/BytesIO object.
     Expected columns (row 1 header): Received Date, D.O. Number, Description, Grade, Qty, Remark
-    Returns (count, error_message). error_message is None on success.
+    upsert=True matches rows on (received date, D.O. number, description, grade)
+    so re-importing a sheet is idempotent; a file row repeating an earlier
+    row's key is rejected, and a key already held by several rows in the
+    database updates none of them.
+    upsert=False appends every row.  Rows go in chunk at a time.
+    stats, if given, is filled with inserted / updated / unchanged counts,
+    rejected, (sheet row, reason) for rows skipped over an unreadable date or
+    a repeated key, and ambiguous, (sheet row, matching rows) for the keys
+    left alone.
+    Returns (count, error_message); count is inserted + updated.
     """
+    stats = {} if stats is None else stats
+    stats.update(inserted=0, updated=0, unchanged=0, rejected=[], ambiguous=[])
     try:
-        import openpyxl
-        from io import BytesIO as _BytesIO
-        if isinstance(file_source, (bytes, bytearray)):
-            file_source = _BytesIO(file_source)
-        wb = openpyxl.load_workbook(file_source, data_only=True)
-        ws = wb.active
-        rows = list(ws.iter_rows(values_only=True))
         # find header row by looking for 'Description' or 'Received Date'
-        header_row = next(
-            (i for i, r in enumerate(rows)
-             if r and any(str(v).strip().lower() in ('description', 'received date')
-                          for v in r if v)),
-            None
+        header, rows = _excel_rows(
+            file_source,
+            lambda r: any(str(v).strip().lower() in ('description', 'received date') for v in r if v),
+            numbered=True,
         )
-        if header_row is None:
+        if header is None:
             return 0, "Header row not found. Ensure row 1 has: Received Date, D.O. Number, Description, Grade, Qty, Remark"
-        headers = [str(h).strip() if h else '' for h in rows[header_row]]
-        col = {h.lower(): i for i, h in enumerate(headers)}
-
-        def _get(row, *names, default=''):
-            for name in names:
-                idx = col.get(name.lower())
-                if idx is not None and idx < len(row) and row[idx] is not None:
-                    return row[idx]
-            return default
-
-        def _float(v):
-            try: return float(v or 0)
-            except: return 0.0
-
-        c = _conn()
-        count = 0
-        for row in rows[header_row + 1:]:
+        extract = _compile_extractor(header, [
+            (('description',),                                  _cell_text,  ''),
+            (('received date', 'received_date'),                _cell_date,  None),
+            (('d.o. number', 'do number', 'do no', 'do_no'),    _cell_text,  ''),
+            (('grade',),                                        _cell_text,  ''),
+            (('qty', 'quantity'),                               _cell_float, 0),
+            (('total kg', 'total_kg', 'total weight'),          _cell_float, 0),
+            (('remark', 'remarks'),                             _cell_text,  ''),
+        ], normalize=lambda h: h.strip().lower())
+
+        records = {}   # natural key (or row number) -> (sheet row, row), file order kept
+        for row_no, row in rows:
             if not row or not any(v for v in row):
                 continue
-            desc = str(_get(row, 'description', default='')).strip()
+            try:
+                desc, recv, do_no, grade, qty, total_kg, remark = extract(row)
+            except ValueError as e:
+                stats['rejected'].append((row_no, str(e)))
+                continue
             if not desc:
                 continue
-            recv     = str(_get(row, 'received date', 'received_date', default='')).strip()
-            do_no    = str(_get(row, 'd.o. number', 'do number', 'do no', 'do_no', default='')).strip()
-            grade    = str(_get(row, 'grade', default='')).strip()
-            qty      = _float(_get(row, 'qty', 'quantity', default=0))
-            total_kg = _float(_get(row, 'total kg', 'total_kg', 'total weight', default=0))
-            remark   = str(_get(row, 'remark', 'remarks', default='')).strip()
-            c.execute(
-                "INSERT INTO raw_materials (received_date, do_no, description, grade, qty, total_kg, remark) "
-                "VALUES (?,?,?,?,?,?,?)",
-                (recv, do_no, desc, grade, qty, total_kg, remark)
-            )
-            count += 1
-        c.commit()
-        c.close()
-        return count, None
+            key = (recv, do_no, desc, grade) if upsert else len(records)
+            prev = records.get(key)
+            if prev is not None:
+                stats['rejected'].append((row_no, f'repeats row {prev[0]}'))
+                continue
+            records[key] = (row_no, (recv, do_no, desc, grade, qty, total_kg, remark))
+        row_nos = [n for n, _ in records.values()]
+        records = [r for _, r in records.values()]
+
+        with _conn() as c:
+            cur = c._conn.cursor()
+            if upsert:   # serialise concurrent imports so a key can't be inserted twice
+                cur.execute("LOCK TABLE raw_materials IN SHARE ROW EXCLUSIVE MODE")
+            for k in range(0, len(records), chunk):
+                batch = records[k:k + chunk]
+                if upsert:
+                    inserted, updated, ambiguous = psycopg2.extras.execute_values(
+                        cur, _RAW_MATERIAL_UPSERT, [(n,) + r for n, r in enumerate(batch)],
+                        template="(%s, %s::date, %s, %s, %s, %s::float8, %s::float8, %s)",
+                        page_size=len(batch), fetch=True,
+                    )[0]
+                    stats['ambiguous'] += [(row_nos[k + n], hits) for n, hits in ambiguous]
+                else:
+                    psycopg2.extras.execute_values(
+                        cur,
+                        "INSERT INTO raw_materials "
+                        "(received_date, do_no, description, grade, qty, total_kg, remark) VALUES %s",
+                        batch, page_size=len(batch),
+                    )
+                    inserted, updated, ambiguous = len(batch), 0, ()
+                stats['inserted']  += inserted
+                stats['updated']   += updated
+                stats['unchanged'] += len(batch) - inserted - updated - len(ambiguous)
+            c.commit()
+            cur.close()
+        return stats['inserted'] + stats['updated'], None
     except Exception as e:
         return 0, str(e)
 
 
-def replace_import_excel(file_source):
+def replace_import_excel(file_source, timings=None, rejected=None):
     """Clear all parts & assemblies (keeps progress), then reimport from Excel.
-    file_source can be a file path (str) or bytes/BytesIO object."""
-    c = _conn()
-    # TRUNCATE is instant; DELETE on 4k-row tables hits Supabase statement timeout
-    c.execute("TRUNCATE TABLE parts, assemblies")
-    c.commit()
-    c.close()
-    return import_excel(file_source)
+    file_source can be a file path (str) or bytes/BytesIO object.
+    The clear and the reimport commit together, so a failed import changes nothing."""
+    return import_excel(file_source, timings=timings, replace=True, rejected=rejected)
+
+
+# ── Excel import: staging + merge ──────────────────────────────────────────────
+# Parsed rows go into ON COMMIT DROP temp tables shaped like their targets,
+# loaded with COPY FROM STDIN (FAB_DB_COPY=0 forces execute_values), then one
+# set-based INSERT ... SELECT per target table.  A replace import fills
+# assemblies_next / parts_next instead and renames them over the live tables
+# at the end, so readers keep the old BOM until the swap commits and only the
+# rename itself holds an exclusive lock.  Imports hold _IMPORT_LOCK so only
+# one runs at a time across all app processes.
+
+_COPY_ENABLED = os.environ.get('FAB_DB_COPY', '1') != '0'
+_IMPORT_STATEMENT_TIMEOUT = os.environ.get('FAB_IMPORT_TIMEOUT', '300s')
+
+_IMPORT_STAGING = {
+    'import_assemblies': ('assemblies', ['assembly_mark', 'total_weight_kg', 'work_order', 'priority']),
+    'import_parts':      ('parts',      ['assembly_mark', 'sub_assembly_mark', 'part_mark', 'no', 'name',
+                                         'profile', 'kg_per_m', 'length_mm', 'total_weight_kg',
+                                         'profile2', 'grade', 'remark', 'priority']),
+    'import_progress':   ('progress',   ['entry_date', 'assembly_mark', 'sub_assembly_mark', 'stage',
+                                         'weight_kg', 'delivery_order_no']),
+}
+
+
+_IMPORT_LOCK = (4242, 1)   # pg_try_advisory_xact_lock key
+
+_SHADOW_TABLES = ('assemblies', 'parts')   # referenced tables first
+
+# before the swap, move daily_stage_totals from the live assembly set to the
+# shadow one (the assemblies triggers fire neither on the shadow table nor on
+# a rename); _merge_import has locked progress and assemblies writers out
+_SHADOW_DAILY_TOTALS_FIX = [
+    f"""
+    SELECT daily_stage_totals_apply(array_agg(entry_date), array_agg(stage), array_agg(kg), array_agg(n))
+    FROM (SELECT p.entry_date, p.stage, {sign} * SUM(COALESCE(p.weight_kg, 0)) AS kg,
+                 {sign} * COUNT(*)::int AS n
+          FROM progress p
+          WHERE EXISTS (SELECT 1 FROM {src} s WHERE s.assembly_mark = p.assembly_mark)
+            AND NOT EXISTS (SELECT 1 FROM {other} o WHERE o.assembly_mark = p.assembly_mark)
+          GROUP BY 1, 2) d
+    """
+    for src, other, sign in (('assemblies', 'assemblies_next', '-1'),
+                             ('assemblies_next', 'assemblies', '1'))
+]
 
 
-def import_excel(file_source):
-    try:
-        import openpyxl
-        from io import BytesIO as _BytesIO
-        if isinstance(file_source, (bytes, bytearray)):
-            file_source = _BytesIO(file_source)
-        wb = openpyxl.load_workbook(file_source, data_only=True)
-        ws = wb.active
-        rows = list(ws.iter_rows(values_only=True))
-        header_row = next(
-            (i for i, r in enumerate(rows)
-             if r and any(str(v).strip() == 'Assembly Mark' for v in r if v is not None)),
-            None
+class _CopyUnavailable(Exception):
+    """COPY FROM STDIN is not permitted or not supported on this connection;
+    the caller retries with execute_values."""
+
+
+def _copy_text(value):
+    """One field in COPY text format."""
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def _stage_rows(cur, table, rows, use_copy):
+    columns = ', '.join(_IMPORT_STAGING[table][1])
+    if use_copy:
+        from io import StringIO as _StringIO
+        buf = _StringIO()
+        for row in rows:
+            buf.write('\t'.join(_copy_text(v) for v in row))
+            buf.write('\n')
+        buf.seek(0)
+        try:
+            cur.copy_expert(f"COPY {table} ({columns}) FROM STDIN", buf)
+        except (psycopg2.errors.InsufficientPrivilege, psycopg2.errors.FeatureNotSupported) as e:
+            raise _CopyUnavailable(e) from e   # anything else (bad data) is a real failure
+    else:
+        psycopg2.extras.execute_values(
+            cur, f"INSERT INTO {table} ({columns}) VALUES %s", rows, page_size=1000)
+
+
+def _own_transaction(what):
+    """Raise RuntimeError inside transaction(): what commits (or rolls back) its own
+    transaction and would end the caller's with it."""
+    if getattr(_local, 'tx', None) is not None:
+        raise RuntimeError(f'{what} cannot run inside db.transaction(); it commits on its own.')
+
+
+def _claim_import_lock(cur):
+    """Take _IMPORT_LOCK for the current transaction or raise RuntimeError."""
+    cur.execute("SELECT pg_try_advisory_xact_lock(%s, %s)", _IMPORT_LOCK)
+    if not cur.fetchone()[0]:
+        raise RuntimeError('Another import is already running. Try again when it has finished.')
+
+
+def _create_shadow_tables(cur):
+    """Empty assemblies_next / parts_next with the live columns, defaults and indexes."""
+    for table in reversed(_SHADOW_TABLES):
+        cur.execute(f"DROP TABLE IF EXISTS {table}_next")
+    for table in _SHADOW_TABLES:
+        cur.execute(f"CREATE TABLE {table}_next (LIKE {table} INCLUDING ALL)")
+
+
+def _swap_shadow_tables(cur):
+    """Rename the filled *_next tables over the live ones inside the caller's
+    transaction.  LIKE copies neither foreign keys nor triggers, names its own
+    indexes and leaves serial sequences owned by the old table, so those are
+    carried over here.  Everything that reads the tables is done before the
+    ACCESS EXCLUSIVE lock; it is held from the renames to commit.
+    """
+    fkeys, triggers, indexes, sequences = [], [], [], []
+    for table in _SHADOW_TABLES:
+        cur.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = %s::regclass AND contype = 'f'", (table,))
+        for name, definition in cur.fetchall():
+            for ref in _SHADOW_TABLES:   # point at the shadow copy, which becomes live
+                definition = definition.replace(f'REFERENCES {ref}(', f'REFERENCES {ref}_next(')
+            fkeys.append(f"ALTER TABLE {table}_next ADD CONSTRAINT {name} {definition}")
+        cur.execute(
+            "SELECT pg_get_triggerdef(oid) FROM pg_trigger "
+            "WHERE tgrelid = %s::regclass AND NOT tgisinternal", (table,))
+        triggers += [r[0] for r in cur.fetchall()]
+        # pair each shadow index with the live index of the same shape
+        cur.execute("""
+            SELECT DISTINCT ON (oc.relname) nc.relname, oc.relname
+            FROM pg_index n
+            JOIN pg_class nc ON nc.oid = n.indexrelid
+            JOIN pg_index o  ON o.indrelid = %s::regclass
+                            AND o.indisunique = n.indisunique AND o.indisprimary = n.indisprimary
+                            AND split_part(pg_get_indexdef(o.indexrelid), ' USING ', 2)
+                              = split_part(pg_get_indexdef(n.indexrelid), ' USING ', 2)
+            JOIN pg_class oc ON oc.oid = o.indexrelid
+            WHERE n.indrelid = %s::regclass
+        """, (table, f'{table}_next'))
+        indexes += cur.fetchall()
+        cur.execute(
+            "SELECT attname, pg_get_serial_sequence(%s, attname) FROM pg_attribute "
+            "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped",
+            (table, table))
+        sequences += [(table, col, seq) for col, seq in cur.fetchall() if seq]
+    for sql in fkeys:
+        cur.execute(sql)
+
+    cur.execute(f"LOCK TABLE {', '.join(_SHADOW_TABLES)} IN ACCESS EXCLUSIVE MODE")
+    for table in _SHADOW_TABLES:
+        cur.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+        cur.execute(f"ALTER TABLE {table}_next RENAME TO {table}")
+    for table, col, seq in sequences:
+        cur.execute(f"ALTER SEQUENCE {seq} OWNED BY {table}.{col}")
+    for table in reversed(_SHADOW_TABLES):
+        cur.execute(f"DROP TABLE {table}_old")
+    for new_name, old_name in indexes:
+        cur.execute(f'ALTER INDEX "{new_name}" RENAME TO "{old_name}"')
+    for sql in triggers:
+        cur.execute(sql)
+
+
+def _merge_import(raw, asm_rows, parts_rows, prog_rows, replace, use_copy, timings):
+    """Stage and merge one parsed import on raw (a psycopg2 connection); commits.
+    replace=True loads into shadow tables and swaps them in (see above)."""
+    cur = raw.cursor()
+    t = time.perf_counter()
+    cur.execute("SET LOCAL statement_timeout = %s", (_IMPORT_STATEMENT_TIMEOUT,))
+    _claim_import_lock(cur)
+    for table, (target, columns) in _IMPORT_STAGING.items():
+        cur.execute(f"CREATE TEMP TABLE {table} ON COMMIT DROP AS "
+                    f"SELECT {', '.join(columns)} FROM {target} WITH NO DATA")
+    _stage_rows(cur, 'import_assemblies', asm_rows, use_copy)
+    _stage_rows(cur, 'import_parts', parts_rows, use_copy)
+    _stage_rows(cur, 'import_progress', prog_rows, use_copy)
+    timings['stage']  = time.perf_counter() - t
+    timings['method'] = 'copy' if use_copy else 'execute_values'
+
+    t = time.perf_counter()
+    suffix = '_next' if replace else ''
+    if replace:
+        _create_shadow_tables(cur)
+    cur.execute(
+        f"INSERT INTO assemblies{suffix} (assembly_mark, total_weight_kg, work_order, priority) "
+        "SELECT assembly_mark, total_weight_kg, work_order, priority FROM import_assemblies "
+        "ON CONFLICT(assembly_mark) DO UPDATE SET total_weight_kg = EXCLUDED.total_weight_kg, "
+        "work_order = EXCLUDED.work_order, priority = EXCLUDED.priority"
+    )
+    parts_cols = ', '.join(_IMPORT_STAGING['import_parts'][1])
+    cur.execute(f"INSERT INTO parts{suffix} ({parts_cols}) SELECT {parts_cols} FROM import_parts")
+    if not replace:   # parts were appended to any already there, so re-sum those assemblies
+        cur.execute(
+            "UPDATE assemblies a SET total_weight_kg = s.kg "
+            "FROM (SELECT assembly_mark, SUM(total_weight_kg) AS kg FROM parts "
+            "      WHERE assembly_mark IN (SELECT assembly_mark FROM import_assemblies) "
+            "      GROUP BY assembly_mark) s "
+            "WHERE a.assembly_mark = s.assembly_mark"
         )
-        if header_row is None:
-            return 0, 0, "Header row 'Assembly Mark' not found."
-        headers = [str(h).strip() if h else '' for h in rows[header_row]]
-        col = {h: i for i, h in enumerate(headers)}
-
-        def _get(row, *names, default=None):
-            for name in names:
-                idx = col.get(name)
-                if idx is not None and idx < len(row) and row[idx] is not None:
-                    return row[idx]
-            return default
-
-        def _float(v):
-            try: return float(v or 0)
-            except: return 0.0
-
-        def _int(v):
-            try: return int(float(v or 1))
-            except: return 1
-
-        stage_cols = [
-            ('FIT UP',              'FIT UP (kg)',               'FIT UP Date',                    None),
-            ('WELDING',             'WELDING (kg)',              'WELDING Date',                   None),
-            ('BLASTING & PAINTING', 'BLASTING & PAINTING (kg)', 'BLASTING & PAINTING Date',       'BLASTING & PAINTING D.O. No.'),
-            ('SEND TO SITE',        'SEND TO SITE (kg)',         'SEND TO SITE Date',              'SEND TO SITE D.O. No.'),
-        ]
 
-        # ── Pass 1: parse entire Excel into memory lists ──────────────────────
-        asm_order      = []        # insertion order preserved
-        asm_set        = set()
-        parts_rows     = []        # list of 12-tuples for bulk INSERT
-        asm_weights    = {}        # asm -> total kg
-        asm_work_orders = {}       # asm -> work_order
-        asm_priorities  = {}       # asm -> priority
-        progress_map   = {}        # (asm, sub, stage) -> (total_kg, date_str, do_no)
-
-        for row in rows[header_row + 1:]:
-            if not row or not _get(row, 'Assembly Mark'):
-                continue
+    # Hold progress writers (not readers) until commit.  With no writer left
+    # holding rollup / totals rows, or AccessShare on assemblies while it
+    # waits for ours, the swap's ACCESS EXCLUSIVE request below can't
+    # deadlock; and the live progress and assembly set stay as read here.
+    cur.execute("LOCK TABLE progress IN SHARE ROW EXCLUSIVE MODE")
+
+    # Progress — keep painting_done keys aside, then carry them into the re-insert
+    cur.execute(
+        "CREATE TEMP TABLE import_painting_done ON COMMIT DROP AS "
+        "SELECT DISTINCT p.assembly_mark, p.sub_assembly_mark, p.delivery_order_no "
+        "FROM progress p JOIN import_assemblies i ON i.assembly_mark = p.assembly_mark "
+        "WHERE p.stage = 'BLASTING & PAINTING' AND p.painting_done = TRUE"
+    )
+    cur.execute("DELETE FROM progress WHERE assembly_mark IN (SELECT assembly_mark FROM import_assemblies)")
+    prog_cols = ', '.join(_IMPORT_STAGING['import_progress'][1])
+    cur.execute(
+        f"INSERT INTO progress ({prog_cols}, painting_done) "
+        f"SELECT {', '.join('i.' + c for c in _IMPORT_STAGING['import_progress'][1])}, "
+        "i.stage = 'BLASTING & PAINTING' AND EXISTS ("
+        "SELECT 1 FROM import_painting_done d WHERE d.assembly_mark = i.assembly_mark "
+        "AND d.sub_assembly_mark = i.sub_assembly_mark AND d.delivery_order_no = i.delivery_order_no) "
+        "FROM import_progress i"
+    )
+    if replace:
+        for sql in _SHADOW_DAILY_TOTALS_FIX:
+            cur.execute(sql)
+    timings['merge'] = time.perf_counter() - t
+
+    if replace:
+        t = time.perf_counter()
+        _swap_shadow_tables(cur)
+        timings['swap'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    raw.commit()
+    timings['commit'] = time.perf_counter() - t
+    cur.close()
+    cache = getattr(raw, 'stmt_cache', None)
+    if replace and cache is not None:   # the tables behind its prepared plans were replaced
+        cache.clear()
+
+
+def _parse_master_excel(file_source, rejected=None, skipped=None):
+    """Parse the master database Excel.
+    Returns (asm_rows, parts_rows, prog_rows):
+      asm_rows   (assembly_mark, total_weight_kg, work_order, priority), file order
+      parts_rows (assembly_mark, sub_assembly_mark, part_mark, no, name, profile, kg_per_m,
+                  length_mm, total_weight_kg, profile2, grade, remark, priority)
+      prog_rows  (entry_date, assembly_mark, sub_assembly_mark, stage, weight_kg, delivery_order_no)
+    A stage whose date is unreadable is left out of prog_rows (the part is kept);
+    rejected, if given, receives (sheet row, reason) for each and skipped, if
+    given, the stage's (assembly, sub-assembly, stage) key.
+    Raises ValueError when the header or data rows are missing.
+    """
+    rejected = [] if rejected is None else rejected
+    header, rows = _excel_rows(
+        file_source, lambda r: any(str(v).strip() == 'Assembly Mark' for v in r if v is not None),
+        numbered=True)
+    if header is None:
+        raise ValueError("Header row 'Assembly Mark' not found.")
+    stage_cols = [
+        ('FIT UP',              'FIT UP (kg)',               'FIT UP Date',                    None),
+        ('WELDING',             'WELDING (kg)',              'WELDING Date',                   None),
+        ('BLASTING & PAINTING', 'BLASTING & PAINTING (kg)', 'BLASTING & PAINTING Date',       'BLASTING & PAINTING D.O. No.'),
+        ('SEND TO SITE',        'SEND TO SITE (kg)',         'SEND TO SITE Date',              'SEND TO SITE D.O. No.'),
+    ]
+    fields = [
+        (('Assembly Mark',),                                        _cell_text,    ''),
+        (('Sub Assembly', 'Sub-Assembly Mark', 'Sub Assembly Mark'), _cell_text,    ''),
+        (('Part Mark',),                                            _cell_text,    ''),
+        (('No.',),                                                  _cell_int,     1),
+        (('Name', 'NAME'),                                          _cell_text,    ''),
+        (('Profile',),                                              _cell_text,    ''),
+        (('kg/m',),                                                 _cell_float,   0),
+        (('Length (mm)', 'Length'),                                 _cell_float,   0),
+        (('Weight (kg)', 'Total weight'),                           _cell_float,   0),
+        (('Profile 2', 'Profile2'),                                 _cell_text,    ''),
+        (('Grade',),                                                _cell_text,    ''),
+        (('Remark',),                                               _cell_text,    ''),
+        (('Work Order', 'Work_Order', 'WO'),                        _cell_text,    '001'),
+        (('Priority',),                                             _cell_opt_int, None),
+    ]
+    for _, kg_col, date_col, do_col in stage_cols:
+        # dates stay raw here and go through _cell_date per stage below
+        fields += [((kg_col,), _cell_float, 0), ((date_col,), lambda v: v, None),
+                   ((do_col,) if do_col else (), _cell_text, '')]
+    extract = _compile_extractor(header, fields)
+
+    asm_order      = []        # insertion order preserved
+    asm_set        = set()
+    parts_rows     = []        # list of 12-tuples for bulk INSERT
+    asm_weights    = {}        # asm -> total kg
+    asm_work_orders = {}       # asm -> work_order
+    asm_priorities  = {}       # asm -> priority
+    progress_map   = {}        # (asm, sub, stage) -> (total_kg, date_str, do_no)
+
+    mark_of = _compile_extractor(header, fields[:1])
+    for row_no, row in rows:
+        # blank and note rows are skipped before their other cells are converted
+        if not row or not mark_of(row)[0]:
+            continue
+        (asm, sub, pm, no, name, prof, kgm, lmm, tw, prof2, grade, remark,
+         wo, prio, *stage_vals) = extract(row)
+        wo = wo or '001'
+
+        if asm not in asm_set:
+            asm_order.append(asm)
+            asm_set.add(asm)
+            asm_work_orders[asm] = wo
+            asm_priorities[asm]  = prio
+        asm_weights[asm] = asm_weights.get(asm, 0) + tw
+        parts_rows.append((asm, sub, pm, no, name, prof, kgm, lmm, tw, prof2, grade, remark, prio))
+
+        for k, (stage, _, _, _) in enumerate(stage_cols):
+            kg, date_str, do_no = stage_vals[3 * k : 3 * k + 3]
+            if kg > 0:
+                try:
+                    date_str = _cell_date(date_str) or str(date.today())
+                except ValueError as e:
+                    rejected.append((row_no, f'{stage}: {e}'))
+                    if skipped is not None:
+                        skipped.add((asm, sub, stage))
+                    continue
+                if (asm, sub, stage) in progress_map:
+                    prev_kg, prev_date, prev_do = progress_map[(asm, sub, stage)]
+                    progress_map[(asm, sub, stage)] = (prev_kg + kg, prev_date, prev_do or do_no)
+                else:
+                    progress_map[(asm, sub, stage)] = (kg, date_str, do_no)
+
+    if not parts_rows:
+        raise ValueError("No valid data rows found.")
+
+    asm_rows = [(asm, asm_weights[asm], asm_work_orders.get(asm, '001'), asm_priorities.get(asm, None))
+                for asm in asm_order]
+    prog_rows = [(ds, asm, sub, stg, kg, do_no)
+                 for (asm, sub, stg), (kg, ds, do_no) in progress_map.items()]
+    return asm_rows, parts_rows, prog_rows
+
+
+def import_excel(file_source, timings=None, replace=False, rejected=None):
+    """Import the master database Excel (parts + cumulative progress columns).
+    Rows are parsed in Python, streamed into temp staging tables with COPY
+    (execute_values if COPY is unavailable) and merged in one transaction.
+    replace=True also empties parts and assemblies inside that transaction.
+    timings, if given, is filled with seconds per phase and the load method;
+    rejected receives (sheet row, reason) for stages skipped over a bad date.
+    Returns (part_count, progress_count, error_message).
+    """
+    _own_transaction('import_excel')
+    timings = {} if timings is None else timings
+    t0 = time.perf_counter()
+    try:
+        asm_rows, parts_rows, prog_rows = _parse_master_excel(file_source, rejected)
+        timings['parse'] = time.perf_counter() - t0
 
-            asm    = str(_get(row, 'Assembly Mark', default='')).strip()
-            sub    = str(_get(row, 'Sub Assembly', 'Sub-Assembly Mark', 'Sub Assembly Mark', default='') or '').strip()
-            pm     = str(_get(row, 'Part Mark', default='') or '').strip()
-            no     = _int(_get(row, 'No.', default=1))
-            name   = str(_get(row, 'Name', 'NAME', default='') or '').strip()
-            prof   = str(_get(row, 'Profile', default='') or '').strip()
-            kgm    = _float(_get(row, 'kg/m', default=0))
-            lmm    = _float(_get(row, 'Length (mm)', 'Length', default=0))
-            tw     = _float(_get(row, 'Weight (kg)', 'Total weight', default=0))
-            prof2  = str(_get(row, 'Profile 2', 'Profile2', default='') or '').strip()
-            grade  = str(_get(row, 'Grade', default='') or '').strip()
-            remark = str(_get(row, 'Remark', default='') or '').strip()
-            wo     = str(_get(row, 'Work Order', 'Work_Order', 'WO', default='001') or '001').strip()
-            _prio_raw = _get(row, 'Priority', default=None)
-            prio = int(float(_prio_raw)) if _prio_raw is not None and str(_prio_raw).strip() != '' else None
-
-            if asm not in asm_set:
-                asm_order.append(asm)
-                asm_set.add(asm)
-                asm_work_orders[asm] = wo
-                asm_priorities[asm]  = prio
-            asm_weights[asm] = asm_weights.get(asm, 0) + tw
-            parts_rows.append((asm, sub, pm, no, name, prof, kgm, lmm, tw, prof2, grade, remark, prio))
-
-            for stage, kg_col, date_col, do_col in stage_cols:
-                kg = _float(_get(row, kg_col, default=0))
-                if kg > 0:
-                    raw_date = _get(row, date_col, default=None)
-                    if raw_date and hasattr(raw_date, 'strftime'):
-                        date_str = raw_date.strftime('%Y-%m-%d')
-                    elif raw_date:
-                        date_str = str(raw_date).strip()[:10]
-                    else:
-                        date_str = str(date.today())
-                    do_no = str(_get(row, do_col, default='') or '').strip() if do_col else ''
-                    if (asm, sub, stage) in progress_map:
-                        prev_kg, prev_date, prev_do = progress_map[(asm, sub, stage)]
-                        progress_map[(asm, sub, stage)] = (prev_kg + kg, prev_date, prev_do or do_no)
-                    else:
-                        progress_map[(asm, sub, stage)] = (kg, date_str, do_no)
-
-        if not parts_rows:
-            return 0, 0, "No valid data rows found."
-
-        # ── Pass 2: bulk DB writes (execute_values = one statement per batch) ─
-        db  = _conn()
-        raw = db._conn   # underlying psycopg2 connection
-        cur = raw.cursor()
-
-        # 1. Assemblies — all in one statement; include final weights and work_order
-        psycopg2.extras.execute_values(
-            cur,
-            "INSERT INTO assemblies (assembly_mark, total_weight_kg, work_order, priority) VALUES %s "
-            "ON CONFLICT(assembly_mark) DO UPDATE SET total_weight_kg = EXCLUDED.total_weight_kg, "
-            "work_order = EXCLUDED.work_order, priority = EXCLUDED.priority",
-            [(asm, asm_weights[asm], asm_work_orders.get(asm, '001'), asm_priorities.get(asm, None)) for asm in asm_order],
-        )
-        raw.commit()
+        # ── Stage rows, then merge everything in one transaction ─────────────
+        with _conn() as db:
+            raw = db._conn   # underlying psycopg2 connection
+            try:
+                _merge_import(raw, asm_rows, parts_rows, prog_rows, replace, _COPY_ENABLED, timings)
+            except _CopyUnavailable as e:
+                raw.rollback()
+                _log.warning('COPY unavailable (%s); importing with execute_values', e)
+                _merge_import(raw, asm_rows, parts_rows, prog_rows, replace, False, timings)
+        timings['total'] = time.perf_counter() - t0
+        return len(parts_rows), len(prog_rows), None
+    except Exception as e:
+        return 0, 0, str(e)
 
-        # 2. Parts — 500-row chunks (each chunk is one fast statement)
-        CHUNK = 500
-        for i in range(0, len(parts_rows), CHUNK):
-            psycopg2.extras.execute_values(
-                cur,
-                "INSERT INTO parts "
-                "(assembly_mark, sub_assembly_mark, part_mark, no, name, "
-                "profile, kg_per_m, length_mm, total_weight_kg, profile2, grade, remark, priority) "
-                "VALUES %s",
-                parts_rows[i : i + CHUNK],
-            )
-            raw.commit()
 
-        # 3. Progress — preserve painting_done flags before wiping, restore after re-insert
-        prog_rows  = [(ds, asm, sub, stg, kg, do_no)
-                      for (asm, sub, stg), (kg, ds, do_no) in progress_map.items()]
-        prog_count = 0
-        if asm_order:
-            # Save existing painting_done flags keyed by (assembly_mark, sub_assembly_mark, delivery_order_no)
-            dict_cur = raw.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-            dict_cur.execute(
-                "SELECT assembly_mark, sub_assembly_mark, delivery_order_no "
-                "FROM progress "
-                "WHERE stage = 'BLASTING & PAINTING' AND painting_done = TRUE "
-                "AND assembly_mark = ANY(%s)",
-                (list(asm_order),)
-            )
-            painting_done_map = {
-                (r['assembly_mark'], r['sub_assembly_mark'], r['delivery_order_no']): True
-                for r in dict_cur.fetchall()
-            }
-            dict_cur.close()
-            psycopg2.extras.execute_values(
-                cur,
-                "DELETE FROM progress WHERE assembly_mark IN (SELECT v FROM (VALUES %s) AS t(v))",
-                [(asm,) for asm in asm_order],
+def delta_import_excel(file_source, timings=None):
+    """Apply only the differences between the master Excel and the stored BOM.
+    Parts are keyed on (assembly_mark, sub_assembly_mark, part_mark): new keys are
+    inserted, changed rows updated in place and keys missing from the file deleted;
+    assemblies follow the same rule.  Progress is diffed per (assembly,
+    sub-assembly, stage) against its total kg, latest date and D.O. No.: a changed
+    key is rewritten as one row (keeping its lowest id and painting_done), a key
+    the file no longer has is deleted, and a stage skipped over a bad date is left
+    alone.  Diff and apply run in one transaction with the rows locked.
+    Returns (summary, error_message); summary counts inserted / updated / deleted /
+    unchanged parts, assemblies_inserted / _updated / _deleted and
+    progress_added / _updated / _deleted (rows), summary['rejected'] lists
+    (sheet row, reason) for stages skipped over a bad date and summary['marks']
+    holds the MarkIndex add() / remove() arguments.
+    """
+    _own_transaction('delta_import_excel')
+    timings = {} if timings is None else timings
+    t0 = time.perf_counter()
+    summary = dict.fromkeys(('inserted', 'updated', 'deleted', 'unchanged',
+                             'assemblies_inserted', 'assemblies_updated', 'assemblies_deleted',
+                             'progress_added', 'progress_updated', 'progress_deleted'), 0)
+    summary['rejected'] = []
+    skipped = set()
+    try:
+        asm_rows, parts_rows, prog_rows = _parse_master_excel(file_source, summary['rejected'],
+                                                              skipped)
+        timings['parse'] = time.perf_counter() - t0
+
+        with _conn() as db:
+            raw = db._conn   # underlying psycopg2 connection
+            cur = raw.cursor()
+            cur.execute("SET LOCAL statement_timeout = %s", (_IMPORT_STATEMENT_TIMEOUT,))
+            _claim_import_lock(cur)
+
+            # ── Diff in memory ────────────────────────────────────────────────
+            # Progress writers wait until commit, as in _merge_import.  Parts
+            # rows are locked before assembly rows, the order update_part and
+            # update_parts_bulk take them in, so edits made while the file was
+            # parsed are read here and none can land between diff and apply.
+            t = time.perf_counter()
+            cur.execute("LOCK TABLE progress IN SHARE ROW EXCLUSIVE MODE")
+            cur.execute(
+                "SELECT id, assembly_mark, COALESCE(sub_assembly_mark, ''), COALESCE(part_mark, ''), "
+                "no, name, profile, kg_per_m, length_mm, total_weight_kg, profile2, grade, remark, priority "
+                "FROM parts ORDER BY id FOR UPDATE"
             )
-            raw.commit()
-        else:
-            painting_done_map = {}
-        if prog_rows:
-            psycopg2.extras.execute_values(
-                cur,
-                "INSERT INTO progress "
-                "(entry_date, assembly_mark, sub_assembly_mark, stage, weight_kg, delivery_order_no) VALUES %s",
-                prog_rows,
+            stored = {}
+            for r in cur.fetchall():
+                stored.setdefault(r[1:4], []).append((r[0], r[4:]))
+            inserts, updates = [], []
+            for row in parts_rows:
+                matches = stored.get(row[:3])
+                if not matches:
+                    inserts.append(row)
+                    continue
+                pid, old = matches.pop(0)
+                if old != row[3:]:
+                    updates.append((pid,) + row[3:])
+                else:
+                    summary['unchanged'] += 1
+            deletes = [pid for matches in stored.values() for pid, _ in matches]
+            deleted_keys = [key for key, matches in stored.items() for _ in matches]
+
+            cur.execute("SELECT assembly_mark, total_weight_kg, work_order, priority "
+                        "FROM assemblies ORDER BY assembly_mark FOR UPDATE")
+            stored_asm = {r[0]: r[1:] for r in cur.fetchall()}
+            asm_inserts, asm_updates = [], []
+            for asm, weight, wo, prio in asm_rows:
+                old = stored_asm.pop(asm, None)
+                if old is None:
+                    asm_inserts.append((asm, weight, wo, prio))
+                elif abs((old[0] or 0) - weight) > 1e-6 or (old[1], old[2]) != (wo, prio):
+                    asm_updates.append((asm, weight, wo, prio))
+            asm_deletes = list(stored_asm)
+
+            # progress: one (ids, kg, last date, last D.O., painted) per key, as the rollup sums it
+            cur.execute(
+                "SELECT assembly_mark, COALESCE(sub_assembly_mark, ''), stage, array_agg(id ORDER BY id), "
+                "SUM(weight_kg), MAX(entry_date), COALESCE(MAX(delivery_order_no), ''), "
+                "COALESCE(bool_or(painting_done), FALSE) "
+                "FROM progress GROUP BY 1, 2, 3"
             )
+            stored_prog = {r[:3]: r[3:] for r in cur.fetchall()}
+            prog_inserts, prog_updates, prog_deletes = [], [], []
+            for ds, asm, sub, stg, kg, do_no in prog_rows:
+                old = stored_prog.pop((asm, sub, stg), None)
+                if old is None:
+                    prog_inserts.append((ds, asm, sub, stg, kg, do_no))
+                    continue
+                ids, old_kg, old_date, old_do, painted = old
+                if (abs((old_kg or 0) - kg) > 1e-6 or str(old_date) != ds
+                        or old_do != (do_no or '')):
+                    prog_updates.append((ids[0], ds, kg, do_no, painted))
+                    prog_deletes += ids[1:]
+            for key, (ids, *_) in stored_prog.items():
+                if key not in skipped:
+                    prog_deletes += ids
+            timings['diff'] = time.perf_counter() - t
+
+            # ── Apply ─────────────────────────────────────────────────────────
+            t = time.perf_counter()
+            if asm_inserts:
+                psycopg2.extras.execute_values(
+                    cur,
+                    "INSERT INTO assemblies (assembly_mark, total_weight_kg, work_order, priority) VALUES %s",
+                    asm_inserts,
+                )
+            if asm_updates:
+                psycopg2.extras.execute_values(
+                    cur,
+                    "UPDATE assemblies a SET total_weight_kg = v.w, work_order = v.wo, priority = v.prio "
+                    "FROM (VALUES %s) AS v(mark, w, wo, prio) WHERE a.assembly_mark = v.mark",
+                    asm_updates,
+                    template="(%s, %s::float8, %s, %s::int)",
+                )
+            if deletes:
+                cur.execute("DELETE FROM parts WHERE id = ANY(%s)", (deletes,))
+            if updates:
+                psycopg2.extras.execute_values(
+                    cur,
+                    "UPDATE parts p SET no = v.no, name = v.name, profile = v.profile, "
+                    "kg_per_m = v.kg_per_m, length_mm = v.length_mm, total_weight_kg = v.total_weight_kg, "
+                    "profile2 = v.profile2, grade = v.grade, remark = v.remark, priority = v.priority "
+                    "FROM (VALUES %s) AS v(id, no, name, profile, kg_per_m, length_mm, total_weight_kg, "
+                    "profile2, grade, remark, priority) WHERE p.id = v.id",
+                    updates,
+                    template="(%s::int, %s::int, %s, %s, %s::float8, %s::float8, %s::float8, %s, %s, %s, %s::int)",
+                )
+            if inserts:
+                psycopg2.extras.execute_values(
+                    cur,
+                    "INSERT INTO parts "
+                    "(assembly_mark, sub_assembly_mark, part_mark, no, name, "
+                    "profile, kg_per_m, length_mm, total_weight_kg, profile2, grade, remark, priority) "
+                    "VALUES %s",
+                    inserts,
+                    page_size=1000,
+                )
+            if prog_deletes:
+                cur.execute("DELETE FROM progress WHERE id = ANY(%s)", (prog_deletes,))
+            if prog_updates:
+                psycopg2.extras.execute_values(
+                    cur,
+                    "UPDATE progress p SET entry_date = v.d, weight_kg = v.kg, "
+                    "delivery_order_no = v.do_no, painting_done = v.done "
+                    "FROM (VALUES %s) AS v(id, d, kg, do_no, done) WHERE p.id = v.id",
+                    prog_updates,
+                    template="(%s::int, %s::date, %s::float8, %s, %s::boolean)",
+                    page_size=1000,
+                )
+            if prog_inserts:
+                psycopg2.extras.execute_values(
+                    cur,
+                    "INSERT INTO progress "
+                    "(entry_date, assembly_mark, sub_assembly_mark, stage, weight_kg, delivery_order_no) "
+                    "VALUES %s",
+                    prog_inserts,
+                    template="(%s::date, %s, %s, %s, %s::float8, %s)",
+                    page_size=1000,
+                )
+            if asm_deletes:
+                cur.execute("DELETE FROM assemblies WHERE assembly_mark = ANY(%s)", (asm_deletes,))
             raw.commit()
-            # Restore painting_done flags
-            if painting_done_map:
-                for (asm, sub, do_no), _ in painting_done_map.items():
-                    cur.execute(
-                        "UPDATE progress SET painting_done = TRUE "
-                        "WHERE assembly_mark = %s AND sub_assembly_mark = %s "
-                        "AND stage = 'BLASTING & PAINTING' AND delivery_order_no = %s",
-                        (asm, sub, do_no)
-                    )
-                raw.commit()
-            prog_count = len(prog_rows)
-
-        cur.close()
-        db.close()
-        return len(parts_rows), prog_count, None
+            cur.close()
+            timings['apply'] = time.perf_counter() - t
+
+        summary.update(inserted=len(inserts), updated=len(updates), deleted=len(deletes),
+                       assemblies_inserted=len(asm_inserts), assemblies_updated=len(asm_updates),
+                       assemblies_deleted=len(asm_deletes), progress_added=len(prog_inserts),
+                       progress_updated=len(prog_updates), progress_deleted=len(prog_deletes))
+        summary['marks'] = {
+            'added':   {'assemblies': [a[0] for a in asm_inserts], 'parts': [r[:3] for r in inserts]},
+            'removed': {'assemblies': asm_deletes, 'parts': deleted_keys},
+        }
+        timings['total'] = time.perf_counter() - t0
+        return summary, None
     except Exception as e:
-        return 0, 0, str(e)
+        return summary, str(e)
 
 
 def get_work_orders():
     """Return sorted list of distinct work_order values from assemblies."""
-    db = _conn()
-    rows = db.execute(
-        "SELECT DISTINCT work_order FROM assemblies WHERE work_order != '' ORDER BY work_order"
-    ).fetchall()
-    db.close()
+    with _conn() as db:
+        rows = db.execute(
+            "SELECT DISTINCT work_order FROM assemblies WHERE work_order != '' ORDER BY work_order"
+        ).fetchall()
     return [r['work_order'] for r in rows]
 
 
 def get_marks_by_work_order(work_order=None):
     """Return assembly marks optionally filtered by work_order."""
-    db = _conn()
-    if work_order:
-        rows = db.execute(
-            "SELECT assembly_mark FROM assemblies WHERE work_order = ? ORDER BY assembly_mark",
-            (work_order,)
-        ).fetchall()
-    else:
-        rows = db.execute(
-            "SELECT assembly_mark FROM assemblies ORDER BY assembly_mark"
-        ).fetchall()
-    db.close()
+    with _conn() as db:
+        if work_order:
+            rows = db.execute(
+                "SELECT assembly_mark FROM assemblies WHERE work_order = ? ORDER BY assembly_mark",
+                (work_order,)
+            ).fetchall()
+        else:
+            rows = db.execute(
+                "SELECT assembly_mark FROM assemblies ORDER BY assembly_mark"
+            ).fetchall()
     return [r['assembly_mark'] for r in rows]
 
 
 def add_assembly(mark, weight, desc='', work_order='001'):
-    db = _conn()
-    db.execute(
-        "INSERT INTO assemblies (assembly_mark, total_weight_kg, description, work_order) VALUES (?, ?, ?, ?) "
-        "ON CONFLICT(assembly_mark) DO NOTHING",
-        (mark.strip().upper(), weight, desc, work_order.strip())
-    )
-    db.commit()
-    db.close()
+    with _conn() as db:
+        db.execute(
+            "INSERT INTO assemblies (assembly_mark, total_weight_kg, description, work_order) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(assembly_mark) DO NOTHING",
+            (mark.strip().upper(), weight, desc, work_order.strip())
+        )
+        db.commit()
 
 
 def add_part(asm, sub, pm, no, name, prof, kgm, lmm, tw, prof2, grade, remark=''):
-    db = _conn()
-    # ensure assembly exists
-    db.execute(
-        "INSERT INTO assemblies (assembly_mark, total_weight_kg) VALUES (?, 0) "
-        "ON CONFLICT(assembly_mark) DO NOTHING",
-        (asm,)
-    )
-    db.execute(
-        "INSERT INTO parts (assembly_mark, sub_assembly_mark, part_mark, no, name, "
-        "profile, kg_per_m, length_mm, total_weight_kg, profile2, grade, remark) "
-        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-        (asm, sub, pm, no, name, prof, kgm, lmm, tw, prof2, grade, remark)
-    )
-    # recalculate assembly total weight from sum of all its parts
-    db.execute(
-        "UPDATE assemblies SET total_weight_kg = "
-        "(SELECT COALESCE(SUM(total_weight_kg), 0) FROM parts WHERE assembly_mark = ?) "
-        "WHERE assembly_mark = ?",
-        (asm, asm)
-    )
-    db.commit()
-    db.close()
+    with _conn() as db:
+        # ensure assembly exists
+        db.execute(
+            "INSERT INTO assemblies (assembly_mark, total_weight_kg) VALUES (?, 0) "
+            "ON CONFLICT(assembly_mark) DO NOTHING",
+            (asm,)
+        )
+        db.execute(
+            "INSERT INTO parts (assembly_mark, sub_assembly_mark, part_mark, no, name, "
+            "profile, kg_per_m, length_mm, total_weight_kg, profile2, grade, remark) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (asm, sub, pm, no, name, prof, kgm, lmm, tw, prof2, grade, remark)
+        )
+        _apply_weight_deltas(db, {asm: tw or 0})
+        db.commit()
 
 
 def update_part(pid, asm, sub, pm, no, name, prof, kgm, lmm, tw, prof2, grade, remark=''):
-    db = _conn()
-    old = db.execute("SELECT assembly_mark FROM parts WHERE id = ?", (pid,)).fetchone()
-    old_asm = old['assembly_mark'] if old else None
-    db.execute("""
-        UPDATE parts SET assembly_mark=?, sub_assembly_mark=?, part_mark=?, no=?,
-        name=?, profile=?, kg_per_m=?, length_mm=?, total_weight_kg=?, profile2=?, grade=?, remark=?
-        WHERE id=?
-    """, (asm, sub, pm, no, name, prof, kgm, lmm, tw, prof2, grade, remark, pid))
-    # recalculate both old and new assembly weights if assembly changed
-    for a in {asm, old_asm} - {None}:
-        db.execute(
-            "UPDATE assemblies SET total_weight_kg = "
-            "(SELECT COALESCE(SUM(total_weight_kg),0) FROM parts WHERE assembly_mark=?) "
-            "WHERE assembly_mark=?", (a, a)
-        )
-    db.commit()
-    db.close()
+    with _conn() as db:
+        old = db.execute(
+            "SELECT assembly_mark, total_weight_kg FROM parts WHERE id = ? FOR UPDATE", (pid,)
+        ).fetchone()
+        db.execute("""
+            UPDATE parts SET assembly_mark=?, sub_assembly_mark=?, part_mark=?, no=?,
+            name=?, profile=?, kg_per_m=?, length_mm=?, total_weight_kg=?, profile2=?, grade=?, remark=?
+            WHERE id=?
+        """, (asm, sub, pm, no, name, prof, kgm, lmm, tw, prof2, grade, remark, pid))
+        if old:   # move the part's weight from the old assembly to the new one
+            deltas = {old['assembly_mark']: -(old['total_weight_kg'] or 0)}
+            deltas[asm] = deltas.get(asm, 0) + (tw or 0)
+            _apply_weight_deltas(db, deltas)
+        db.commit()
 
 
 def update_progress(pid, entry_date, mark, sub_mark, stage, weight, qty, remarks, do_no=''):
-    db = _conn()
-    db.execute("""
-        UPDATE progress SET entry_date=?, assembly_mark=?, sub_assembly_mark=?, stage=?,
-        weight_kg=?, qty=?, remarks=?, delivery_order_no=? WHERE id=?
-    """, (str(entry_date), mark, sub_mark, stage, float(weight), int(qty), remarks, do_no, pid))
-    db.commit()
-    db.close()
+    with _conn() as db:
+        db.execute("""
+            UPDATE progress SET entry_date=?, assembly_mark=?, sub_assembly_mark=?, stage=?,
+            weight_kg=?, qty=?, remarks=?, delivery_order_no=? WHERE id=?
+        """, (str(entry_date), mark, sub_mark, stage, float(weight), int(qty), remarks, do_no, pid))
+        db.commit()
 
 
 def delete_part(part_id):
-    db = _conn()
-    row = db.execute("SELECT assembly_mark FROM parts WHERE id = ?", (part_id,)).fetchone()
-    if row:
-        asm = row['assembly_mark']
-        db.execute("DELETE FROM parts WHERE id = ?", (part_id,))
-        db.execute(
-            "UPDATE assemblies SET total_weight_kg = "
-            "(SELECT COALESCE(SUM(total_weight_kg), 0) FROM parts WHERE assembly_mark = ?) "
-            "WHERE assembly_mark = ?",
-            (asm, asm)
-        )
+    with _conn() as db:
+        row = db.execute(
+            "DELETE FROM parts WHERE id = ? RETURNING assembly_mark, total_weight_kg", (part_id,)
+        ).fetchone()
+        if row:
+            _apply_weight_deltas(db, {row['assembly_mark']: -(row['total_weight_kg'] or 0)})
         db.commit()
-    db.close()
 
 
 def get_marks():
-    db = _conn()
-    rows = db.execute("SELECT assembly_mark FROM assemblies ORDER BY assembly_mark").fetchall()
-    db.close()
+    with _conn() as db:
+        rows = db.execute("SELECT assembly_mark FROM assemblies ORDER BY assembly_mark").fetchall()
     return [r['assembly_mark'] for r in rows]
 
 
 def get_assemblies():
-    db = _conn()
-    rows = db.execute("SELECT * FROM assemblies ORDER BY assembly_mark").fetchall()
-    db.close()
+    with _conn() as db:
+        rows = db.execute("SELECT * FROM assemblies ORDER BY assembly_mark").fetchall()
     return [dict(r) for r in rows]
 
 
 def get_assembly_weight(mark):
-    db = _conn()
-    row = db.execute("SELECT total_weight_kg FROM assemblies WHERE assembly_mark = ?", (mark,)).fetchone()
-    db.close()
+    with _conn() as db:
+        row = db.execute("SELECT total_weight_kg FROM assemblies WHERE assembly_mark = ?", (mark,)).fetchone()
     return row['total_weight_kg'] if row else 0
 
 
 def progress_exists(entry_date, mark, sub_mark, stage):
     """Return True if a progress entry already exists for the given combination."""
-    db = _conn()
-    row = db.execute(
-        "SELECT 1 AS exists FROM progress WHERE entry_date=? AND assembly_mark=? "
-        "AND sub_assembly_mark=? AND stage=?",
-        (str(entry_date), mark, sub_mark, stage)
-    ).fetchone()
-    db.close()
+    with _conn() as db:
+        row = db.execute(
+            "SELECT 1 AS exists FROM progress WHERE entry_date=? AND assembly_mark=? "
+            "AND sub_assembly_mark=? AND stage=?",
+            (str(entry_date), mark, sub_mark, stage)
+        ).fetchone()
     return row is not None
 
 
 def get_completed_stages(mark, sub_mark):
     """Return set of stages that have at least one progress entry for this assembly/sub-assembly."""
-    db = _conn()
-    rows = db.execute(
-        "SELECT DISTINCT stage FROM progress "
-        "WHERE assembly_mark=? AND sub_assembly_mark=?",
-        (mark, sub_mark)
-    ).fetchall()
-    db.close()
+    with _conn() as db:
+        rows = db.execute(
+            "SELECT DISTINCT stage FROM progress "
+            "WHERE assembly_mark=? AND sub_assembly_mark=?",
+            (mark, sub_mark)
+        ).fetchall()
     return {r['stage'] for r in rows}
 
 
 def add_progress(entry_date, mark, sub_mark, stage, weight, qty, remarks, do_no=''):
-    db = _conn()
-    cur = db.execute(
-        "INSERT INTO progress (entry_date, assembly_mark, sub_assembly_mark, stage, "
-        "weight_kg, qty, remarks, delivery_order_no) VALUES (?, ?, ?, ?, ?, ?, ?, ?) RETURNING id",
-        (str(entry_date), mark, sub_mark, stage, float(weight), int(qty), remarks, do_no)
-    )
-    rid = cur.lastrowid
-    db.commit()
-    db.close()
+    with _conn() as db:
+        cur = db.execute(
+            "INSERT INTO progress (entry_date, assembly_mark, sub_assembly_mark, stage, "
+            "weight_kg, qty, remarks, delivery_order_no) VALUES (?, ?, ?, ?, ?, ?, ?, ?) RETURNING id",
+            (str(entry_date), mark, sub_mark, stage, float(weight), int(qty), remarks, do_no)
+        )
+        rid = cur.lastrowid
+        db.commit()
     return rid
 
 
@@ -900,76 +2881,70 @@ def add_progress_bulk(entries):
     """
     if not entries:
         return
-    conn = _conn()
-    rows = [
-        (str(e['date']), e['mark'], e['sub'], e['stage'],
-         float(e['weight']), int(e['qty']), e['remarks'], e['do_no'])
-        for e in entries
-    ]
-    psycopg2.extras.execute_values(
-        conn._conn.cursor(),
-        "INSERT INTO progress (entry_date, assembly_mark, sub_assembly_mark, stage, "
-        "weight_kg, qty, remarks, delivery_order_no) VALUES %s",
-        rows,
-    )
-    conn.commit()
-    conn.close()
+    with _conn() as conn:
+        rows = [
+            (str(e['date']), e['mark'], e['sub'], e['stage'],
+             float(e['weight']), int(e['qty']), e['remarks'], e['do_no'])
+            for e in entries
+        ]
+        psycopg2.extras.execute_values(
+            conn._conn.cursor(),
+            "INSERT INTO progress (entry_date, assembly_mark, sub_assembly_mark, stage, "
+            "weight_kg, qty, remarks, delivery_order_no) VALUES %s",
+            rows,
+        )
+        conn.commit()
 
 
 def delete_progress(rid):
-    db = _conn()
-    db.execute("DELETE FROM progress WHERE id = ?", (rid,))
-    db.commit()
-    db.close()
+    with _conn() as db:
+        db.execute("DELETE FROM progress WHERE id = ?", (rid,))
+        db.commit()
 
 
 def clear_all_data():
     """Delete all records from progress, parts, and assemblies tables."""
-    db = _conn()
-    db.execute("DELETE FROM progress")
-    db.execute("DELETE FROM parts")
-    db.execute("DELETE FROM assemblies")
-    db.commit()
-    db.close()
+    with _conn() as db:
+        db.execute("DELETE FROM progress")
+        db.execute("DELETE FROM parts")
+        db.execute("DELETE FROM assemblies")
+        db.commit()
 
 
 def get_by_date(d):
-    db = _conn()
-    rows = db.execute(
-        "SELECT p.*, a.total_weight_kg as asm_total FROM progress p "
-        "JOIN assemblies a ON p.assembly_mark = a.assembly_mark "
-        "WHERE p.entry_date = ? ORDER BY p.stage, p.assembly_mark",
-        (str(d),)
-    ).fetchall()
-    db.close()
+    with _conn() as db:
+        rows = db.execute(
+            "SELECT p.*, a.total_weight_kg as asm_total FROM progress p "
+            "JOIN assemblies a ON p.assembly_mark = a.assembly_mark "
+            "WHERE p.entry_date = ? ORDER BY p.stage, p.assembly_mark",
+            (str(d),)
+        ).fetchall()
     return [dict(r) for r in rows]
 
 
 def get_by_range(start, end):
-    db = _conn()
-    rows = db.execute(
-        "SELECT p.*, a.total_weight_kg as asm_total FROM progress p "
-        "JOIN assemblies a ON p.assembly_mark = a.assembly_mark "
-        "WHERE p.entry_date BETWEEN ? AND ? ORDER BY p.entry_date, p.stage, p.assembly_mark",
-        (str(start), str(end))
-    ).fetchall()
-    db.close()
+    with _conn() as db:
+        rows = db.execute(
+            "SELECT p.*, a.total_weight_kg as asm_total FROM progress p "
+            "JOIN assemblies a ON p.assembly_mark = a.assembly_mark "
+            "WHERE p.entry_date BETWEEN ? AND ? ORDER BY p.entry_date, p.stage, p.assembly_mark",
+            (str(start), str(end))
+        ).fetchall()
     return [dict(r) for r in rows]
 
 
 def get_cumulative():
-    db = _conn()
-    rows = db.execute("""
-        SELECT a.assembly_mark, a.total_weight_kg,
-            COALESCE(SUM(CASE WHEN p.stage='FIT UP'             THEN p.weight_kg END), 0) as fitup,
-            COALESCE(SUM(CASE WHEN p.stage='WELDING'            THEN p.weight_kg END), 0) as welding,
-            COALESCE(SUM(CASE WHEN p.stage='BLASTING & PAINTING' THEN p.weight_kg END), 0) as blasting,
-            COALESCE(SUM(CASE WHEN p.stage='SEND TO SITE'       THEN p.weight_kg END), 0) as sendsite
-        FROM assemblies a
-        LEFT JOIN progress p ON a.assembly_mark = p.assembly_mark
-        GROUP BY a.assembly_mark, a.total_weight_kg ORDER BY a.assembly_mark
-    """).fetchall()
-    db.close()
+    with _conn() as db:
+        rows = db.execute("""
+            SELECT a.assembly_mark, a.total_weight_kg,
+                COALESCE(SUM(CASE WHEN r.stage='FIT UP'             THEN r.kg END), 0) as fitup,
+                COALESCE(SUM(CASE WHEN r.stage='WELDING'            THEN r.kg END), 0) as welding,
+                COALESCE(SUM(CASE WHEN r.stage='BLASTING & PAINTING' THEN r.kg END), 0) as blasting,
+                COALESCE(SUM(CASE WHEN r.stage='SEND TO SITE'       THEN r.kg END), 0) as sendsite
+            FROM assemblies a
+            LEFT JOIN progress_rollup r ON a.assembly_mark = r.assembly_mark
+            GROUP BY a.assembly_mark, a.total_weight_kg ORDER BY a.assembly_mark
+        """).fetchall()
     return [dict(r) for r in rows]
 
 
@@ -977,93 +2952,42 @@ def get_cumulative_by_sub(work_order=None):
     """Progress grouped by (assembly, sub-assembly).
     Total weight comes from the sub-assembly's parts weight.
     Assemblies with no sub-assemblies fall back to assembly-level totals.
+    Stage sums are read from progress_rollup rather than raw progress.
     """
-    db = _conn()
-    params = []
-    wo_filter1 = ''
-    wo_filter2 = ''
-    if work_order:
-        wo_filter1 = 'AND a2.work_order = ?'
-        wo_filter2 = 'AND a.work_order = ?'
-        params = [work_order, work_order]
-    rows = db.execute(f"""
-        SELECT
-            sp.assembly_mark,
-            sp.sub_assembly_mark,
-            sp.work_order,
-            sp.priority,
-            sp.sub_weight AS total_weight_kg,
-            COALESCE(SUM(CASE WHEN p.stage='FIT UP'              THEN p.weight_kg END), 0) AS fitup,
-            COALESCE(SUM(CASE WHEN p.stage='WELDING'             THEN p.weight_kg END), 0) AS welding,
-            COALESCE(SUM(CASE WHEN p.stage='BLASTING & PAINTING' THEN p.weight_kg END), 0) AS blasting,
-            COALESCE(SUM(CASE WHEN p.stage='SEND TO SITE'        THEN p.weight_kg END), 0) AS sendsite,
-            MAX(CASE WHEN p.stage='BLASTING & PAINTING' THEN p.delivery_order_no END) AS blasting_do,
-            MAX(CASE WHEN p.stage='SEND TO SITE'        THEN p.delivery_order_no END) AS sendsite_do
-        FROM (
-            SELECT pt.assembly_mark, pt.sub_assembly_mark,
-                   a2.work_order, MAX(pt.priority) AS priority, SUM(pt.total_weight_kg) AS sub_weight
-            FROM parts pt
-            JOIN assemblies a2 ON pt.assembly_mark = a2.assembly_mark
-            WHERE pt.sub_assembly_mark != ''
-            {wo_filter1}
-            GROUP BY pt.assembly_mark, pt.sub_assembly_mark, a2.work_order
-        ) sp
-        LEFT JOIN progress p
-            ON sp.assembly_mark = p.assembly_mark
-           AND sp.sub_assembly_mark = p.sub_assembly_mark
-        GROUP BY sp.assembly_mark, sp.sub_assembly_mark, sp.work_order, sp.priority, sp.sub_weight
-
-        UNION ALL
-
-        SELECT
-            a.assembly_mark,
-            '' AS sub_assembly_mark,
-            a.work_order,
-            MAX(pt2.priority) AS priority,
-            a.total_weight_kg,
-            COALESCE(SUM(CASE WHEN p.stage='FIT UP'              THEN p.weight_kg END), 0) AS fitup,
-            COALESCE(SUM(CASE WHEN p.stage='WELDING'             THEN p.weight_kg END), 0) AS welding,
-            COALESCE(SUM(CASE WHEN p.stage='BLASTING & PAINTING' THEN p.weight_kg END), 0) AS blasting,
-            COALESCE(SUM(CASE WHEN p.stage='SEND TO SITE'        THEN p.weight_kg END), 0) AS sendsite,
-            MAX(CASE WHEN p.stage='BLASTING & PAINTING' THEN p.delivery_order_no END) AS blasting_do,
-            MAX(CASE WHEN p.stage='SEND TO SITE'        THEN p.delivery_order_no END) AS sendsite_do
-        FROM assemblies a
-        LEFT JOIN parts pt2 ON a.assembly_mark = pt2.assembly_mark
-        LEFT JOIN progress p ON a.assembly_mark = p.assembly_mark
-        WHERE a.assembly_mark NOT IN (
-            SELECT DISTINCT assembly_mark FROM parts WHERE sub_assembly_mark != ''
-        )
-        {wo_filter2}
-        GROUP BY a.assembly_mark, a.work_order, a.total_weight_kg
-        ORDER BY 1, 2
-    """, params).fetchall()
-    db.close()
+    with _conn() as db:
+        params = []
+        wo_filter1 = ''
+        wo_filter2 = ''
+        if work_order:
+            wo_filter1 = 'AND a2.work_order = ?'
+            wo_filter2 = 'AND a.work_order = ?'
+            params = [work_order, work_order]
+        rows = db.execute(
+            _CUMULATIVE_BY_SUB.format(wo_filter1=wo_filter1, wo_filter2=wo_filter2), params
+        ).fetchall()
     return [dict(r) for r in rows]
 
 
 def get_daily_production():
     """Return kg produced per entry_date per stage — for trend and S-curve charts."""
-    c = _conn()
-    rows = c.execute("""
-        SELECT entry_date, stage, COALESCE(SUM(weight_kg), 0) AS kg
-        FROM progress
-        GROUP BY entry_date, stage
-        ORDER BY entry_date, stage
-    """).fetchall()
-    c.close()
+    with _conn() as c:
+        rows = c.execute("""
+            SELECT entry_date, stage, kg
+            FROM daily_stage_totals
+            ORDER BY entry_date, stage
+        """).fetchall()
     return [dict(r) for r in rows]
 
 
 def get_daily_manhours():
     """Return total manhours per entry_date from manpower_detail."""
-    c = _conn()
-    rows = c.execute("""
-        SELECT entry_date, shift, COALESCE(SUM(count), 0) AS headcount
-        FROM manpower_detail
-        GROUP BY entry_date, shift
-        ORDER BY entry_date
-    """).fetchall()
-    c.close()
+    with _conn() as c:
+        rows = c.execute("""
+            SELECT entry_date, shift, COALESCE(SUM(count), 0) AS headcount
+            FROM manpower_detail
+            GROUP BY entry_date, shift
+            ORDER BY entry_date
+        """).fetchall()
     result = {}
     for r in rows:
         d = r['entry_date']
@@ -1073,16 +2997,14 @@ def get_daily_manhours():
 
 def get_stage_daily_stats():
     """Return total_kg and unique day count per stage — single aggregate query."""
-    c = _conn()
-    rows = c.execute("""
-        SELECT p.stage,
-               COALESCE(SUM(p.weight_kg), 0)        AS total_kg,
-               COUNT(DISTINCT p.entry_date)          AS days
-        FROM progress p
-        JOIN assemblies a ON p.assembly_mark = a.assembly_mark
-        GROUP BY p.stage
-    """).fetchall()
-    c.close()
+    with _conn() as c:
+        rows = c.execute("""
+            SELECT stage,
+                   COALESCE(SUM(kg), 0) AS total_kg,
+                   COUNT(*)             AS days
+            FROM daily_stage_totals
+            GROUP BY stage
+        """).fetchall()
     result = {}
     for r in rows:
         days  = r['days']     or 0
@@ -1096,231 +3018,307 @@ def get_stage_daily_stats():
 
 
 def get_summary(as_of_date=None):
-    db = _conn()
-    total = db.execute(
-        "SELECT COALESCE(SUM(total_weight_kg),0) AS total FROM assemblies"
-    ).fetchone()['total']
-    if as_of_date:
-        rows = db.execute(
-            "SELECT p.stage, COALESCE(SUM(p.weight_kg),0) as done "
-            "FROM progress p JOIN assemblies a ON p.assembly_mark = a.assembly_mark "
-            "WHERE p.entry_date <= ? "
-            "GROUP BY p.stage",
-            (str(as_of_date),)
-        ).fetchall()
-    else:
-        rows = db.execute(
-            "SELECT p.stage, COALESCE(SUM(p.weight_kg),0) as done "
-            "FROM progress p JOIN assemblies a ON p.assembly_mark = a.assembly_mark "
-            "GROUP BY p.stage"
-        ).fetchall()
-    db.close()
+    with _conn() as db:
+        total = db.execute(
+            "SELECT COALESCE(SUM(total_weight_kg),0) AS total FROM assemblies"
+        ).fetchone()['total']
+        if as_of_date:
+            rows = db.execute(
+                "SELECT stage, COALESCE(SUM(kg),0) as done FROM daily_stage_totals "
+                "WHERE entry_date <= ? GROUP BY stage",
+                (str(as_of_date),)
+            ).fetchall()
+        else:
+            rows = db.execute(
+                "SELECT stage, COALESCE(SUM(kg),0) as done FROM daily_stage_totals GROUP BY stage"
+            ).fetchall()
     result = {'total': total}
     for r in rows:
         result[r['stage']] = r['done']
     return result
 
 
+@dataclass(frozen=True)
+class DashboardSnapshot:
+    """Headline numbers shared by the Report, Progress and Summary pages."""
+    as_of_date:       str     # None means all dates
+    total_kg:         float   # sum of assembly weights
+    done_kg:          dict    # stage -> kg recorded up to as_of_date
+    stage_stats:      dict    # stage -> {'total_kg', 'days', 'avg_per_day'}, all dates
+    on_hold_kg:       float
+    vi_entries:       int
+    vi_kg:            float
+    painting_done_kg: float   # B&P kg marked painting_done, up to as_of_date
+
+    def pct(self, stage):
+        """Percent of total_kg done for stage, capped at 100."""
+        return min(self.done_kg[stage] / self.total_kg * 100, 100) if self.total_kg else 0
+
+
+# one statement for everything in DashboardSnapshot; ? is as_of_date (or NULL)
+_DASHBOARD_SNAPSHOT = """
+    WITH asm AS (
+        SELECT COALESCE(SUM(total_weight_kg), 0) AS total_kg FROM assemblies
+    ), done AS (
+        SELECT stage, SUM(kg) AS kg FROM daily_stage_totals
+        WHERE ?::date IS NULL OR entry_date <= ?::date
+        GROUP BY stage
+    ), stats AS (
+        SELECT stage, SUM(kg) AS total_kg, COUNT(*) AS days FROM daily_stage_totals GROUP BY stage
+    ), hold AS (
+        SELECT COALESCE(SUM(total_weight_kg), 0) AS kg FROM parts
+        WHERE UPPER(remark) LIKE '%%ON HOLD%%' OR UPPER(remark) LIKE '%%ON-HOLD%%'
+    ), vi AS (
+        SELECT COUNT(*) AS entries, COALESCE(SUM(weight_kg), 0) AS kg FROM visual_inspection
+    ), paint AS (
+        SELECT COALESCE(SUM(weight_kg), 0) AS kg FROM progress
+        WHERE stage = 'BLASTING & PAINTING' AND painting_done = TRUE
+          AND (?::date IS NULL OR entry_date <= ?::date)
+    )
+    SELECT asm.total_kg, hold.kg AS on_hold_kg, vi.entries AS vi_entries, vi.kg AS vi_kg,
+           paint.kg AS painting_done_kg,
+           (SELECT COALESCE(json_object_agg(stage, kg), '{}') FROM done) AS done,
+           (SELECT COALESCE(json_object_agg(stage, json_build_array(total_kg, days)), '{}')
+              FROM stats) AS stats
+    FROM asm, hold, vi, paint
+"""
+
+
+def get_dashboard_snapshot(as_of_date=None):
+    """All headline numbers in one round trip; see DashboardSnapshot."""
+    d = str(as_of_date) if as_of_date else None
+    with _conn() as db:
+        r = db.execute(_DASHBOARD_SNAPSHOT, (d, d, d, d)).fetchone()
+    stage_stats = {}
+    for stage, (total, days) in r['stats'].items():
+        stage_stats[stage] = {'total_kg': total, 'days': days,
+                              'avg_per_day': total / days if days else 0}
+    return DashboardSnapshot(
+        as_of_date=d,
+        total_kg=float(r['total_kg']),
+        done_kg={s: float(r['done'].get(s, 0)) for s in STAGES},
+        stage_stats=stage_stats,
+        on_hold_kg=float(r['on_hold_kg']),
+        vi_entries=int(r['vi_entries']),
+        vi_kg=float(r['vi_kg']),
+        painting_done_kg=float(r['painting_done_kg']),
+    )
+
+
 def get_all_daily_stage_totals():
     """Return list of {entry_date, stage, kg} for every date+stage that has progress.
-    Used by the Report tab to compute both cumulative and daily totals in Python,
-    avoiding a new DB round-trip each time the user changes the selected date."""
-    db = _conn()
-    rows = db.execute(
-        "SELECT p.entry_date, p.stage, COALESCE(SUM(p.weight_kg),0) AS kg "
-        "FROM progress p JOIN assemblies a ON p.assembly_mark = a.assembly_mark "
-        "GROUP BY p.entry_date, p.stage"
-    ).fetchall()
-    db.close()
+    Read from daily_stage_totals; see StagePrefixSums for as-of lookups."""
+    with _conn() as db:
+        rows = db.execute(
+            "SELECT entry_date, stage, kg FROM daily_stage_totals"
+        ).fetchall()
     return [{'entry_date': str(r['entry_date']), 'stage': r['stage'], 'kg': float(r['kg'] or 0)} for r in rows]
 
 
 def get_on_hold_weight():
     """Total weight_kg of parts whose remark contains 'on hold' (case-insensitive)."""
-    db = _conn()
-    row = db.execute(
-        "SELECT COALESCE(SUM(total_weight_kg), 0) AS kg "
-        "FROM parts WHERE UPPER(remark) LIKE ? OR UPPER(remark) LIKE ?",
-        ('%ON HOLD%', '%ON-HOLD%')
-    ).fetchone()
-    db.close()
+    with _conn() as db:
+        row = db.execute(
+            "SELECT COALESCE(SUM(total_weight_kg), 0) AS kg "
+            "FROM parts WHERE UPPER(remark) LIKE ? OR UPPER(remark) LIKE ?",
+            ('%ON HOLD%', '%ON-HOLD%')
+        ).fetchone()
     return row['kg'] if row else 0
 
 
 def get_sub_assemblies(assembly_mark):
     """Return distinct sub-assembly marks for a given assembly."""
-    db = _conn()
-    rows = db.execute(
-        "SELECT DISTINCT sub_assembly_mark FROM parts "
-        "WHERE assembly_mark = ? AND sub_assembly_mark != '' "
-        "ORDER BY sub_assembly_mark",
-        (assembly_mark,)
-    ).fetchall()
-    db.close()
+    with _conn() as db:
+        rows = db.execute(
+            "SELECT DISTINCT sub_assembly_mark FROM parts "
+            "WHERE assembly_mark = ? AND sub_assembly_mark != '' "
+            "ORDER BY sub_assembly_mark",
+            (assembly_mark,)
+        ).fetchall()
     return [r['sub_assembly_mark'] for r in rows]
 
 
 def get_deliveries():
-    db = _conn()
-    rows = db.execute(
-        "SELECT p.id, p.entry_date, a.work_order, p.assembly_mark, p.sub_assembly_mark, p.stage, "
-        "p.delivery_order_no, p.weight_kg, p.qty, p.remarks, "
-        "COALESCE(p.painting_done, FALSE) AS painting_done "
-        "FROM progress p "
-        "JOIN assemblies a ON p.assembly_mark = a.assembly_mark "
-        "WHERE p.stage IN ('BLASTING & PAINTING','SEND TO SITE') "
-        "ORDER BY p.entry_date DESC, p.assembly_mark"
-    ).fetchall()
-    db.close()
+    with _conn() as db:
+        rows = db.execute(
+            "SELECT p.id, p.entry_date, a.work_order, p.assembly_mark, p.sub_assembly_mark, p.stage, "
+            "p.delivery_order_no, p.weight_kg, p.qty, p.remarks, "
+            "COALESCE(p.painting_done, FALSE) AS painting_done "
+            "FROM progress p "
+            "JOIN assemblies a ON p.assembly_mark = a.assembly_mark "
+            "WHERE p.stage IN ('BLASTING & PAINTING','SEND TO SITE') "
+            "ORDER BY p.entry_date DESC, p.assembly_mark"
+        ).fetchall()
     return [dict(r) for r in rows]
 
 
 def set_painting_done(progress_id, done: bool):
-    db = _conn()
-    db.execute("UPDATE progress SET painting_done = ? WHERE id = ?", (done, progress_id))
-    db.commit()
-    db.close()
+    with _conn() as db:
+        db.execute("UPDATE progress SET painting_done = ? WHERE id = ?", (done, progress_id))
+        db.commit()
 
 
 def get_painting_done_kg(up_to_date: str = None):
     """Total weight_kg of B&P entries marked painting_done, optionally up to a date."""
-    db = _conn()
-    if up_to_date:
-        row = db.execute(
-            "SELECT COALESCE(SUM(weight_kg), 0) AS kg FROM progress "
-            "WHERE stage = 'BLASTING & PAINTING' AND painting_done = TRUE "
-            "AND entry_date <= ?", (up_to_date,)
-        ).fetchone()
-    else:
-        row = db.execute(
-            "SELECT COALESCE(SUM(weight_kg), 0) AS kg FROM progress "
-            "WHERE stage = 'BLASTING & PAINTING' AND painting_done = TRUE"
-        ).fetchone()
-    db.close()
+    with _conn() as db:
+        if up_to_date:
+            row = db.execute(
+                "SELECT COALESCE(SUM(weight_kg), 0) AS kg FROM progress "
+                "WHERE stage = 'BLASTING & PAINTING' AND painting_done = TRUE "
+                "AND entry_date <= ?", (up_to_date,)
+            ).fetchone()
+        else:
+            row = db.execute(
+                "SELECT COALESCE(SUM(weight_kg), 0) AS kg FROM progress "
+                "WHERE stage = 'BLASTING & PAINTING' AND painting_done = TRUE"
+            ).fetchone()
     return float(row['kg']) if row else 0.0
 
 
 def set_painting_done_by_do(do_no: str, done: bool):
-    db = _conn()
-    db.execute(
-        "UPDATE progress SET painting_done = ? "
-        "WHERE stage = 'BLASTING & PAINTING' AND delivery_order_no = ?",
-        (done, do_no)
-    )
-    db.commit()
-    db.close()
+    with _conn() as db:
+        db.execute(
+            "UPDATE progress SET painting_done = ? "
+            "WHERE stage = 'BLASTING & PAINTING' AND delivery_order_no = ?",
+            (done, do_no)
+        )
+        db.commit()
 
 
 def get_parts(assembly_mark=None):
-    db = _conn()
-    if assembly_mark:
-        rows = db.execute(
-            "SELECT * FROM parts WHERE assembly_mark = ? "
-            "ORDER BY assembly_mark, part_mark", (assembly_mark,)
-        ).fetchall()
-    else:
-        rows = db.execute(
-            "SELECT * FROM parts ORDER BY assembly_mark, part_mark"
-        ).fetchall()
-    db.close()
+    with _conn() as db:
+        if assembly_mark:
+            rows = db.execute(
+                "SELECT * FROM parts WHERE assembly_mark = ? "
+                "ORDER BY assembly_mark, part_mark", (assembly_mark,)
+            ).fetchall()
+        else:
+            rows = db.execute(
+                "SELECT * FROM parts ORDER BY assembly_mark, part_mark"
+            ).fetchall()
     return [dict(r) for r in rows]
 
 
 def get_master_export():
     """Parts table joined with cumulative progress per (assembly, sub-assembly)."""
-    db = _conn()
-    rows = db.execute("""
-        SELECT
-            p.priority             AS "Priority",
-            a.work_order           AS "Work Order",
-            p.assembly_mark        AS "Assembly Mark",
-            p.sub_assembly_mark    AS "Sub Assembly",
-            p.part_mark            AS "Part Mark",
-            p.no                   AS "No.",
-            p.name                 AS "Name",
-            p.profile              AS "Profile",
-            p.kg_per_m             AS "kg/m",
-            p.length_mm            AS "Length (mm)",
-            p.total_weight_kg      AS "Weight (kg)",
-            p.profile2             AS "Profile 2",
-            p.grade                AS "Grade",
-            p.remark               AS "Remark",
-            CASE WHEN pr.fitup_done    = 1 THEN p.total_weight_kg ELSE 0 END AS "FIT UP (kg)",
-            pr.fitup_dates                                                   AS "FIT UP Date",
-            CASE WHEN pr.welding_done  = 1 THEN p.total_weight_kg ELSE 0 END AS "WELDING (kg)",
-            pr.welding_dates                                                 AS "WELDING Date",
-            CASE WHEN pr.blasting_done = 1 THEN p.total_weight_kg ELSE 0 END AS "BLASTING & PAINTING (kg)",
-            pr.blasting_dates                                                AS "BLASTING & PAINTING Date",
-            pr.blasting_do                                                   AS "BLASTING & PAINTING D.O. No.",
-            CASE WHEN pr.sendsite_done = 1 THEN p.total_weight_kg ELSE 0 END AS "SEND TO SITE (kg)",
-            pr.sendsite_dates                                                AS "SEND TO SITE Date",
-            pr.sendsite_do                                                   AS "SEND TO SITE D.O. No."
-        FROM parts p
-        JOIN assemblies a ON p.assembly_mark = a.assembly_mark
-        LEFT JOIN (
+    with _conn() as db:
+        rows = db.execute("""
             SELECT
-                assembly_mark,
-                sub_assembly_mark,
-                MAX(CASE WHEN stage='FIT UP'              THEN 1 ELSE 0 END) AS fitup_done,
-                MAX(CASE WHEN stage='WELDING'             THEN 1 ELSE 0 END) AS welding_done,
-                MAX(CASE WHEN stage='BLASTING & PAINTING' THEN 1 ELSE 0 END) AS blasting_done,
-                MAX(CASE WHEN stage='SEND TO SITE'        THEN 1 ELSE 0 END) AS sendsite_done,
-                STRING_AGG(CASE WHEN stage='FIT UP'              THEN entry_date END, ',') AS fitup_dates,
-                STRING_AGG(CASE WHEN stage='WELDING'             THEN entry_date END, ',') AS welding_dates,
-                STRING_AGG(CASE WHEN stage='BLASTING & PAINTING' THEN entry_date END, ',') AS blasting_dates,
-                STRING_AGG(CASE WHEN stage='SEND TO SITE'        THEN entry_date END, ',') AS sendsite_dates,
-                MAX(CASE WHEN stage='BLASTING & PAINTING' THEN delivery_order_no END)      AS blasting_do,
-                MAX(CASE WHEN stage='SEND TO SITE'        THEN delivery_order_no END)      AS sendsite_do
-            FROM progress
-            GROUP BY assembly_mark, sub_assembly_mark
-        ) pr ON p.assembly_mark = pr.assembly_mark
-             AND p.sub_assembly_mark = pr.sub_assembly_mark
-        ORDER BY p.assembly_mark, p.sub_assembly_mark, p.part_mark
-    """).fetchall()
-    db.close()
+                p.priority             AS "Priority",
+                a.work_order           AS "Work Order",
+                p.assembly_mark        AS "Assembly Mark",
+                p.sub_assembly_mark    AS "Sub Assembly",
+                p.part_mark            AS "Part Mark",
+                p.no                   AS "No.",
+                p.name                 AS "Name",
+                p.profile              AS "Profile",
+                p.kg_per_m             AS "kg/m",
+                p.length_mm            AS "Length (mm)",
+                p.total_weight_kg      AS "Weight (kg)",
+                p.profile2             AS "Profile 2",
+                p.grade                AS "Grade",
+                p.remark               AS "Remark",
+                CASE WHEN pr.fitup_done    = 1 THEN p.total_weight_kg ELSE 0 END AS "FIT UP (kg)",
+                pr.fitup_dates                                                   AS "FIT UP Date",
+                CASE WHEN pr.welding_done  = 1 THEN p.total_weight_kg ELSE 0 END AS "WELDING (kg)",
+                pr.welding_dates                                                 AS "WELDING Date",
+                CASE WHEN pr.blasting_done = 1 THEN p.total_weight_kg ELSE 0 END AS "BLASTING & PAINTING (kg)",
+                pr.blasting_dates                                                AS "BLASTING & PAINTING Date",
+                pr.blasting_do                                                   AS "BLASTING & PAINTING D.O. No.",
+                CASE WHEN pr.sendsite_done = 1 THEN p.total_weight_kg ELSE 0 END AS "SEND TO SITE (kg)",
+                pr.sendsite_dates                                                AS "SEND TO SITE Date",
+                pr.sendsite_do                                                   AS "SEND TO SITE D.O. No."
+            FROM parts p
+            JOIN assemblies a ON p.assembly_mark = a.assembly_mark
+            LEFT JOIN (
+                SELECT
+                    assembly_mark,
+                    sub_assembly_mark,
+                    MAX(CASE WHEN stage='FIT UP'              THEN 1 ELSE 0 END) AS fitup_done,
+                    MAX(CASE WHEN stage='WELDING'             THEN 1 ELSE 0 END) AS welding_done,
+                    MAX(CASE WHEN stage='BLASTING & PAINTING' THEN 1 ELSE 0 END) AS blasting_done,
+                    MAX(CASE WHEN stage='SEND TO SITE'        THEN 1 ELSE 0 END) AS sendsite_done,
+                    STRING_AGG(CASE WHEN stage='FIT UP'              THEN entry_date::text END, ',') AS fitup_dates,
+                    STRING_AGG(CASE WHEN stage='WELDING'             THEN entry_date::text END, ',') AS welding_dates,
+                    STRING_AGG(CASE WHEN stage='BLASTING & PAINTING' THEN entry_date::text END, ',') AS blasting_dates,
+                    STRING_AGG(CASE WHEN stage='SEND TO SITE'        THEN entry_date::text END, ',') AS sendsite_dates,
+                    MAX(CASE WHEN stage='BLASTING & PAINTING' THEN delivery_order_no END)      AS blasting_do,
+                    MAX(CASE WHEN stage='SEND TO SITE'        THEN delivery_order_no END)      AS sendsite_do
+                FROM progress
+                GROUP BY assembly_mark, sub_assembly_mark
+            ) pr ON p.assembly_mark = pr.assembly_mark
+                 AND p.sub_assembly_mark = pr.sub_assembly_mark
+            ORDER BY p.assembly_mark, p.sub_assembly_mark, p.part_mark
+        """).fetchall()
     return [dict(r) for r in rows]
 
 
 def get_parts_summary(assembly_mark):
     """Return part count and total weight for an assembly."""
-    db = _conn()
-    row = db.execute(
-        "SELECT COUNT(*) as cnt, COALESCE(SUM(total_weight_kg),0) as total "
-        "FROM parts WHERE assembly_mark = ?", (assembly_mark,)
-    ).fetchone()
-    db.close()
+    with _conn() as db:
+        row = db.execute(
+            "SELECT COUNT(*) as cnt, COALESCE(SUM(total_weight_kg),0) as total "
+            "FROM parts WHERE assembly_mark = ?", (assembly_mark,)
+        ).fetchone()
     return dict(row) if row else {'cnt': 0, 'total': 0}
 
 
-def search_parts(keyword='', assembly_mark=None):
-    """Search parts by keyword across all text columns."""
-    db = _conn()
-    kw = f'%{keyword}%'
+_pg_trgm = None   # cached: is the pg_trgm extension installed?
+
+
+def _has_pg_trgm(db):
+    global _pg_trgm
+    if _pg_trgm is None:
+        _pg_trgm = db.execute(
+            "SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') AS ok"
+        ).fetchone()['ok']
+    return _pg_trgm
+
+
+def search_parts(keyword='', assembly_mark=None, limit=None):
+    """Search parts by keyword across all text columns.
+    With limit, returns the best `limit` matches for type-ahead: exact marks
+    first, then by trigram word similarity.
+    """
+    keyword = (keyword or '').strip()
+    conditions, params = [], []
     if assembly_mark:
-        rows = db.execute("""
-            SELECT * FROM parts
-            WHERE assembly_mark = ?
-              AND (assembly_mark ILIKE ? OR sub_assembly_mark ILIKE ? OR part_mark ILIKE ?
-                   OR name ILIKE ? OR profile ILIKE ? OR profile2 ILIKE ? OR grade ILIKE ?)
-            ORDER BY assembly_mark, part_mark
-        """, (assembly_mark, kw, kw, kw, kw, kw, kw, kw)).fetchall()
-    else:
-        rows = db.execute("""
-            SELECT * FROM parts
-            WHERE (assembly_mark ILIKE ? OR sub_assembly_mark ILIKE ? OR part_mark ILIKE ?
-                   OR name ILIKE ? OR profile ILIKE ? OR profile2 ILIKE ? OR grade ILIKE ?)
-            ORDER BY assembly_mark, part_mark
-        """, (kw, kw, kw, kw, kw, kw, kw)).fetchall()
-    db.close()
+        conditions.append("assembly_mark = ?")
+        params.append(assembly_mark)
+    if keyword:
+        conditions.append(f"{_PARTS_SEARCH_EXPR} ILIKE ?")
+        params.append(f'%{keyword}%')
+    where = " AND ".join(conditions) or "TRUE"
+    with _conn() as db:
+        if limit and keyword:
+            if _has_pg_trgm(db):
+                relevance = f"word_similarity(?, {_PARTS_SEARCH_EXPR}) DESC"
+            else:   # earliest match first
+                relevance = f"STRPOS(LOWER({_PARTS_SEARCH_EXPR}), LOWER(?))"
+            rows = db.execute(f"""
+                SELECT * FROM parts
+                WHERE {where}
+                ORDER BY (LOWER(part_mark) = LOWER(?) OR LOWER(assembly_mark) = LOWER(?)) DESC,
+                         {relevance}, assembly_mark, part_mark
+                LIMIT ?
+            """, params + [keyword, keyword, keyword, limit]).fetchall()
+        else:
+            rows = db.execute(f"""
+                SELECT * FROM parts
+                WHERE {where}
+                ORDER BY assembly_mark, part_mark
+                {'LIMIT ?' if limit else ''}
+            """, params + ([limit] if limit else [])).fetchall()
     return [dict(r) for r in rows]
 
 
-def search_progress(keyword='', stage=None, assembly_mark=None, start=None, end=None, work_order=None):
-    """Search progress entries by keyword, stage, assembly, date range, and/or work_order."""
-    db = _conn()
-    kw = f'%{keyword}%'
-    conditions = ["(p.assembly_mark ILIKE ? OR p.remarks ILIKE ?)"]
-    params = [kw, kw]
+def _progress_filters(keyword='', stage=None, assembly_mark=None, start=None, end=None, work_order=None):
+    """WHERE conditions and params over progress p JOIN assemblies a."""
+    conditions, params = [], []
+    keyword = (keyword or '').strip()
+    if keyword:   # trigram-indexed; a blank keyword adds no predicate at all
+        conditions.append("(p.assembly_mark ILIKE ? OR p.remarks ILIKE ?)")
+        params += [f'%{keyword}%'] * 2
     if stage:
         conditions.append("p.stage = ?")
         params.append(stage)
@@ -1336,18 +3334,49 @@ def search_progress(keyword='', stage=None, assembly_mark=None, start=None, end=
     if work_order:
         conditions.append("a.work_order = ?")
         params.append(work_order)
-    where = " AND ".join(conditions)
-    rows = db.execute(f"""
-        SELECT p.*, a.total_weight_kg as asm_total, a.work_order
-        FROM progress p
-        JOIN assemblies a ON p.assembly_mark = a.assembly_mark
-        WHERE {where}
-        ORDER BY p.entry_date DESC, p.stage, p.assembly_mark
-    """, params).fetchall()
-    db.close()
+    return conditions, params
+
+
+def search_progress(keyword='', stage=None, assembly_mark=None, start=None, end=None, work_order=None):
+    """Search progress entries by keyword, stage, assembly, date range, and/or work_order."""
+    conditions, params = _progress_filters(keyword, stage, assembly_mark, start, end, work_order)
+    with _conn() as db:
+        where = " AND ".join(conditions) or "TRUE"
+        rows = db.execute(f"""
+            SELECT p.*, a.total_weight_kg as asm_total, a.work_order
+            FROM progress p
+            JOIN assemblies a ON p.assembly_mark = a.assembly_mark
+            WHERE {where}
+            ORDER BY p.entry_date DESC, p.stage, p.assembly_mark
+        """, params).fetchall()
     return [dict(r) for r in rows]
 
 
+def search_progress_page(keyword='', stage=None, assembly_mark=None, start=None, end=None,
+                         work_order=None, after=None, before=None, limit=None):
+    """Keyset-paginated search_progress(), ordered by entry_date, id (newest first)."""
+    conditions, params = _progress_filters(keyword, stage, assembly_mark, start, end, work_order)
+    with _conn() as db:
+        return _keyset_page(db, 'p.*, a.total_weight_kg AS asm_total, a.work_order',
+                            'progress p JOIN assemblies a ON p.assembly_mark = a.assembly_mark',
+                            conditions, params, 'p.entry_date', 'p.id',
+                            after=after, before=before, limit=limit)
+
+
+def search_progress_totals(keyword='', stage=None, assembly_mark=None, start=None, end=None, work_order=None):
+    """kg per stage over everything search_progress() would return."""
+    conditions, params = _progress_filters(keyword, stage, assembly_mark, start, end, work_order)
+    with _conn() as db:
+        rows = db.execute(f"""
+            SELECT p.stage, COALESCE(SUM(p.weight_kg), 0) AS kg
+            FROM progress p
+            JOIN assemblies a ON p.assembly_mark = a.assembly_mark
+            WHERE {" AND ".join(conditions) or "TRUE"}
+            GROUP BY p.stage
+        """, params).fetchall()
+    return {r['stage']: r['kg'] for r in rows}
+
+
 def export_csv(rows, path):
     import csv
     if not rows:
@@ -1390,60 +3419,339 @@ def export_excel(rows, path):
     wb.save(path)
 
 
+# ── Mark index ─────────────────────────────────────────────────────────────────
+
+def _trigrams(term):
+    padded = f'  {term} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class MarkIndex:
+    """In-memory lookup over assembly, sub-assembly and part marks.
+
+    Membership is a dict probe, prefix search a bisect over the sorted
+    upper-cased terms, and fuzzy search a trigram vote re-ranked with
+    difflib. add() / remove() keep it current after an import without a
+    rebuild; all methods are safe to call from several sessions at once.
+    Search results are (assembly_mark, sub_assembly_mark) targets, with ''
+    for the whole assembly.
+    """
+
+    def __init__(self, assemblies=(), parts=()):
+        self._lock  = threading.Lock()
+        self._subs  = {}   # assembly mark -> Counter of sub mark -> part rows
+        self._terms = {}   # upper-cased term -> Counter of target -> references
+        self._keys  = []   # sorted _terms keys
+        self._grams = {}   # trigram -> set of terms
+        self._marks = None # sorted assembly marks, rebuilt on demand
+        self.add(assemblies, parts)
+
+    # ── Maintenance ───────────────────────────────────────────────────────────
+
+    def add(self, assemblies=(), parts=()):
+        """Index assembly marks and (assembly, sub, part) part rows."""
+        with self._lock:
+            new_terms = []
+            for mark in assemblies:
+                if mark not in self._subs:
+                    self._subs[mark] = Counter()
+                    self._ref(mark, (mark, ''), 1, new_terms)
+            for mark, sub, part in parts:
+                sub, part = sub or '', part or ''
+                if mark not in self._subs:   # parts only ever hang off an assembly
+                    self._subs[mark] = Counter()
+                    self._ref(mark, (mark, ''), 1, new_terms)
+                self._subs[mark][sub] += 1
+                if sub:
+                    self._ref(sub, (mark, sub), 1, new_terms)
+                if part:
+                    self._ref(part, (mark, sub), 1, new_terms)
+            if len(new_terms) > 64:
+                self._keys = sorted(self._terms)
+            else:
+                for term in new_terms:
+                    insort(self._keys, term)
+            self._marks = None
+
+    def remove(self, assemblies=(), parts=()):
+        """Drop part rows, then whole assemblies (with any parts left under them)."""
+        with self._lock:
+            for mark, sub, part in parts:
+                sub, part = sub or '', part or ''
+                subs = self._subs.get(mark)
+                if not subs or not subs[sub]:
+                    continue
+                subs[sub] -= 1
+                if not subs[sub]:
+                    del subs[sub]
+                if sub:
+                    self._ref(sub, (mark, sub), -1)
+                if part:
+                    self._ref(part, (mark, sub), -1)
+            gone = {m for m in assemblies if self._subs.pop(m, None) is not None}
+            if gone:   # one pass over the terms, however many assemblies go
+                for term in list(self._terms):
+                    for target, n in [(t, n) for t, n in self._terms[term].items() if t[0] in gone]:
+                        self._ref(term, target, -n)
+            self._marks = None
+
+    def _ref(self, term, target, delta, new_terms=None):
+        key = term.upper()
+        targets = self._terms.get(key)
+        if targets is None:
+            if delta <= 0:
+                return
+            targets = self._terms[key] = Counter()
+            for g in _trigrams(key):
+                self._grams.setdefault(g, set()).add(key)
+            new_terms.append(key)
+        targets[target] += delta
+        if targets[target] <= 0:
+            del targets[target]
+        if not targets:
+            del self._terms[key]
+            i = bisect_left(self._keys, key)
+            if i < len(self._keys) and self._keys[i] == key:
+                del self._keys[i]
+            for g in _trigrams(key):
+                terms = self._grams.get(g)
+                if terms is not None:
+                    terms.discard(key)
+                    if not terms:
+                        del self._grams[g]
+
+    # ── Lookup ────────────────────────────────────────────────────────────────
+
+    def __contains__(self, mark):
+        return mark in self._subs
+
+    def __len__(self):
+        return len(self._subs)
+
+    def has(self, mark, sub=''):
+        """True if the assembly exists and, when sub is given, has that sub-assembly."""
+        subs = self._subs.get(mark)
+        return subs is not None and (not sub or subs[sub] > 0)
+
+    def marks(self):
+        """All assembly marks, sorted."""
+        with self._lock:
+            if self._marks is None:
+                self._marks = sorted(self._subs)
+            return self._marks
+
+    def subs(self, mark):
+        """Non-empty sub-assembly marks under an assembly, sorted."""
+        with self._lock:
+            return sorted(s for s in self._subs.get(mark, ()) if s)
+
+    def prefix(self, text, limit=20):
+        """Targets whose assembly, sub or part mark starts with text (case-insensitive)."""
+        key = (text or '').strip().upper()
+        if not key:
+            return []
+        out = {}
+        with self._lock:
+            i = bisect_left(self._keys, key)
+            while i < len(self._keys) and self._keys[i].startswith(key) and len(out) < limit:
+                for target in sorted(self._terms[self._keys[i]]):
+                    out.setdefault(target, None)
+                i += 1
+        return list(out)[:limit]
+
+    def fuzzy(self, text, limit=10, cutoff=0.6):
+        """Typo-tolerant matches, best first; candidates share trigrams with text."""
+        from difflib import SequenceMatcher
+        key = (text or '').strip().upper()
+        if not key:
+            return []
+        with self._lock:
+            votes = Counter()
+            for g in _trigrams(key):
+                votes.update(self._grams.get(g, ()))
+            scored = []
+            # short marks share few trigrams, so rank a wide pool by edit ratio
+            for term, _ in votes.most_common(max(200, limit * 50)):
+                m = SequenceMatcher(None, key, term)
+                if m.real_quick_ratio() >= cutoff and m.quick_ratio() >= cutoff:
+                    score = m.ratio()
+                    if score >= cutoff:
+                        scored.append((-score, term))
+            scored.sort()
+            out = {}
+            for _, term in scored:
+                for target in sorted(self._terms[term]):
+                    out.setdefault(target, None)
+        return list(out)[:limit]
+
+    def search(self, text, limit=10):
+        """Prefix matches first, then fuzzy ones — for quick-find boxes."""
+        out = dict.fromkeys(self.prefix(text, limit))
+        if len(out) < limit:
+            out.update(dict.fromkeys(self.fuzzy(text, limit)))
+        return list(out)[:limit]
+
+
+def get_mark_index():
+    """MarkIndex over every assembly and part row (two narrow scans)."""
+    with _conn() as db:
+        assemblies = [r['assembly_mark'] for r in
+                      db.execute("SELECT assembly_mark FROM assemblies").fetchall()]
+        parts = [(r['assembly_mark'], r['sub_assembly_mark'], r['part_mark']) for r in
+                 db.execute("SELECT assembly_mark, sub_assembly_mark, part_mark FROM parts").fetchall()]
+    return MarkIndex(assemblies, parts)
+
+
+# ── Assembly weights ───────────────────────────────────────────────────────────
+# assemblies.total_weight_kg is the sum of its parts' total_weight_kg.  Part
+# writes apply the difference instead of re-summing; verify_assembly_weights()
+# catches any drift and is run once a day by the app.
+
+_PART_FIELDS = {   # editable parts column -> VALUES cast for update_parts_bulk
+    'assembly_mark': 'text', 'sub_assembly_mark': 'text', 'part_mark': 'text', 'no': 'int',
+    'name': 'text', 'profile': 'text', 'kg_per_m': 'float8', 'length_mm': 'float8',
+    'total_weight_kg': 'float8', 'profile2': 'text', 'grade': 'text', 'remark': 'text',
+    'priority': 'int',
+}
+
+
+def _apply_weight_deltas(db, deltas):
+    """Add {assembly_mark: kg} to assemblies.total_weight_kg in one statement."""
+    deltas = {a: kg for a, kg in deltas.items() if a is not None and kg}
+    if deltas:
+        db.execute(
+            "UPDATE assemblies a SET total_weight_kg = COALESCE(a.total_weight_kg, 0) + d.kg "
+            "FROM unnest(?::text[], ?::float8[]) AS d(mark, kg) WHERE a.assembly_mark = d.mark",
+            (list(deltas), list(deltas.values()))
+        )
+
+
+def update_parts_bulk(changes):
+    """Apply many part edits in one transaction.
+    changes: iterable of dicts with 'id' plus any of the _PART_FIELDS columns.
+    Edits with the same set of columns go in one UPDATE ... FROM (VALUES ...);
+    assembly weights then get one delta per touched assembly.
+    Returns the number of parts updated.
+    """
+    groups = {}   # column tuple -> rows
+    for change in changes:
+        cols = tuple(sorted(k for k in change if k != 'id'))
+        unknown = set(cols) - set(_PART_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown part field(s): {', '.join(sorted(unknown))}")
+        if cols:
+            groups.setdefault(cols, []).append((int(change['id']),) + tuple(change[c] for c in cols))
+    if not groups:
+        return 0
+    deltas, updated = {}, 0
+    with _conn() as db:
+        cur = db._conn.cursor()
+        for cols, rows in groups.items():
+            # parts o is the pre-update row, so RETURNING sees old and new values
+            returned = psycopg2.extras.execute_values(
+                cur,
+                f"UPDATE parts p SET {', '.join(f'{c} = v.{c}' for c in cols)} "
+                f"FROM (VALUES %s) AS v(id, {', '.join(cols)}) JOIN parts o ON o.id = v.id "
+                "WHERE p.id = v.id "
+                "RETURNING o.assembly_mark, o.total_weight_kg, p.assembly_mark, p.total_weight_kg",
+                rows,
+                template='(%s::int, ' + ', '.join(f'%s::{_PART_FIELDS[c]}' for c in cols) + ')',
+                page_size=1000,
+                fetch=True,
+            )
+            for old_asm, old_kg, new_asm, new_kg in returned:
+                deltas[old_asm] = deltas.get(old_asm, 0) - (old_kg or 0)
+                deltas[new_asm] = deltas.get(new_asm, 0) + (new_kg or 0)
+            updated += len(returned)
+        cur.close()
+        _apply_weight_deltas(db, deltas)
+        db.commit()
+    return updated
+
+
+def verify_assembly_weights(repair=False, tolerance=0.01):
+    """Compare assemblies.total_weight_kg with the sum of their parts.
+    Returns a list of {'assembly_mark', 'stored', 'actual'} for every assembly
+    off by more than tolerance kg; repair=True also overwrites those totals.
+    """
+    with _conn() as db:
+        rows = db.execute("""
+            SELECT a.assembly_mark, a.total_weight_kg AS stored, COALESCE(s.kg, 0) AS actual
+            FROM assemblies a
+            LEFT JOIN (SELECT assembly_mark, SUM(total_weight_kg) AS kg
+                       FROM parts GROUP BY assembly_mark) s ON s.assembly_mark = a.assembly_mark
+            WHERE ABS(COALESCE(a.total_weight_kg, 0) - COALESCE(s.kg, 0)) > ?
+            ORDER BY a.assembly_mark
+        """, (tolerance,)).fetchall()
+        drift = [dict(r) for r in rows]
+        if repair and drift:
+            db.execute(
+                "UPDATE assemblies a SET total_weight_kg = d.kg "
+                "FROM unnest(?::text[], ?::float8[]) AS d(mark, kg) WHERE a.assembly_mark = d.mark",
+                ([r['assembly_mark'] for r in drift], [r['actual'] for r in drift])
+            )
+            db.commit()
+    if drift:
+        _log.warning('assembly weights drifted for %d assemblies%s', len(drift),
+                     ' (repaired)' if repair else '')
+    return drift
+
+
 # ── Visual Inspection ─────────────────────────────────────────────────────────
 
-def init_visual_inspection():
-    c = _conn()
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS visual_inspection (
-            id                SERIAL PRIMARY KEY,
-            entry_date        TEXT NOT NULL,
-            assembly_mark     TEXT DEFAULT '',
-            sub_assembly_mark TEXT DEFAULT '',
-            weight_kg         DOUBLE PRECISION DEFAULT 0,
-            qty               INTEGER DEFAULT 1,
-            remarks           TEXT DEFAULT '',
-            created_at        TIMESTAMPTZ DEFAULT NOW()
+def _insert_visual_inspections(c, rows, chunk=500):
+    """Insert (entry_date, mark, sub, weight_kg, qty, remarks) tuples, one statement
+    per chunk; rows that hit the unique key are skipped. Returns the inserted count."""
+    inserted = 0
+    cur = c._conn.cursor()
+    for i in range(0, len(rows), chunk):
+        returned = psycopg2.extras.execute_values(
+            cur,
+            "INSERT INTO visual_inspection "
+            "(entry_date, assembly_mark, sub_assembly_mark, weight_kg, qty, remarks) VALUES %s "
+            "ON CONFLICT (entry_date, assembly_mark, sub_assembly_mark) DO NOTHING RETURNING id",
+            rows[i : i + chunk],
+            page_size=chunk,
+            fetch=True,
         )
-    """)
-    c.commit()
-    c.close()
+        inserted += len(returned)
+    return inserted
 
 
 def visual_inspection_passed(mark, sub_mark):
     """Return True if at least one visual inspection record exists for this assembly/sub-assembly."""
-    c = _conn()
-    row = c.execute(
-        "SELECT 1 FROM visual_inspection WHERE assembly_mark=? AND sub_assembly_mark=?",
-        (mark.strip().upper(), sub_mark.strip().upper())
-    ).fetchone()
-    c.close()
+    with _conn() as c:
+        row = c.execute(
+            "SELECT 1 FROM visual_inspection WHERE assembly_mark=? AND sub_assembly_mark=?",
+            (mark.strip().upper(), sub_mark.strip().upper())
+        ).fetchone()
     return row is not None
 
 
 def visual_inspection_exists(entry_date, mark, sub_mark):
     """Return True if a record already exists for this date/assembly/sub-assembly."""
-    c = _conn()
-    row = c.execute(
-        "SELECT 1 FROM visual_inspection "
-        "WHERE entry_date=? AND assembly_mark=? AND sub_assembly_mark=?",
-        (str(entry_date), mark.strip().upper(), sub_mark.strip().upper())
-    ).fetchone()
-    c.close()
+    with _conn() as c:
+        row = c.execute(
+            "SELECT 1 FROM visual_inspection "
+            "WHERE entry_date=? AND assembly_mark=? AND sub_assembly_mark=?",
+            (str(entry_date), mark.strip().upper(), sub_mark.strip().upper())
+        ).fetchone()
     return row is not None
 
 
 def add_visual_inspection(entry_date, mark, sub_mark, weight_kg, qty, remarks=''):
-    c = _conn()
-    cur = c.execute(
-        "INSERT INTO visual_inspection (entry_date, assembly_mark, sub_assembly_mark, "
-        "weight_kg, qty, remarks) VALUES (?,?,?,?,?,?) RETURNING id",
-        (str(entry_date), mark.strip().upper(), sub_mark.strip().upper(),
-         float(weight_kg), int(qty), remarks.strip())
-    )
-    rid = cur.lastrowid
-    c.commit()
-    c.close()
+    """Record one inspection; returns its id, or None if the date / mark / sub
+    was already inspected (e.g. saved from another session since the check)."""
+    with _conn() as c:
+        cur = c.execute(
+            "INSERT INTO visual_inspection (entry_date, assembly_mark, sub_assembly_mark, "
+            "weight_kg, qty, remarks) VALUES (?,?,?,?,?,?) "
+            "ON CONFLICT (entry_date, assembly_mark, sub_assembly_mark) DO NOTHING RETURNING id",
+            (str(entry_date), mark.strip().upper(), sub_mark.strip().upper(),
+             float(weight_kg), int(qty), remarks.strip())
+        )
+        rid = cur.lastrowid
+        c.commit()
     return rid
 
 
@@ -1451,167 +3759,129 @@ def bulk_add_visual_inspection(entry_date, records):
     """Insert multiple VI records in one connection.
     records: list of dicts with keys mark, sub, weight_kg, qty, remarks.
     Skips duplicates (same date/mark/sub already exists).
-    Returns count of rows inserted.
+    Returns (inserted, skipped).
     """
     if not records:
-        return 0
-    c = _conn()
-    count = 0
-    for r in records:
-        exists = c.execute(
-            "SELECT 1 FROM visual_inspection "
-            "WHERE entry_date=? AND assembly_mark=? AND sub_assembly_mark=?",
-            (str(entry_date), r['mark'].upper(), r['sub'].upper())
-        ).fetchone()
-        if not exists:
-            c.execute(
-                "INSERT INTO visual_inspection "
-                "(entry_date, assembly_mark, sub_assembly_mark, weight_kg, qty, remarks) "
-                "VALUES (?,?,?,?,?,?)",
-                (str(entry_date), r['mark'].upper(), r['sub'].upper(),
-                 float(r['weight_kg']), int(r.get('qty', 1)), r.get('remarks', ''))
-            )
-            count += 1
-    c.commit()
-    c.close()
-    return count
+        return 0, 0
+    rows = [(str(entry_date), r['mark'].upper(), r['sub'].upper(),
+             float(r['weight_kg']), int(r.get('qty', 1)), r.get('remarks', ''))
+            for r in records]
+    with _conn() as c:
+        inserted = _insert_visual_inspections(c, rows)
+        c.commit()
+    return inserted, len(rows) - inserted
 
 
 def get_visual_inspections(start=None, end=None):
-    c = _conn()
-    if start and end:
-        rows = c.execute(
-            "SELECT * FROM visual_inspection WHERE entry_date BETWEEN ? AND ? "
-            "ORDER BY entry_date DESC, id DESC",
-            (str(start), str(end))
-        ).fetchall()
-    else:
-        rows = c.execute(
-            "SELECT * FROM visual_inspection ORDER BY entry_date DESC, id DESC"
-        ).fetchall()
-    c.close()
+    with _conn() as c:
+        if start and end:
+            rows = c.execute(
+                "SELECT * FROM visual_inspection WHERE entry_date BETWEEN ? AND ? "
+                "ORDER BY entry_date DESC, id DESC",
+                (str(start), str(end))
+            ).fetchall()
+        else:
+            rows = c.execute(
+                "SELECT * FROM visual_inspection ORDER BY entry_date DESC, id DESC"
+            ).fetchall()
     return [dict(r) for r in rows]
 
 
+def get_visual_inspections_page(start=None, end=None, assembly_mark=None,
+                                after=None, before=None, limit=None):
+    """Keyset-paginated get_visual_inspections(); see _keyset_page."""
+    conditions, params = [], []
+    if start and end:
+        conditions.append("entry_date BETWEEN ? AND ?")
+        params += [str(start), str(end)]
+    if assembly_mark:
+        conditions.append("assembly_mark = ?")
+        params.append(assembly_mark)
+    with _conn() as c:
+        return _keyset_page(c, '*', 'visual_inspection', conditions, params, 'entry_date', 'id',
+                            after=after, before=before, limit=limit)
+
+
 def get_visual_inspection_summary():
-    c = _conn()
-    row = c.execute(
-        "SELECT COUNT(*) as entries, COALESCE(SUM(weight_kg),0) as total_kg "
-        "FROM visual_inspection"
-    ).fetchone()
-    c.close()
+    with _conn() as c:
+        row = c.execute(
+            "SELECT COUNT(*) as entries, COALESCE(SUM(weight_kg),0) as total_kg "
+            "FROM visual_inspection"
+        ).fetchone()
     return dict(row) if row else {'entries': 0, 'total_kg': 0}
 
 
 def get_missing_visual_inspections():
     """Return sub-assemblies that have WELDING recorded but no VI record yet."""
-    c = _conn()
-    rows = c.execute("""
-        SELECT p.assembly_mark, p.sub_assembly_mark,
-               COALESCE(SUM(p.weight_kg), 0) AS welding_kg
-        FROM progress p
-        WHERE p.stage = 'WELDING'
-          AND NOT EXISTS (
-              SELECT 1 FROM visual_inspection vi
-              WHERE vi.assembly_mark     = p.assembly_mark
-                AND vi.sub_assembly_mark = p.sub_assembly_mark
-          )
-        GROUP BY p.assembly_mark, p.sub_assembly_mark
-        ORDER BY p.assembly_mark, p.sub_assembly_mark
-    """).fetchall()
-    c.close()
+    with _conn() as c:
+        rows = c.execute("""
+            SELECT p.assembly_mark, p.sub_assembly_mark,
+                   COALESCE(SUM(p.weight_kg), 0) AS welding_kg
+            FROM progress p
+            WHERE p.stage = 'WELDING'
+              AND NOT EXISTS (
+                  SELECT 1 FROM visual_inspection vi
+                  WHERE vi.assembly_mark     = p.assembly_mark
+                    AND vi.sub_assembly_mark = p.sub_assembly_mark
+              )
+            GROUP BY p.assembly_mark, p.sub_assembly_mark
+            ORDER BY p.assembly_mark, p.sub_assembly_mark
+        """).fetchall()
     return [dict(r) for r in rows]
 
 
 def delete_visual_inspection(rid):
-    c = _conn()
-    c.execute("DELETE FROM visual_inspection WHERE id=?", (rid,))
-    c.commit()
-    c.close()
+    with _conn() as c:
+        c.execute("DELETE FROM visual_inspection WHERE id=?", (rid,))
+        c.commit()
 
 
-def import_visual_inspection_excel(file_source):
+def import_visual_inspection_excel(file_source, rejected=None):
     """Import visual inspection records from Excel.
     Expected columns: Date, Assembly Mark, Sub Assembly Mark, Weight (kg), Qty, Remarks
-    Skips duplicates (same date + assembly + sub-assembly).
+    Skips duplicates (same date + assembly + sub-assembly) and rows with an
+    unreadable date; rejected, if given, receives (sheet row, reason) for those.
     Returns (inserted, skipped, error_message).
     """
+    rejected = [] if rejected is None else rejected
     try:
-        import openpyxl
-        from io import BytesIO as _BytesIO
-        if isinstance(file_source, (bytes, bytearray)):
-            file_source = _BytesIO(file_source)
-        wb = openpyxl.load_workbook(file_source, data_only=True)
-        ws = wb.active
-        rows = list(ws.iter_rows(values_only=True))
-
-        header_row = next(
-            (i for i, r in enumerate(rows)
-             if r and any(str(v).strip().lower() in ('date', 'assembly mark')
-                          for v in r if v is not None)),
-            None
+        header, rows = _excel_rows(
+            file_source,
+            lambda r: any(str(v).strip().lower() in ('date', 'assembly mark') for v in r if v is not None),
+            numbered=True,
         )
-        if header_row is None:
+        if header is None:
             return 0, 0, "Header row not found. Ensure columns: Date, Assembly Mark, Sub Assembly Mark, Weight (kg), Qty, Remarks"
 
-        headers = [str(h).strip().lower() if h else '' for h in rows[header_row]]
-        col = {h: i for i, h in enumerate(headers)}
-
-        def _get(row, *names, default=None):
-            for name in names:
-                idx = col.get(name.lower())
-                if idx is not None and idx < len(row) and row[idx] is not None:
-                    return row[idx]
-            return default
-
-        def _float(v):
-            try: return float(v)
-            except: return 0.0
-
-        def _int(v):
-            try: return int(v)
-            except: return 1
-
-        c = _conn()
-        inserted = 0
-        skipped  = 0
-        for row in rows[header_row + 1:]:
+        extract = _compile_extractor(header, [
+            (('date',),                                                  _cell_date,  None),
+            (('assembly mark',),                                         _cell_text,  ''),
+            (('sub assembly mark', 'sub assembly', 'sub-assembly mark'), _cell_text,  ''),
+            (('weight (kg)', 'weight', 'kg'),                            _cell_float, 0),
+            (('qty', 'quantity'),                                        _cell_int,   1),
+            (('remarks', 'remark'),                                      _cell_text,  ''),
+        ], normalize=lambda h: h.strip().lower())
+
+        records, bad = [], 0
+        for row_no, row in rows:
             if not row or not any(v for v in row):
                 continue
-            raw_date = _get(row, 'date', default=None)
-            if raw_date and hasattr(raw_date, 'strftime'):
-                entry_date = raw_date.strftime('%Y-%m-%d')
-            elif raw_date:
-                entry_date = str(raw_date).strip()
-            else:
-                continue
-
-            mark = str(_get(row, 'assembly mark', default='') or '').strip().upper()
-            if not mark:
+            try:
+                entry_date, mark, sub, wt, qty, rmk = extract(row)
+            except ValueError as e:
+                rejected.append((row_no, str(e)))
+                bad += 1
                 continue
-            sub  = str(_get(row, 'sub assembly mark', 'sub assembly', 'sub-assembly mark', default='') or '').strip().upper()
-            wt   = _float(_get(row, 'weight (kg)', 'weight', 'kg', default=0))
-            qty  = _int(_get(row, 'qty', 'quantity', default=1))
-            rmk  = str(_get(row, 'remarks', 'remark', default='') or '').strip()
-
-            # skip duplicates
-            dup = c.execute(
-                "SELECT 1 FROM visual_inspection WHERE entry_date=? AND assembly_mark=? AND sub_assembly_mark=?",
-                (entry_date, mark, sub)
-            ).fetchone()
-            if dup:
-                skipped += 1
+            mark, sub = mark.upper(), sub.upper()
+            if not entry_date or not mark:
                 continue
+            records.append((entry_date, mark, sub, wt, qty, rmk))
 
-            c.execute(
-                "INSERT INTO visual_inspection (entry_date, assembly_mark, sub_assembly_mark, weight_kg, qty, remarks) "
-                "VALUES (?,?,?,?,?,?)",
-                (entry_date, mark, sub, wt, qty, rmk)
-            )
-            inserted += 1
-
-        c.commit()
-        c.close()
+        # duplicates (in the file or already stored) are skipped by the unique key
+        with _conn() as c:
+            inserted = _insert_visual_inspections(c, records)
+            c.commit()
+        skipped = len(records) - inserted + bad
         return inserted, skipped, None
     except Exception as e:
         return 0, 0, str(e)
@@ -1619,20 +3889,8 @@ def import_visual_inspection_excel(file_source):
 
 # ── Session / Online Tracking ──────────────────────────────────────────────────
 
-def init_sessions():
-    c = _conn()
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS sessions (
-            id         SERIAL PRIMARY KEY,
-            username   TEXT NOT NULL,
-            role       TEXT DEFAULT '',
-            login_time TEXT NOT NULL,
-            last_seen  TEXT NOT NULL,
-            active     INTEGER DEFAULT 1
-        )
-    """)
-    c.commit()
-    c.close()
+# last_seen is TIMESTAMPTZ; callers still get GMT+8 wall-clock strings
+_LAST_SEEN_GMT8 = "to_char(last_seen AT TIME ZONE INTERVAL '+08:00', 'YYYY-MM-DD HH24:MI:SS') AS last_seen"
 
 
 def _now_gmt8():
@@ -1642,56 +3900,48 @@ def _now_gmt8():
 
 def create_session(username, role=''):
     now = _now_gmt8()
-    c = _conn()
-    cur = c.execute(
-        "INSERT INTO sessions (username, role, login_time, last_seen) VALUES (?,?,?,?) RETURNING id",
-        (username, role, now, now)
-    )
-    sid = cur.lastrowid
-    c.commit()
-    c.close()
+    with _conn() as c:
+        cur = c.execute(
+            "INSERT INTO sessions (username, role, login_time, last_seen) VALUES (?,?,?,NOW()) RETURNING id",
+            (username, role, now)
+        )
+        sid = cur.lastrowid
+        c.commit()
     return sid
 
 
 def update_session_heartbeat(session_id):
-    now = _now_gmt8()
-    c = _conn()
-    c.execute("UPDATE sessions SET last_seen=? WHERE id=?", (now, session_id))
-    c.commit()
-    c.close()
+    with _conn() as c:
+        c.execute("UPDATE sessions SET last_seen=NOW() WHERE id=?", (session_id,))
+        c.commit()
 
 
 def end_session(session_id):
-    c = _conn()
-    c.execute("UPDATE sessions SET active=0 WHERE id=?", (session_id,))
-    c.commit()
-    c.close()
+    with _conn() as c:
+        c.execute("UPDATE sessions SET active=0 WHERE id=?", (session_id,))
+        c.commit()
 
 
 def get_active_sessions(minutes=10):
     """Users active within the last N minutes (GMT+8)."""
-    from datetime import datetime as _dt, timedelta as _td
-    threshold = (_dt.utcnow() + _td(hours=8) - _td(minutes=minutes)).strftime('%Y-%m-%d %H:%M:%S')
-    c = _conn()
-    rows = c.execute(
-        "SELECT username, role, login_time, last_seen FROM sessions "
-        "WHERE active=1 AND last_seen >= ? "
-        "ORDER BY last_seen DESC",
-        (threshold,)
-    ).fetchall()
-    c.close()
+    with _conn() as c:
+        rows = c.execute(
+            f"SELECT username, role, login_time, {_LAST_SEEN_GMT8} FROM sessions "
+            "WHERE active=1 AND sessions.last_seen >= NOW() - make_interval(mins => ?) "
+            "ORDER BY sessions.last_seen DESC",
+            (int(minutes),)
+        ).fetchall()
     return [dict(r) for r in rows]
 
 
 def get_login_history(limit=100):
     """Recent login sessions, newest first."""
-    c = _conn()
-    rows = c.execute(
-        "SELECT username, role, login_time, last_seen, active FROM sessions "
-        "ORDER BY login_time DESC LIMIT ?",
-        (limit,)
-    ).fetchall()
-    c.close()
+    with _conn() as c:
+        rows = c.execute(
+            f"SELECT username, role, login_time, {_LAST_SEEN_GMT8}, active FROM sessions "
+            "ORDER BY login_time DESC LIMIT ?",
+            (limit,)
+        ).fetchall()
     return [dict(r) for r in rows]
 
 
@@ -1700,60 +3950,56 @@ def get_login_history(limit=100):
 def save_manpower(entry_date, regular, ot1, ot2, ot3, sun_ph,
                   cutting_man=0, supervisor=0, foremen=0, fitter=0, helper=0, semi_skill=0,
                   material_coordinator=0, material_handler=0):
-    c = _conn()
-    c.execute("""
-        INSERT INTO manpower
-            (entry_date, regular, ot1, ot2, ot3, sun_ph,
-             cutting_man, supervisor, foremen, fitter, helper, semi_skill,
-             material_coordinator, material_handler)
-        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-        ON CONFLICT(entry_date) DO UPDATE SET
-            regular=EXCLUDED.regular, ot1=EXCLUDED.ot1, ot2=EXCLUDED.ot2,
-            ot3=EXCLUDED.ot3, sun_ph=EXCLUDED.sun_ph,
-            cutting_man=EXCLUDED.cutting_man, supervisor=EXCLUDED.supervisor,
-            foremen=EXCLUDED.foremen, fitter=EXCLUDED.fitter,
-            helper=EXCLUDED.helper, semi_skill=EXCLUDED.semi_skill,
-            material_coordinator=EXCLUDED.material_coordinator,
-            material_handler=EXCLUDED.material_handler
-    """, (str(entry_date),
-          int(regular), int(ot1), int(ot2), int(ot3), int(sun_ph),
-          int(cutting_man), int(supervisor), int(foremen),
-          int(fitter), int(helper), int(semi_skill),
-          int(material_coordinator), int(material_handler)))
-    c.commit()
-    c.close()
+    with _conn() as c:
+        c.execute("""
+            INSERT INTO manpower
+                (entry_date, regular, ot1, ot2, ot3, sun_ph,
+                 cutting_man, supervisor, foremen, fitter, helper, semi_skill,
+                 material_coordinator, material_handler)
+            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+            ON CONFLICT(entry_date) DO UPDATE SET
+                regular=EXCLUDED.regular, ot1=EXCLUDED.ot1, ot2=EXCLUDED.ot2,
+                ot3=EXCLUDED.ot3, sun_ph=EXCLUDED.sun_ph,
+                cutting_man=EXCLUDED.cutting_man, supervisor=EXCLUDED.supervisor,
+                foremen=EXCLUDED.foremen, fitter=EXCLUDED.fitter,
+                helper=EXCLUDED.helper, semi_skill=EXCLUDED.semi_skill,
+                material_coordinator=EXCLUDED.material_coordinator,
+                material_handler=EXCLUDED.material_handler
+        """, (str(entry_date),
+              int(regular), int(ot1), int(ot2), int(ot3), int(sun_ph),
+              int(cutting_man), int(supervisor), int(foremen),
+              int(fitter), int(helper), int(semi_skill),
+              int(material_coordinator), int(material_handler)))
+        c.commit()
 
 
 def get_manpower(entry_date):
-    c = _conn()
-    row = c.execute("SELECT * FROM manpower WHERE entry_date=?", (str(entry_date),)).fetchone()
-    c.close()
+    with _conn() as c:
+        row = c.execute("SELECT * FROM manpower WHERE entry_date=?", (str(entry_date),)).fetchone()
     return dict(row) if row else None
 
 
 def save_manpower_grid(entry_date, grid):
     """Save a full grid {worker_type: {shift_key: count}} for a date."""
-    c = _conn()
-    c.execute("DELETE FROM manpower_detail WHERE entry_date=?", (str(entry_date),))
-    for wtype, shifts in grid.items():
-        for shift_key, count in shifts.items():
-            if int(count) > 0:
-                c.execute("""
-                    INSERT INTO manpower_detail (entry_date, worker_type, shift, count)
-                    VALUES (?,?,?,?)
-                """, (str(entry_date), wtype, shift_key, int(count)))
-    c.commit()
-    c.close()
+    with _conn() as c:
+        c.execute("DELETE FROM manpower_detail WHERE entry_date=?", (str(entry_date),))
+        for wtype, shifts in grid.items():
+            for shift_key, count in shifts.items():
+                if int(count) > 0:
+                    c.execute("""
+                        INSERT INTO manpower_detail (entry_date, worker_type, shift, count)
+                        VALUES (?,?,?,?)
+                    """, (str(entry_date), wtype, shift_key, int(count)))
+        c.commit()
 
 
 def get_manpower_grid(entry_date):
     """Return {worker_type: {shift_key: count}} for a date."""
-    c = _conn()
-    rows = c.execute(
-        "SELECT worker_type, shift, count FROM manpower_detail WHERE entry_date=?",
-        (str(entry_date),)
-    ).fetchall()
-    c.close()
+    with _conn() as c:
+        rows = c.execute(
+            "SELECT worker_type, shift, count FROM manpower_detail WHERE entry_date=?",
+            (str(entry_date),)
+        ).fetchall()
     grid = {}
     for r in rows:
         grid.setdefault(r['worker_type'], {})[r['shift']] = r['count']
@@ -1762,11 +4008,10 @@ def get_manpower_grid(entry_date):
 
 def get_manhour_summary():
     """Total manhours, total days logged, and average manhours per day."""
-    c = _conn()
-    rows = c.execute(
-        "SELECT entry_date, shift, SUM(count) as total FROM manpower_detail GROUP BY entry_date, shift"
-    ).fetchall()
-    c.close()
+    with _conn() as c:
+        rows = c.execute(
+            "SELECT entry_date, shift, SUM(count) as total FROM manpower_detail GROUP BY entry_date, shift"
+        ).fetchall()
     total_days = len({r['entry_date'] for r in rows})
     total_mh   = sum(r['total'] * SHIFT_HOURS.get(r['shift'], 0) for r in rows)
     avg = total_mh / total_days if total_days else 0
@@ -1779,43 +4024,39 @@ def save_drawing(title, assembly_mark, original_name, file_bytes, uploaded_by=''
     import uuid
     ext      = original_name.rsplit('.', 1)[-1].lower() if '.' in original_name else 'bin'
     filename = f"{uuid.uuid4().hex}.{ext}"
-    c = _conn()
-    c.execute("""
-        INSERT INTO drawings (title, original_name, filename, assembly_mark, uploaded_by, file_data, rev_no, date_received)
-        VALUES (?,?,?,?,?,?,?,?)
-    """, (title.strip(), original_name, filename, assembly_mark or '', uploaded_by,
-          psycopg2.Binary(file_bytes), rev_no or '', date_received or ''))
-    c.commit()
-    c.close()
+    with _conn() as c:
+        c.execute("""
+            INSERT INTO drawings (title, original_name, filename, assembly_mark, uploaded_by, file_data, rev_no, date_received)
+            VALUES (?,?,?,?,?,?,?,?)
+        """, (title.strip(), original_name, filename, assembly_mark or '', uploaded_by,
+              psycopg2.Binary(file_bytes), rev_no or '', date_received or ''))
+        c.commit()
 
 
 def get_drawings(assembly_mark=None):
     """Return drawing metadata only — file_data excluded to keep list fast."""
     _cols = "id, title, original_name, filename, assembly_mark, uploaded_by, created_at, rev_no, date_received"
-    c = _conn()
-    if assembly_mark:
-        rows = c.execute(
-            f"SELECT {_cols} FROM drawings WHERE assembly_mark=? ORDER BY created_at DESC",
-            (assembly_mark,)
-        ).fetchall()
-    else:
-        rows = c.execute(
-            f"SELECT {_cols} FROM drawings ORDER BY created_at DESC"
-        ).fetchall()
-    c.close()
+    with _conn() as c:
+        if assembly_mark:
+            rows = c.execute(
+                f"SELECT {_cols} FROM drawings WHERE assembly_mark=? ORDER BY created_at DESC",
+                (assembly_mark,)
+            ).fetchall()
+        else:
+            rows = c.execute(
+                f"SELECT {_cols} FROM drawings ORDER BY created_at DESC"
+            ).fetchall()
     return [dict(r) for r in rows]
 
 
 def get_drawing_file(did):
     """Fetch file_data bytes for a single drawing — called on demand only."""
-    c = _conn()
-    row = c.execute("SELECT file_data FROM drawings WHERE id=?", (did,)).fetchone()
-    c.close()
+    with _conn() as c:
+        row = c.execute("SELECT file_data FROM drawings WHERE id=?", (did,)).fetchone()
     return bytes(row['file_data']) if row and row.get('file_data') else None
 
 
 def delete_drawing(did):
-    c = _conn()
-    c.execute("DELETE FROM drawings WHERE id=?", (did,))
-    c.commit()
-    c.close()
+    with _conn() as c:
+        c.execute("DELETE FROM drawings WHERE id=?", (did,))
+        c.commit()
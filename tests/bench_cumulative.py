@@ -0,0 +1,96 @@
+"""Statement latency of get_cumulative_by_sub() as the BOM grows.
+
+    FAB_TEST_DATABASE_URL="host=localhost user=postgres" python tests/bench_cumulative.py
+
+Each size has 40 parts and 100 progress rows per assembly.  Half of the
+assemblies have sub-assemblies and half don't, so both UNION ALL branches do
+work.  For each size the script prints the median wall time of
+get_cumulative_by_sub() (rollup-backed) and the server execution time
+(EXPLAIN ANALYZE) of that statement, of the raw aggregation and of the
+assembly-level branch as it was before the fan-out fix, which joined parts
+and progress to assemblies at the same time.
+"""
+import json
+import statistics
+import time
+
+from scratchdb import require_url, scratch_db
+
+SIZES = [(5_000, 12_500), (10_000, 25_000), (20_000, 50_000), (40_000, 100_000)]
+PARTS_PER_ASM = 40
+REPEAT = 7
+
+# assembly-level branch before the fix: every progress row counted once per part
+_FANOUT_BRANCH = """
+    SELECT a.assembly_mark, MAX(pt2.priority) AS priority,
+        COALESCE(SUM(CASE WHEN p.stage='FIT UP'              THEN p.weight_kg END), 0) AS fitup,
+        COALESCE(SUM(CASE WHEN p.stage='WELDING'             THEN p.weight_kg END), 0) AS welding,
+        COALESCE(SUM(CASE WHEN p.stage='BLASTING & PAINTING' THEN p.weight_kg END), 0) AS blasting,
+        COALESCE(SUM(CASE WHEN p.stage='SEND TO SITE'        THEN p.weight_kg END), 0) AS sendsite
+    FROM assemblies a
+    LEFT JOIN parts pt2 ON a.assembly_mark = pt2.assembly_mark
+    LEFT JOIN progress p ON a.assembly_mark = p.assembly_mark
+    WHERE a.assembly_mark NOT IN (
+        SELECT DISTINCT assembly_mark FROM parts WHERE sub_assembly_mark != ''
+    )
+    GROUP BY a.assembly_mark, a.work_order, a.total_weight_kg
+"""
+
+
+def load(db, n_parts, n_progress):
+    n_asm = n_parts // PARTS_PER_ASM
+    with db._conn() as c:
+        c.execute("TRUNCATE progress, parts, assemblies, progress_rollup, daily_stage_totals")
+        c.execute("INSERT INTO assemblies (assembly_mark, total_weight_kg) "
+                  "SELECT 'A' || g, 40 FROM generate_series(1, ?) g", (n_asm,))
+        # odd assemblies have 4 sub-assemblies, even ones none
+        c.execute("INSERT INTO parts (assembly_mark, sub_assembly_mark, part_mark, total_weight_kg, priority) "
+                  "SELECT 'A' || a, CASE WHEN a %% 2 = 1 THEN 'S' || (g %% 4) ELSE '' END, 'P' || g, 1, g %% 5 "
+                  "FROM generate_series(1, ?) g, LATERAL (SELECT g %% ? + 1 AS a) x",
+                  (n_parts, n_asm))
+        c.execute("INSERT INTO progress (entry_date, assembly_mark, sub_assembly_mark, stage, weight_kg) "
+                  "SELECT DATE '2026-01-01' + g %% 90, 'A' || a, "
+                  "CASE WHEN a %% 2 = 1 THEN 'S' || (g %% 4) ELSE '' END, "
+                  "(ARRAY['FIT UP', 'WELDING', 'BLASTING & PAINTING', 'SEND TO SITE'])[g %% 4 + 1], 0.1 "
+                  "FROM generate_series(1, ?) g, LATERAL (SELECT g %% ? + 1 AS a) x",
+                  (n_progress, n_asm))
+        c.commit()
+        c.execute("ANALYZE")
+        c.commit()
+
+
+def execution_ms(db, sql):
+    """Best server-side execution time of sql over REPEAT runs."""
+    best = None
+    with db._conn() as c:
+        for _ in range(REPEAT):
+            plan = c.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + sql).fetchone()['QUERY PLAN']
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            ms = plan[0]['Execution Time']
+            best = ms if best is None else min(best, ms)
+        c.commit()
+    return best
+
+
+def main():
+    require_url()
+    fmt = {'wo_filter1': '', 'wo_filter2': ''}
+    with scratch_db() as db:
+        print(f"{'parts':>7} {'progress':>9} {'rows':>6} {'call ms':>8} {'rollup ms':>10} "
+              f"{'raw ms':>8} {'fan-out ms':>11}")
+        for n_parts, n_progress in SIZES:
+            load(db, n_parts, n_progress)
+            walls = []
+            for _ in range(REPEAT):
+                t = time.perf_counter()
+                rows = db.get_cumulative_by_sub()
+                walls.append((time.perf_counter() - t) * 1000)
+            print(f'{n_parts:>7} {n_progress:>9} {len(rows):>6} {statistics.median(walls):>8.1f} '
+                  f'{execution_ms(db, db._CUMULATIVE_BY_SUB.format(**fmt)):>10.1f} '
+                  f'{execution_ms(db, db._CUMULATIVE_BY_SUB_RAW.format(**fmt)):>8.1f} '
+                  f'{execution_ms(db, _FANOUT_BRANCH):>11.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Rows per second of the master Excel column extractor.
+
+    python tests/bench_extractor.py
+
+Reads a 10k-row BOM once, then converts every row with:
+  _get       the per-row alias walk the importers used before user-013
+  generated  the exec()'d reader with inlined column indexes that preceded
+             the closure version (kept here only as a reference point)
+  compiled   db._compile_extractor as shipped
+and prints the best of 9 runs, plus _parse_master_excel's total for the same
+file so the extractor's share of an import is visible.  No database needed.
+"""
+import os
+import tempfile
+import timeit
+
+from bench_import_memory import write_bom
+from scratchdb import _db as db
+
+ROWS = 10_000
+REPEAT = 9
+
+STAGES = ('FIT UP', 'WELDING', 'BLASTING & PAINTING', 'SEND TO SITE')
+FIELDS = [
+    (('Assembly Mark',),                                        db._cell_text,    ''),
+    (('Sub Assembly', 'Sub-Assembly Mark', 'Sub Assembly Mark'), db._cell_text,    ''),
+    (('Part Mark',),                                            db._cell_text,    ''),
+    (('No.',),                                                  db._cell_int,     1),
+    (('Name', 'NAME'),                                          db._cell_text,    ''),
+    (('Profile',),                                              db._cell_text,    ''),
+    (('kg/m',),                                                 db._cell_float,   0),
+    (('Length (mm)', 'Length'),                                 db._cell_float,   0),
+    (('Weight (kg)', 'Total weight'),                           db._cell_float,   0),
+    (('Profile 2', 'Profile2'),                                 db._cell_text,    ''),
+    (('Grade',),                                                db._cell_text,    ''),
+    (('Remark',),                                               db._cell_text,    ''),
+    (('Work Order', 'Work_Order', 'WO'),                        db._cell_text,    '001'),
+    (('Priority',),                                             db._cell_opt_int, None),
+]
+for _stage in STAGES:
+    FIELDS += [((f'{_stage} (kg)',), db._cell_float, 0), ((f'{_stage} Date',), lambda v: v, None),
+               ((f'{_stage} D.O. No.',), db._cell_text, '')]
+
+
+def alias_walk(header):
+    """The pre-user-013 reader: every field re-resolves its aliases per row."""
+    col = {str(h).strip(): i for i, h in enumerate(header) if h}
+
+    def get(row, names, default):
+        for name in names:
+            i = col.get(name)
+            if i is not None and i < len(row) and row[i] is not None:
+                return row[i]
+        return default
+
+    def extract(row):
+        return tuple([d if (v := get(row, names, None)) is None else c(v) for names, c, d in FIELDS])
+    return extract
+
+
+def generated(header):
+    """Reference: the reader as generated source, every index inlined."""
+    col = {str(h).strip(): i for i, h in enumerate(header) if h}
+    width = len(header) + 1
+    env, exprs = {'pad': (None,) * width, 'width': width}, []
+    for k, (aliases, convert, default) in enumerate(FIELDS):
+        i = next((col[a] for a in aliases if a in col), len(header))
+        env[f'c{k}'], env[f'd{k}'] = convert, default
+        if convert is db._cell_text:
+            exprs.append(f'(d{k} if row[{i}] is None else str(row[{i}]).strip())')
+        else:
+            exprs.append(f'(d{k} if row[{i}] is None else c{k}(row[{i}]))')
+    exec('def extract(row):\n'
+         '    if len(row) < width:\n'
+         '        row = row + pad[:width - len(row)]\n'
+         f'    return ({", ".join(exprs)},)\n', env)
+    return env['extract']
+
+
+def best_s(fn):
+    return min(timeit.repeat(fn, number=1, repeat=REPEAT))
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bom.xlsx')
+        write_bom(path, ROWS)
+        header, rows = db._excel_rows(
+            path, lambda r: any(str(v).strip() == 'Assembly Mark' for v in r if v is not None))
+        rows = [r for r in rows if r]
+        readers = {'_get': alias_walk(header), 'generated': generated(header),
+                   'compiled': db._compile_extractor(header, FIELDS)}
+        expected = [readers['_get'](r) for r in rows]
+        for name, extract in readers.items():
+            assert [extract(r) for r in rows] == expected, name
+        parse = min(timeit.repeat(lambda: db._parse_master_excel(path), number=1, repeat=3))
+        print(f'{len(rows)} rows; _parse_master_excel {parse * 1000:.0f} ms')
+        print(f"{'reader':>10} {'rows/s':>9} {'ms':>7} {'of parse':>9}")
+        for name, extract in readers.items():
+            s = best_s(lambda: [extract(r) for r in rows])
+            print(f'{name:>10} {len(rows) / s:>9.0f} {s * 1000:>7.1f} {s / parse:>9.1%}')
+
+
+if __name__ == '__main__':
+    main()
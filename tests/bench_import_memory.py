@@ -0,0 +1,92 @@
+"""Peak memory of the streaming master Excel import, per 10k rows.
+
+    FAB_TEST_DATABASE_URL="host=localhost user=postgres" python tests/bench_import_memory.py
+
+Writes BOM workbooks of 10k, 20k and 40k part rows, then measures each in a
+fresh child process, so ru_maxrss is that run's own peak:
+  import  db.import_excel() into a scratch database (read-only openpyxl,
+          rows streamed through _excel_rows into COPY)
+  full    the reading pattern the importers used before: load_workbook()
+          in full mode and list(iter_rows(values_only=True))
+Memory is the peak RSS above the child's RSS once its modules are imported.
+"""
+import datetime
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+import openpyxl
+
+SIZES = [10_000, 20_000, 40_000]
+PARTS_PER_ASM = 10
+
+HEADER = ['Priority', 'Work Order', 'Assembly Mark', 'Sub Assembly', 'Part Mark', 'No.', 'Name',
+          'Profile', 'kg/m', 'Length (mm)', 'Weight (kg)', 'Profile 2', 'Grade', 'Remark',
+          'FIT UP (kg)', 'FIT UP Date', 'WELDING (kg)', 'WELDING Date',
+          'BLASTING & PAINTING (kg)', 'BLASTING & PAINTING Date', 'BLASTING & PAINTING D.O. No.',
+          'SEND TO SITE (kg)', 'SEND TO SITE Date', 'SEND TO SITE D.O. No.']
+
+
+def write_bom(path, n_parts):
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(['Master database'])
+    ws.append(HEADER)
+    for i in range(n_parts):
+        a = i // PARTS_PER_ASM
+        d = datetime.datetime(2026, 1, 1 + i % 28)
+        kg = 1 + i % 50
+        ws.append([i % 4 or None, f'00{a % 3 + 1}', f'A{a}', f'S{a}-{i % 3}' if a % 2 else '', f'P{i}',
+                   1, 'BEAM', 'UB203', 1.5, 1000, kg, '', 'S275', '',
+                   kg, d, kg if i % 2 else 0, d if i % 2 else None,
+                   kg if i % 3 == 0 else 0, d if i % 3 == 0 else None, f'DO{a % 7}' if i % 3 == 0 else None,
+                   0, None, None])
+    wb.save(path)
+
+
+def peak_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024   # KiB on Linux
+
+
+def child(mode, path):
+    """Run one measurement; print peak MB above the post-import baseline."""
+    if mode == 'import':
+        from scratchdb import scratch_db
+        with scratch_db() as db:
+            base = peak_mb()
+            parts, progress, err = db.import_excel(path)
+            assert err is None, err
+    else:
+        base = peak_mb()
+        wb = openpyxl.load_workbook(path, data_only=True)
+        rows = list(wb.active.iter_rows(values_only=True))
+        assert rows
+    print(f'{peak_mb() - base:.1f}')
+
+
+def main():
+    from scratchdb import require_url
+    require_url()
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{'rows':>7} {'file MB':>8} {'import MB':>10} {'per 10k':>8} {'full MB':>8} {'per 10k':>8}")
+        for n in SIZES:
+            path = os.path.join(tmp, f'bom{n}.xlsx')
+            write_bom(path, n)
+            peaks = {}
+            for mode in ('import', 'full'):
+                out = subprocess.run([sys.executable, __file__, '--child', mode, path], cwd=here,
+                                     capture_output=True, text=True, check=True).stdout
+                peaks[mode] = float(out.split()[-1])
+            per = 10_000 / n
+            print(f'{n:>7} {os.path.getsize(path) / 2**20:>8.1f} {peaks["import"]:>10.1f} '
+                  f'{peaks["import"] * per:>8.1f} {peaks["full"]:>8.1f} {peaks["full"] * per:>8.1f}')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        child(*sys.argv[2:4])
+    else:
+        main()
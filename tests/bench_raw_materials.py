@@ -0,0 +1,62 @@
+"""Raw-material page and delete latency at 10k and 50k rows.
+
+    FAB_TEST_DATABASE_URL="host=localhost user=postgres" python tests/bench_raw_materials.py
+
+For each size the script prints the median of 7 calls, in ms, of:
+  all        get_raw_materials(): every row, numbered with ROW_NUMBER()
+  range      get_raw_materials(start, end) over a 30-day window
+  page 1     get_raw_materials_page(), the first keyset page
+  page 40    the same, 40 pages in (cursor taken from page 39)
+  delete     delete_raw_material() of one row (ids stay as they are)
+  bulk 500   delete_raw_materials() of 500 ids in one statement
+"""
+import statistics
+import time
+
+from scratchdb import require_url, scratch_db
+
+SIZES = [10_000, 50_000]
+REPEAT = 7
+
+
+def load(db, n):
+    with db._conn() as c:
+        c.execute("TRUNCATE raw_materials RESTART IDENTITY")
+        c.execute("INSERT INTO raw_materials (received_date, do_no, description, grade, qty, total_kg) "
+                  "SELECT DATE '2025-01-01' + g %% 365, 'DO' || g / 10, 'PL ' || g, 'S275', g %% 40, g %% 900 "
+                  "FROM generate_series(1, ?) g", (n,))
+        c.commit()
+        c.execute("ANALYZE raw_materials")
+        c.commit()
+
+
+def median_ms(fn, args_list):
+    times = []
+    for args in args_list:
+        t = time.perf_counter()
+        fn(*args)
+        times.append((time.perf_counter() - t) * 1000)
+    return statistics.median(times)
+
+
+def main():
+    require_url()
+    with scratch_db() as db:
+        print(f"{'rows':>7} {'all':>7} {'range':>7} {'page 1':>7} {'page 40':>8} {'delete':>7} {'bulk 500':>9}")
+        for n in SIZES:
+            load(db, n)
+            cursor = None
+            for _ in range(39):
+                cursor = db.get_raw_materials_page(after=cursor)['next']
+            once = [()] * REPEAT
+            print(f'{n:>7} '
+                  f'{median_ms(db.get_raw_materials, once):>7.1f} '
+                  f"{median_ms(db.get_raw_materials, [('2025-03-01', '2025-03-30')] * REPEAT):>7.1f} "
+                  f'{median_ms(db.get_raw_materials_page, once):>7.1f} '
+                  f"{median_ms(lambda: db.get_raw_materials_page(after=cursor), once):>8.1f} "
+                  f'{median_ms(db.delete_raw_material, [(n // 2 + k,) for k in range(REPEAT)]):>7.1f} '
+                  f'{median_ms(db.delete_raw_materials, [(range(1 + 500 * k, 501 + 500 * k),) for k in range(REPEAT)]):>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,14 @@
+import pytest
+
+from scratchdb import URL, scratch_db
+
+
+@pytest.fixture
+def pg():
+    """db module pointed at a scratch database, initialised.  The database is
+    created through FAB_TEST_DATABASE_URL (which needs CREATEDB) and dropped
+    afterwards; the test is skipped when the variable is not set."""
+    if not URL:
+        pytest.skip('FAB_TEST_DATABASE_URL not set')
+    with scratch_db() as db:
+        yield db
@@ -0,0 +1,42 @@
+"""Scratch PostgreSQL databases for the test fixtures and tests/bench_*.py.
+
+A database is created through FAB_TEST_DATABASE_URL (which needs CREATEDB),
+db is pointed at it and initialised, and it is dropped again on exit.
+"""
+import contextlib
+import os
+import sys
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db as _db   # noqa: E402
+
+URL = os.environ.get('FAB_TEST_DATABASE_URL')
+
+
+@contextlib.contextmanager
+def scratch_db(maxconn=4):
+    """db module pointed at a fresh, initialised database."""
+    name = f'fab_test_{uuid.uuid4().hex[:8]}'
+    admin = _db.psycopg2.connect(URL)
+    admin.autocommit = True
+    admin.cursor().execute(f'CREATE DATABASE {name}')
+    saved = _db._pool
+    _db._pool = _db._ConnectionPool(1, maxconn, 5, dsn=URL, dbname=name,
+                                    connection_factory=_db._PgConnection)
+    try:
+        _db.init()
+        yield _db
+    finally:
+        _db._pool.closeall()
+        _db._pool = saved
+        admin.cursor().execute(f'DROP DATABASE {name}')
+        admin.close()
+
+
+def require_url():
+    """Exit with a usage line when FAB_TEST_DATABASE_URL is not set (benchmarks)."""
+    if not URL:
+        sys.exit('set FAB_TEST_DATABASE_URL to a PostgreSQL role with CREATEDB, e.g.\n'
+                 '  FAB_TEST_DATABASE_URL="host=localhost user=postgres" python ' + sys.argv[0])
@@ -0,0 +1,26 @@
+from datetime import date, datetime
+
+import pytest
+
+from db import _cell_date
+
+
+@pytest.mark.parametrize('value, expected', [
+    (date(2024, 3, 25),             '2024-03-25'),
+    (datetime(2024, 3, 25, 14, 5),  '2024-03-25'),
+    ('2024-03-25',                  '2024-03-25'),
+    (' 2024-03-25 08:00:00 ',       '2024-03-25'),
+    ('25/03/2024',                  '2024-03-25'),
+    ('5.3.2024',                    '2024-03-05'),
+    ('',                            None),
+    ('   ',                         None),
+    (None,                          None),
+])
+def test_cell_date(value, expected):
+    assert _cell_date(value) == expected
+
+
+@pytest.mark.parametrize('value', ['TBA', '31/02/2024', '2024-13-01', '03/25'])
+def test_cell_date_rejects_unreadable(value):
+    with pytest.raises(ValueError, match='unreadable date'):
+        _cell_date(value)
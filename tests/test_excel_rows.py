@@ -0,0 +1,51 @@
+from io import BytesIO
+
+import openpyxl
+
+from db import _cell_float, _cell_int, _cell_text, _compile_extractor, _parse_master_excel
+
+
+def lower(h):
+    return h.strip().lower()
+
+
+def test_extractor_resolves_aliases_once():
+    extract = _compile_extractor(
+        ('Description', ' QTY ', None, 'Remarks'),
+        [(('description',),         _cell_text,  ''),
+         (('qty', 'quantity'),      _cell_float, 0),
+         (('remark', 'remarks'),    _cell_text,  ''),
+         (('grade',),               _cell_text,  'n/a')],
+        normalize=lower,
+    )
+    assert extract((' Plate ', '3', 'ignored', ' ok ')) == ('Plate', 3.0, 'ok', 'n/a')
+    assert extract((None, None, None, None)) == ('', 0, '', 'n/a')
+
+
+def test_extractor_pads_short_rows_and_ignores_extra_cells():
+    extract = _compile_extractor(('A', 'B'), [(('A',), _cell_text, ''), (('B',), _cell_int, 1),
+                                              (('C',), _cell_text, 'dflt')])
+    assert extract(('x',)) == ('x', 1, 'dflt')
+    assert extract(('x', '4', 'beyond the header')) == ('x', 4, 'dflt')
+
+
+def test_extractor_alias_columns_take_first_present():
+    extract = _compile_extractor(('Length', 'Length (mm)'),
+                                 [(('Length (mm)', 'Length'), _cell_float, 0)])
+    assert extract((None, 12)) == (12.0,)
+    assert extract((7, 12)) == (12.0,)
+    assert extract((7, None)) == (7.0,)
+    assert extract((None, None)) == (0,)
+
+
+def test_master_rows_without_a_mark_are_skipped_before_conversion():
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append(['Assembly Mark', 'Part Mark', 'Priority'])
+    ws.append(['A1', 'P1', 2])
+    ws.append([None, 'see note', 'n/a'])   # 'n/a' would fail the Priority conversion
+    buf = BytesIO()
+    wb.save(buf)
+    asm_rows, parts_rows, _ = _parse_master_excel(buf.getvalue())
+    assert asm_rows == [('A1', 0, '001', 2)]
+    assert [r[:3] for r in parts_rows] == [('A1', '', 'P1')]
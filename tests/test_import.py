@@ -0,0 +1,95 @@
+from io import BytesIO
+
+import openpyxl
+
+BP = 'BLASTING & PAINTING'
+
+
+def bom(rows):
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append(['Assembly Mark', 'Sub Assembly', 'Part Mark', 'Weight (kg)',
+               f'{BP} (kg)', f'{BP} Date', f'{BP} D.O. No.'])
+    for r in rows:
+        ws.append(r)
+    buf = BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+
+FILE = bom([
+    ['A1', 'S1', 'P1', 10, 10, '2024-03-01', 'DO-1'],
+    ['A1', 'S2', 'P2', 20, 20, '2024-03-02', 'DO-2'],
+    ['A2', '',   'P3', 30, 0,  None,         None],
+])
+
+
+def painted(pg):
+    return {(r['assembly_mark'], r['sub_assembly_mark']): r['painting_done']
+            for r in pg.get_deliveries() if r['stage'] == BP}
+
+
+def test_painting_done_survives_reimport(pg):
+    assert pg.import_excel(FILE)[2] is None
+    pg.set_painting_done_by_do('DO-1', True)
+    assert painted(pg) == {('A1', 'S1'): True, ('A1', 'S2'): False}
+
+    parts, progress, err = pg.replace_import_excel(FILE)
+    assert (parts, progress, err) == (3, 2, None)
+    assert painted(pg) == {('A1', 'S1'): True, ('A1', 'S2'): False}
+
+    summary, err = pg.delta_import_excel(FILE)
+    assert err is None and summary['unchanged'] == 3
+    assert painted(pg) == {('A1', 'S1'): True, ('A1', 'S2'): False}
+    mismatches = pg.check_progress_rollup()
+    assert mismatches == [], mismatches
+
+
+def test_unreadable_stage_date_is_reported_not_fatal(pg):
+    rejected = []
+    f = bom([['A1', 'S1', 'P1', 10, 10, 'TBA', 'DO-1'],
+             ['A1', 'S2', 'P2', 20, 20, '02/03/2024', 'DO-2']])
+    assert pg.import_excel(f, rejected=rejected) == (2, 1, None)
+    assert rejected == [(2, f"{BP}: unreadable date 'TBA'")]
+
+
+def progress(pg):
+    with pg._conn() as db:
+        rows = db.execute("SELECT assembly_mark, sub_assembly_mark, weight_kg, entry_date, "
+                          "delivery_order_no, painting_done FROM progress "
+                          "ORDER BY assembly_mark, sub_assembly_mark").fetchall()
+    return [(r['assembly_mark'], r['sub_assembly_mark'], r['weight_kg'], str(r['entry_date']),
+             r['delivery_order_no'], r['painting_done']) for r in rows]
+
+
+def test_delta_import_diffs_progress(pg):
+    assert pg.import_excel(FILE)[2] is None
+    pg.set_painting_done_by_do('DO-1', True)
+    pg.add_progress('2024-03-05', 'A1', 'S1', BP, 5, 0, '', 'DO-1')
+    pg.add_progress('2024-03-05', 'A2', '', BP, 7, 0, '', 'DO-9')
+
+    summary, err = pg.delta_import_excel(bom([
+        ['A1', 'S1', 'P1', 10, 12, '2024-03-06', 'DO-1'],   # two rows -> one, still painted
+        ['A1', 'S2', 'P2', 20, 20, '2024-03-02', 'DO-2'],   # unchanged
+        ['A3', '',   'P4', 40, 40, '2024-03-07', 'DO-3'],   # new; A2 dropped from the file
+    ]))
+    assert err is None
+    assert (summary['progress_added'], summary['progress_updated'],
+            summary['progress_deleted']) == (1, 1, 2)
+    assert progress(pg) == [
+        ('A1', 'S1', 12, '2024-03-06', 'DO-1', True),
+        ('A1', 'S2', 20, '2024-03-02', 'DO-2', False),
+        ('A3', '', 40, '2024-03-07', 'DO-3', False),
+    ]
+    assert pg.check_progress_rollup() == []
+
+
+def test_delta_import_keeps_progress_of_unreadable_dates(pg):
+    assert pg.import_excel(FILE)[2] is None
+    summary, err = pg.delta_import_excel(bom([
+        ['A1', 'S1', 'P1', 10, 10, 'TBA', 'DO-1'],
+        ['A1', 'S2', 'P2', 20, 20, '2024-03-02', 'DO-2'],
+    ]))
+    assert err is None and summary['rejected'] == [(2, f"{BP}: unreadable date 'TBA'")]
+    assert summary['progress_deleted'] == 0
+    assert [r[:3] for r in progress(pg)] == [('A1', 'S1', 10), ('A1', 'S2', 20)]
@@ -0,0 +1,115 @@
+import re
+
+import pytest
+
+import db as _db
+from db import _keyset_page
+
+
+@pytest.fixture(autouse=True)
+def fresh_estimates():
+    _db._estimates.clear()
+
+
+class _Result:
+    def __init__(self, rows):
+        self._rows = rows
+
+    def fetchall(self):
+        return self._rows
+
+    def fetchone(self):
+        return self._rows[0]
+
+
+class FakeDB:
+    """Answers _keyset_page's queries from an in-memory (date, id) list."""
+
+    def __init__(self, keys):
+        self.keys = sorted(keys)
+        self.explains = 0
+
+    def execute(self, sql, params):
+        if sql.startswith('EXPLAIN'):
+            self.explains += 1
+            return _Result([{'QUERY PLAN': [{'Plan': {'Plan Rows': len(self.keys)}}]}])
+        params = list(params)
+        limit = params.pop()
+        keys = self.keys
+        if '< (?, ?)' in sql:
+            cursor = tuple(params)
+            keys = [k for k in keys if k < cursor]
+        elif '> (?, ?)' in sql:
+            cursor = tuple(params)
+            keys = [k for k in keys if k > cursor]
+        if re.search(r'ORDER BY \S+ DESC', sql):
+            keys = keys[::-1]
+        return _Result([{'v': f'{d}#{i}', 'page_key_date': d, 'page_key_id': i}
+                        for d, i in keys[:limit]])
+
+
+KEYS = [(f'2024-03-{d:02d}', i) for i, d in enumerate([1, 1, 2, 3, 3, 3, 4, 5, 6, 7], start=1)]
+
+
+def page(db, **kw):
+    return _keyset_page(db, 'v', 't', [], [], 'd', 'id', limit=4, **kw)
+
+
+def ids(result):
+    return [int(r['v'].split('#')[1]) for r in result['rows']]
+
+
+def test_first_page_is_newest_and_has_no_prev():
+    p = page(FakeDB(KEYS))
+    assert ids(p) == [10, 9, 8, 7]
+    assert p['prev'] is None
+    assert p['next'] == ('2024-03-04', 7)
+    assert p['estimate'] == 10
+    assert 'page_key_date' not in p['rows'][0]
+
+
+def test_walk_forward_then_back():
+    db = FakeDB(KEYS)
+    p2 = page(db, after=page(db)['next'])
+    assert ids(p2) == [6, 5, 4, 3]
+    assert p2['prev'] == ('2024-03-03', 6)
+    p3 = page(db, after=p2['next'])
+    assert ids(p3) == [2, 1]
+    assert p3['next'] is None and p3['prev'] == ('2024-03-01', 2)
+    back = page(db, before=p3['prev'])
+    assert ids(back) == [6, 5, 4, 3]
+    assert back['next'] == ('2024-03-02', 3) and back['prev'] == ('2024-03-03', 6)
+
+
+def test_before_at_the_start_shows_first_page():
+    db = FakeDB(KEYS)
+    p = page(db, before=('2024-03-06', 9))
+    assert ids(p) == [10, 9, 8, 7]
+    assert p['prev'] is None
+
+
+def test_empty_page_after_cursor_falls_back_to_first_page():
+    db = FakeDB(KEYS)
+    cursor = page(db, after=page(db)['next'])['next']
+    db.keys = [k for k in db.keys if k[1] > 2]      # the last rows were deleted
+    p = page(db, after=cursor)
+    assert ids(p) == [10, 9, 8, 7]
+    assert p['prev'] is None and p['next'] == ('2024-03-04', 7)
+
+
+def test_empty_table():
+    p = page(FakeDB([]))
+    assert p['rows'] == [] and p['next'] is None and p['prev'] is None
+
+
+def test_estimate_is_planned_once_per_filter_within_the_ttl(monkeypatch):
+    db = FakeDB(KEYS)
+    page(db, after=page(db)['next'])
+    assert db.explains == 1
+    _keyset_page(db, 'v', 't', ['d > ?'], ['2024-03-01'], 'd', 'id', limit=4)
+    assert db.explains == 2                       # another filter is planned on its own
+    monkeypatch.setattr(_db, '_ESTIMATE_TTL', 0)
+    _db._estimates.clear()
+    page(db)
+    page(db)
+    assert db.explains == 4                       # expired at once: planned every time
@@ -0,0 +1,60 @@
+from db import MarkIndex
+
+
+def make_index():
+    return MarkIndex(
+        assemblies=['B101', 'B102', 'C200'],
+        parts=[('B101', 'S1', 'P1'), ('B101', 'S1', 'P2'), ('B101', '', 'P3'),
+               ('B102', 'S2', 'P4'), ('C200', None, None)],
+    )
+
+
+def test_membership_and_subs():
+    idx = make_index()
+    assert 'B101' in idx and 'X1' not in idx
+    assert len(idx) == 3
+    assert idx.has('B101') and idx.has('B101', 'S1') and not idx.has('B101', 'S9')
+    assert idx.marks() == ['B101', 'B102', 'C200']
+    assert idx.subs('B101') == ['S1']
+    assert idx.subs('X1') == []
+
+
+def test_prefix_is_case_insensitive():
+    idx = make_index()
+    assert idx.prefix('b10') == [('B101', ''), ('B102', '')]
+    assert idx.prefix('p') == [('B101', 'S1'), ('B101', ''), ('B102', 'S2')]
+    assert idx.prefix('') == []
+    assert idx.prefix('b', limit=1) == [('B101', '')]
+
+
+def test_fuzzy_and_search():
+    idx = make_index()
+    assert idx.fuzzy('C2OO', cutoff=0.5)[0] == ('C200', '')
+    assert idx.search('B10')[:2] == [('B101', ''), ('B102', '')]
+    assert idx.fuzzy('   ') == []
+
+
+def test_parts_add_their_assembly():
+    idx = MarkIndex(parts=[('D1', 'S1', 'P1')])
+    assert 'D1' in idx and idx.has('D1', 'S1')
+
+
+def test_remove_parts_then_assemblies():
+    idx = make_index()
+    idx.remove(parts=[('B101', 'S1', 'P1')])
+    assert idx.has('B101', 'S1')                 # P2 still hangs off S1
+    assert ('B101', 'S1') in idx.prefix('P2')
+    assert idx.prefix('P1') == []
+    idx.remove(parts=[('B101', 'S1', 'P2')])
+    assert not idx.has('B101', 'S1')
+    assert idx.prefix('S1') == []
+    idx.remove(assemblies=['B101'])
+    assert 'B101' not in idx
+    assert idx.prefix('P3') == []
+    assert idx.marks() == ['B102', 'C200']
+
+
+def test_remove_unknown_is_noop():
+    idx = make_index()
+    idx.remove(assemblies=['NOPE'], parts=[('NOPE', 'S', 'P'), ('B101', 'S9', 'P1')])
+    assert len(idx) == 3 and idx.has('B101', 'S1')
@@ -0,0 +1,35 @@
+from datetime import date
+
+from db import StagePrefixSums
+
+
+ROWS = [
+    {'entry_date': '2024-03-02', 'stage': 'FIT UP',  'kg': 10},
+    {'entry_date': '2024-03-01', 'stage': 'FIT UP',  'kg': 5},
+    {'entry_date': '2024-03-05', 'stage': 'FIT UP',  'kg': 2.5},
+    {'entry_date': '2024-03-03', 'stage': 'WELDING', 'kg': 7},
+    {'entry_date': '2024-03-04', 'stage': 'WELDING', 'kg': None},
+]
+
+
+def test_as_of_is_cumulative_per_stage():
+    sums = StagePrefixSums(ROWS)
+    assert sums.as_of('2024-02-28') == {'FIT UP': 0.0, 'WELDING': 0.0,
+                                        'BLASTING & PAINTING': 0.0, 'SEND TO SITE': 0.0}
+    assert sums.as_of('2024-03-01')['FIT UP'] == 5
+    assert sums.as_of('2024-03-04') == {'FIT UP': 15, 'WELDING': 7,
+                                        'BLASTING & PAINTING': 0.0, 'SEND TO SITE': 0.0}
+    assert sums.as_of(date(2024, 12, 31))['FIT UP'] == 17.5
+
+
+def test_on_returns_single_day():
+    sums = StagePrefixSums(ROWS)
+    assert sums.on('2024-03-02', stages=['FIT UP', 'WELDING']) == {'FIT UP': 10, 'WELDING': 0.0}
+    assert sums.on(date(2024, 3, 3))['WELDING'] == 7
+    assert sums.on('2024-03-04')['WELDING'] == 0.0
+
+
+def test_empty():
+    sums = StagePrefixSums([])
+    assert sums.as_of('2024-01-01', stages=['FIT UP']) == {'FIT UP': 0.0}
+    assert sums.on('2024-01-01', stages=['FIT UP']) == {'FIT UP': 0.0}
@@ -0,0 +1,39 @@
+from io import BytesIO
+
+import openpyxl
+
+
+def sheet(rows):
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append(['Received Date', 'D.O. Number', 'Description', 'Grade', 'Qty', 'Total kg', 'Remark'])
+    for r in rows:
+        ws.append(r)
+    buf = BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+
+def test_repeated_key_in_file_is_rejected(pg):
+    stats = {}
+    count, err = pg.import_raw_materials_excel(sheet([
+        ['2026-01-05', 'DO-1', 'PL 10', 'S275', 2, 100, ''],
+        ['2026-01-05', 'DO-1', 'PL 12', 'S275', 1, 80, ''],
+        ['2026-01-05', 'DO-1', 'PL 10', 'S275', 3, 150, ''],
+    ]), stats=stats)
+    assert err is None and count == 2
+    assert stats['rejected'] == [(4, 'repeats row 2')]
+    qty = {r['description']: r['qty'] for r in pg.get_raw_materials()}
+    assert qty == {'PL 10': 2, 'PL 12': 1}
+
+
+def test_key_matching_several_rows_is_left_alone(pg):
+    row = ['2026-01-05', 'DO-1', 'PL 10', 'S275', 2, 100, '']
+    pg.import_raw_materials_excel(sheet([row]), upsert=False)
+    pg.import_raw_materials_excel(sheet([row]), upsert=False)
+    stats = {}
+    count, err = pg.import_raw_materials_excel(sheet([row[:4] + [5, 250, '']]), stats=stats)
+    assert err is None and count == 0
+    assert stats['ambiguous'] == [(2, 2)]
+    assert stats['unchanged'] == 0
+    assert [r['qty'] for r in pg.get_raw_materials()] == [2, 2]
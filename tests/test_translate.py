@@ -0,0 +1,69 @@
+import psycopg2.errors
+
+from db import _PREPARE_RETRIES, _StatementCache, _translate
+
+
+def test_placeholders_become_numbered_parameters():
+    pyformat, body, args = _translate("SELECT *  FROM t\n WHERE a = ? AND b IN (?, ?)")
+    assert pyformat == "SELECT *  FROM t\n WHERE a = %s AND b IN (%s, %s)"
+    assert body == "SELECT *  FROM t\n WHERE a = $1 AND b IN ($2, $3)"
+    assert args == ' (%s, %s, %s)'
+
+
+def test_escaped_percent_is_kept_literal():
+    pyformat, body, args = _translate("SELECT 1 WHERE x LIKE '%%ON HOLD%%' AND y = ?")
+    assert pyformat == "SELECT 1 WHERE x LIKE '%%ON HOLD%%' AND y = %s"
+    assert body == "SELECT 1 WHERE x LIKE '%ON HOLD%' AND y = $1"
+    assert args == ' (%s)'
+
+
+def test_no_parameters():
+    pyformat, body, args = _translate('SELECT 1')
+    assert pyformat == body == 'SELECT 1'
+    assert args == ''
+
+
+class FakeCursor:
+    """Records statements; PREPARE raises `error` when one is given."""
+
+    def __init__(self, error=None):
+        self.error = error
+        self.prepares = 0
+
+    def execute(self, sql):
+        if 'PREPARE' in sql:
+            self.prepares += 1
+            if self.error:
+                raise self.error('prepare failed')
+
+
+def lookup(cache, cur, sql):
+    return cache.lookup(cur, sql, *_translate(sql)[1:])
+
+
+def test_statements_are_keyed_on_their_exact_text():
+    cache, cur = _StatementCache(), FakeCursor()
+    first = lookup(cache, cur, "SELECT 'a  b' WHERE x = ?")
+    assert lookup(cache, cur, "SELECT 'a b' WHERE x = ?") != first
+    assert lookup(cache, cur, "SELECT 'a  b' WHERE x = ?") == first
+    assert cur.prepares == 2
+
+
+def test_statement_errors_are_cached_as_unpreparable():
+    cache, cur = _StatementCache(), FakeCursor(psycopg2.errors.IndeterminateDatatype)
+    assert lookup(cache, cur, 'SELECT ?') is None
+    assert lookup(cache, cur, 'SELECT ?') is None
+    assert cur.prepares == 1
+
+
+def test_transient_errors_are_retried_a_bounded_number_of_times():
+    cache, cur = _StatementCache(), FakeCursor(psycopg2.errors.UndefinedTable)
+    for _ in range(_PREPARE_RETRIES + 2):
+        assert lookup(cache, cur, 'SELECT * FROM later') is None
+    assert cur.prepares == _PREPARE_RETRIES
+
+    cur = FakeCursor(psycopg2.errors.UndefinedTable)
+    assert lookup(cache, cur, 'SELECT * FROM temp_table') is None
+    cur.error = None   # the table exists now
+    assert lookup(cache, cur, 'SELECT * FROM temp_table').startswith('EXECUTE fab_ps_')
+    assert cur.prepares == 2
@@ -0,0 +1,5 @@
+def test_second_save_of_same_inspection_is_skipped(pg):
+    first = pg.add_visual_inspection('2026-02-03', 'a1', 's1', 12.5, 1)
+    again = pg.add_visual_inspection('2026-02-03', 'A1', 'S1', 12.5, 1)
+    assert first is not None and again is None
+    assert len(pg.get_visual_inspections()) == 1